@@ -1,15 +1,28 @@
-import requests
+import asyncio
+import concurrent.futures
 import hashlib
 import logging
 import json
 import time
 from typing import Dict, Any, Optional
 
+import aiohttp
+
+from Functions.AsyncLoop import run_coro
+from Functions.HttpSessions import get_session
+
+# Ожидание ответа APays из синхронного кода (секунды)
+REQUEST_TIMEOUT = 30
+# Ошибки запроса к APays (сеть, HTTP-статус, таймаут)
+REQUEST_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError, concurrent.futures.TimeoutError)
+
 
 class APaysPayment:
     """
     Класс для работы с APays API
     Документация: https://docs.apays.io/lets-start/api
+    
+    Запросы идут через общую aiohttp-сессию "apays" (Functions.HttpSessions) в фоновом цикле событий
     """
     
     def __init__(self, client_id: int, secret_key: str, base_url: str = "https://apays.io"):
@@ -24,13 +37,12 @@ class APaysPayment:
         self.client_id = client_id
         self.secret_key = secret_key
         self.base_url = base_url.rstrip('/')
-        self.session = requests.Session()
         
-        # Настройка заголовков
-        self.session.headers.update({
+        # Заголовки запросов
+        self.headers = {
             'User-Agent': 'FragmentBot/1.0',
             'Accept': 'application/json'
-        })
+        }
         
         logging.info("✅ APays клиент инициализирован")
     
@@ -54,6 +66,17 @@ class APaysPayment:
         
         return hashlib.md5(sign_string.encode('utf-8')).hexdigest()
     
+    async def _get_async(self, path: str, params: Dict[str, Any]) -> Dict[str, Any]:
+        """GET-запрос к APays; ошибка HTTP-статуса - aiohttp.ClientResponseError"""
+        async with get_session("apays").get(f"{self.base_url}{path}", params=params,
+                                            headers=self.headers) as response:
+            response.raise_for_status()
+            return await response.json(content_type=None)
+    
+    def _get(self, path: str, params: Dict[str, Any]) -> Dict[str, Any]:
+        """Синхронная обертка _get_async для обработчиков"""
+        return run_coro(self._get_async(path, params), timeout=REQUEST_TIMEOUT)
+    
     def create_order(self, order_id: str, amount: int, callback_url: str = "") -> Dict[str, Any]:
         """
         Создает новый заказ на оплату
@@ -84,14 +107,12 @@ class APaysPayment:
         try:
             logging.info(f"📡 APays создание заказа: order_id={order_id}, amount={amount} копеек")
             
-            response = self.session.get(f"{self.base_url}/backend/create_order", params=params)
-            response.raise_for_status()
-            result = response.json()
+            result = self._get("/backend/create_order", params)
             
             logging.info(f"✅ APays заказ создан: {result}")
             return result
             
-        except requests.exceptions.RequestException as e:
+        except REQUEST_ERRORS as e:
             logging.error(f"❌ Ошибка создания заказа APays: {e}")
             raise Exception(f"Ошибка создания заказа APays: {e}")
         except json.JSONDecodeError as e:
@@ -122,14 +143,12 @@ class APaysPayment:
         try:
             logging.info(f"📡 APays проверка статуса: order_id={order_id}")
             
-            response = self.session.get(f"{self.base_url}/backend/get_order", params=params)
-            response.raise_for_status()
-            result = response.json()
+            result = self._get("/backend/get_order", params)
             
             logging.info(f"✅ APays статус заказа: {result}")
             return result
             
-        except requests.exceptions.RequestException as e:
+        except REQUEST_ERRORS as e:
             logging.error(f"❌ Ошибка получения статуса APays: {e}")
             raise Exception(f"Ошибка получения статуса APays: {e}")
         except json.JSONDecodeError as e:
@@ -0,0 +1,164 @@
+import asyncio
+import json
+import logging
+import threading
+import time
+from re import search
+
+import aiohttp
+
+from FragmentApi.PaymentGet import (HASH_TTL, FRAGMENT_PAGE_URL, HASH_ERRORS, FRAGMENT_HEADERS, load_cookies,
+                                    buy_link_payload, payment_data_from_response)
+from FragmentApi.RecipientCache import get_recipient_cache, recipient_from_response, MISSING
+from Functions.AsyncLoop import run_blocking
+from Functions.HttpSessions import get_session
+
+# Таймаут каждого шага покупки, секунды
+STEP_TIMEOUTS = {
+    "hash": 15,
+    "searchStarsRecipient": 10,
+    "initBuyStarsRequest": 15,
+    "getBuyStarsLink": 20,
+}
+
+
+class AsyncPaymentGet:
+    """
+    Неблокирующий клиент Fragment на aiohttp: тот же порядок запросов
+    searchStarsRecipient -> initBuyStarsRequest -> getBuyStarsLink, что и в PaymentGet,
+    но запросы не останавливают цикл событий, поэтому покупки идут параллельно.
+    Соединения берутся из общей сессии "fragment" (Functions.HttpSessions);
+    заголовки, cookies и разбор ответов - общие с PaymentGet функции модуля FragmentApi.PaymentGet.
+    """
+
+    def __init__(self, cookies_path='cookies.json', hash_ttl=HASH_TTL):
+        self.cookies = load_cookies(cookies_path)
+        self.headers = dict(FRAGMENT_HEADERS)
+
+        self.hash_ttl = hash_ttl
+        # asyncio.Lock создается в цикле событий при первом обновлении hash
+        self._hash_lock = None
+        self._api_hash = None
+        self._hash_expires = 0.0
+        self.hash_refreshes = 0
+
+    async def _hash_get_async(self):
+        timeout = aiohttp.ClientTimeout(total=STEP_TIMEOUTS["hash"])
+        async with get_session("fragment").get(FRAGMENT_PAGE_URL, cookies=self.cookies, timeout=timeout) as response:
+            text = await response.text()
+            if response.status == 200:
+                match = search(r'api\?hash=([a-zA-Z0-9]+)', text)
+                if match:
+                    return match.group(1)
+        logging.error(f"❌ Не удалось получить api hash Fragment (HTTP {response.status})")
+        return None
+
+    async def _update_url_async(self, force=False):
+        if self._hash_lock is None:
+            self._hash_lock = asyncio.Lock()
+        async with self._hash_lock:
+            if force or self._api_hash is None or time.monotonic() >= self._hash_expires:
+                api_hash = await self._hash_get_async()
+                if api_hash is None:
+                    raise Exception("Не удалось получить api hash Fragment")
+                self._api_hash = api_hash
+                self._hash_expires = time.monotonic() + self.hash_ttl
+                self.hash_refreshes += 1
+                logging.info("🔑 api hash Fragment обновлен")
+            return f"https://fragment.com/api?hash={self._api_hash}"
+
+    async def _post_once(self, url, data, step):
+        timeout = aiohttp.ClientTimeout(total=STEP_TIMEOUTS[step])
+        async with get_session("fragment").post(url, headers=self.headers, cookies=self.cookies,
+                                                data=data, timeout=timeout) as response:
+            text = await response.text()
+            try:
+                body = json.loads(text)
+            except ValueError:
+                body = None
+            return response.status, body, text
+
+    async def _post_async(self, data, step):
+        """POST в API Fragment с таймаутом шага; при отказе hash перечитывается и запрос повторяется"""
+        status, body, text = await self._post_once(await self._update_url_async(), data, step)
+        error = str(body.get("error", "")).lower() if isinstance(body, dict) else ""
+        if status != 200 or body is None or any(marker in error for marker in HASH_ERRORS):
+            logging.warning(f"⚠️ Fragment отклонил {step} (HTTP {status}), обновляем api hash")
+            status, body, text = await self._post_once(await self._update_url_async(force=True), data, step)
+        if body is None:
+            raise Exception(f"Fragment вернул не JSON на {step} (HTTP {status}): {text[:200]}")
+        return body
+
+    async def warm_up_async(self):
+        await self._update_url_async()
+
+    async def resolve_recipient_async(self, recipient, use_cache=True):
+        """То же, что PaymentGet.resolve_recipient, без блокировки цикла событий"""
+        cache = get_recipient_cache()
+        if use_cache:
+            cached = cache.lookup(recipient)
+            if cached is not MISSING:
+                return cached, True
+        body = await self._post_async(f"query={recipient}&quantity=&method=searchStarsRecipient",
+                                      "searchStarsRecipient")
+        recipient_id, known = recipient_from_response(body)
+        if not known:
+            # Ответ не говорит ни "найден", ни "не найден": не кэшируем и не считаем отказом
+            raise Exception(f"Неожиданный ответ searchStarsRecipient для @{recipient}: {body}")
+        cache.put(recipient, recipient_id)
+        return recipient_id, False
+
+    async def _init_request_async(self, recipient_id, quantity):
+        init = await self._post_async(f"recipient={recipient_id}&quantity={quantity}&method=initBuyStarsRequest",
+                                      "initBuyStarsRequest")
+        return init.get("req_id", "")
+
+    async def get_data_for_payment(self, recipient, quantity, mnemonics):
+        logging.warning(f"Sending {quantity} stars to @{recipient}...")
+
+        recipient_id, cached = await self.resolve_recipient_async(recipient)
+        if recipient_id is None:
+            raise Exception(f"Получатель @{recipient} не найден на Fragment")
+
+        req_id = await self._init_request_async(recipient_id, quantity)
+        if not req_id and cached:
+            # Закэшированный recipient мог устареть: получаем заново и повторяем один раз
+            get_recipient_cache().invalidate(recipient)
+            recipient_id, _ = await self.resolve_recipient_async(recipient, use_cache=False)
+            if recipient_id is None:
+                raise Exception(f"Получатель @{recipient} не найден на Fragment")
+            req_id = await self._init_request_async(recipient_id, quantity)
+
+        # Ключи берутся из кэша wallet.WalletIdentity; если прогрев при запуске не успел,
+        # первый вывод ключа (PBKDF2) не должен останавливать цикл событий
+        encoded_payload = await run_blocking(buy_link_payload, req_id, mnemonics)
+
+        response_json = await self._post_async(encoded_payload, "getBuyStarsLink")
+        logging.info(f"📊 JSON ответ: {response_json}")
+
+        address, amount, payload = payment_data_from_response(response_json)
+        logging.info("Payment data received!")
+        logging.warning("Waiting to send transaction...")
+        return address, amount, payload
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_async_payment_client():
+    """Общий асинхронный клиент Fragment процесса (используется в общем цикле событий)"""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = AsyncPaymentGet()
+        return _client
+
+
+async def warm_up_async_client():
+    """Получает api hash при запуске бота, чтобы первая покупка не ждала"""
+    try:
+        await get_async_payment_client().warm_up_async()
+        logging.info("✅ Клиент Fragment готов")
+    except Exception as e:
+        logging.warning(f"⚠️ Клиент Fragment не подготовлен заранее: {e}")
@@ -1,8 +1,21 @@
-from FragmentApi.PaymentGet import PaymentGet
+from FragmentApi.AsyncPaymentGet import get_async_payment_client
 from wallet.Transactions import Transactions
 import logging
 from config import TON_CENTER_API_KEY, TON_CENTER_API_URL, TON_NETWORK
 
+# testnet -> Transactions: создаются один раз на процесс
+_transactions = {}
+
+
+def get_transactions(testnet: bool = False) -> Transactions:
+    transactions = _transactions.get(testnet)
+    if transactions is None:
+        transactions = _transactions[testnet] = Transactions({
+            'testnet': testnet,
+            'TON_NETWORK': 'mainnet' if not testnet else 'testnet'
+        })
+    return transactions
+
 
 async def buy_stars(recipient, amount, mnemonics, version="v4r2", testnet=False, send_mode=1, test_mode=False):
     """
@@ -11,20 +24,17 @@ async def buy_stars(recipient, amount, mnemonics, version="v4r2", testnet=False,
     try:
         logging.info(f"🚀 Начинаем покупку {amount} звезд для @{recipient}")
         
-        payment = PaymentGet()
+        # Один клиент Fragment на процесс: общие aiohttp-соединения и кэшированный api hash
+        payment = get_async_payment_client()
         
-        # Создаем config для Transactions
-        config = {
-            'testnet': testnet,
-            'TON_NETWORK': 'mainnet' if not testnet else 'testnet'
-        }
-        
-        # Создаем объект Transactions с config
-        transactions = Transactions(config)
+        # Объект Transactions (и его TonCenterClient) переиспользуется между покупками
+        transactions = get_transactions(testnet)
         
         logging.info("📡 Получаем данные для платежа...")
-        payment_address, payment_amount, payload = payment.get_data_for_payment(recipient=recipient, quantity=amount,
-                                                                                mnemonics=mnemonics)
+        # Запросы к Fragment не блокируют цикл событий: покупки разных пользователей идут параллельно
+        payment_address, payment_amount, payload = await payment.get_data_for_payment(
+            recipient=recipient, quantity=amount, mnemonics=mnemonics
+        )
         
         if not payment_address or not payment_amount:
             logging.error("❌ Не удалось получить данные для платежа от Fragment API")
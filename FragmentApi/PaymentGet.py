@@ -1,81 +1,195 @@
 import requests
+from requests.adapters import HTTPAdapter
 from re import search
 import logging
+import threading
+import time
 from wallet.WalletUtils import WalletUtils
+from wallet.WalletIdentity import get_identity
+from FragmentApi.RecipientCache import get_recipient_cache, recipient_from_response, MISSING
 from urllib.parse import urlencode
 import json
 import base64
 
+# Сколько секунд api?hash считается действительным без повторного разбора страницы
+HASH_TTL = 3600
+FRAGMENT_PAGE_URL = "https://fragment.com/stars/buy"
+# Ошибки API, после которых hash перечитывается (ошибки вроде "получатель не найден" сюда не входят)
+HASH_ERRORS = ("hash", "access denied", "expired", "reload", "session")
+FRAGMENT_HEADERS = {
+    "Content-Type": "application/x-www-form-urlencoded; charset=UTF-8",
+    "Referer": "https://fragment.com/stars/buy",
+    "X-Requested-With": "XMLHttpRequest",
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/132.0.0.0 Safari/537.36 OPR/117.0.0.0 (Edition Yx GX)"
+}
+
+
+# Общие части синхронного (PaymentGet) и асинхронного (AsyncPaymentGet) клиентов Fragment
+
+def load_cookies(cookies_path='cookies.json'):
+    with open(cookies_path, 'r') as file:
+        return json.load(file)
+
+
+def buy_link_payload(req_id, mnemonics):
+    """Тело запроса getBuyStarsLink; публичный ключ берется из кэша wallet.WalletIdentity"""
+    payload = {
+        "account": json.dumps({
+            "chain": "-239",
+            "publicKey": get_identity(mnemonics).public_key
+        }),
+        "device": json.dumps({
+            "platform": "web",
+            "appName": "telegram-wallet",
+            "appVersion": "1",
+            "maxProtocolVersion": 2,
+            "features": ["SendTransaction", {"name": "SendTransaction", "maxMessages": 4}]
+        }),
+        "transaction": 1,
+        "id": req_id,
+        "show_sender": 0,
+        "method": "getBuyStarsLink"
+    }
+    return urlencode(payload)
+
+
+def message_decode(encoded_payload):
+    padding_needed = len(encoded_payload) % 4
+    if padding_needed != 0:
+        encoded_payload += '=' * (4 - padding_needed)
+    decoded_payload = base64.b64decode(encoded_payload)
+    text_part = decoded_payload.split(b"\x00")[-1].decode("utf-8")
+
+    return text_part
+
+
+def payment_data_from_response(response_json):
+    """(address, amount, payload) из ответа getBuyStarsLink"""
+    # Проверяем структуру ответа
+    if "transaction" in response_json and "messages" in response_json["transaction"]:
+        buy_payload = response_json["transaction"]["messages"][0]
+    elif "messages" in response_json:
+        buy_payload = response_json["messages"][0]
+    else:
+        # Если структура другая, ищем нужные поля
+        logging.error(f"❌ Неожиданная структура ответа: {response_json}")
+        raise Exception(f"Неожиданная структура ответа Fragment API: {response_json}")
+
+    address, amount, encoded_message = buy_payload["address"], buy_payload["amount"], buy_payload["payload"]
+    return address, amount, message_decode(encoded_message)
+
 
 class PaymentGet:
-    def __init__(self):
+    """
+    Клиент Fragment: одна keep-alive сессия requests на все запросы, cookies читаются
+    один раз, api?hash кэшируется на HASH_TTL и перечитывается раньше, только если
+    Fragment отклонил запрос. Создавайте один раз на процесс (get_payment_client).
+    """
+
+    def __init__(self, cookies_path='cookies.json', hash_ttl=HASH_TTL):
         self.WalletUtils = WalletUtils()
-        with open('cookies.json', 'r') as file:
-            loaded_cookies = json.load(file)
+        self.cookies = load_cookies(cookies_path)
+        self.headers = dict(FRAGMENT_HEADERS)
+
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_connections=1, pool_maxsize=10))
+        self.session.cookies.update(self.cookies)
 
-        self.cookies = loaded_cookies
-        self.headers = {
-            "Content-Type": "application/x-www-form-urlencoded; charset=UTF-8",
-            "Referer": "https://fragment.com/stars/buy",
-            "X-Requested-With": "XMLHttpRequest",
-            "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/132.0.0.0 Safari/537.36 OPR/117.0.0.0 (Edition Yx GX)"
-        }
+        self.hash_ttl = hash_ttl
+        self._hash_lock = threading.Lock()
+        self._api_hash = None
+        self._hash_expires = 0.0
+        self.hash_refreshes = 0
 
     def _hash_get(self):
-        response = requests.get("https://fragment.com/stars/buy", cookies=self.cookies)
+        response = self.session.get(FRAGMENT_PAGE_URL, timeout=30)
         if response.status_code == 200:
-            return search(r'api\?hash=([a-zA-Z0-9]+)', response.text).group(1)
-
-    def _update_url(self):
-        return f"https://fragment.com/api?hash={self._hash_get()}"
-
-    def _payload_get(self, req_id, mnemonics):
-        payload = {
-            "account": json.dumps({
-                "chain": "-239",
-                "publicKey": self.WalletUtils.wallet_from_mnemonics(mnemonics)[0]["public_key"]
-            }),
-            "device": json.dumps({
-                "platform": "web",
-                "appName": "telegram-wallet",
-                "appVersion": "1",
-                "maxProtocolVersion": 2,
-                "features": ["SendTransaction", {"name": "SendTransaction", "maxMessages": 4}]
-            }),
-            "transaction": 1,
-            "id": req_id,
-            "show_sender": 0,
-            "method": "getBuyStarsLink"
-        }
-        return urlencode(payload)
+            match = search(r'api\?hash=([a-zA-Z0-9]+)', response.text)
+            if match:
+                return match.group(1)
+        logging.error(f"❌ Не удалось получить api hash Fragment (HTTP {response.status_code})")
+        return None
+
+    def _update_url(self, force=False):
+        """URL API с кэшированным hash; force - перечитать hash со страницы"""
+        with self._hash_lock:
+            if force or self._api_hash is None or time.monotonic() >= self._hash_expires:
+                api_hash = self._hash_get()
+                if api_hash is None:
+                    raise Exception("Не удалось получить api hash Fragment")
+                self._api_hash = api_hash
+                self._hash_expires = time.monotonic() + self.hash_ttl
+                self.hash_refreshes += 1
+                logging.info("🔑 api hash Fragment обновлен")
+            return f"https://fragment.com/api?hash={self._api_hash}"
 
     @staticmethod
-    def _message_decode(encoded_payload):
-        padding_needed = len(encoded_payload) % 4
-        if padding_needed != 0:
-            encoded_payload += '=' * (4 - padding_needed)
-        decoded_payload = base64.b64decode(encoded_payload)
-        text_part = decoded_payload.split(b"\x00")[-1].decode("utf-8")
-
-        return text_part
+    def _rejected(response):
+        """Fragment не принял hash или сессию: ответ не JSON либо ошибка доступа"""
+        if response.status_code != 200:
+            return True
+        try:
+            data = response.json()
+        except ValueError:
+            return True
+        error = str(data.get("error", "")).lower() if isinstance(data, dict) else ""
+        return any(marker in error for marker in HASH_ERRORS)
+
+    def _post(self, data):
+        """POST в API Fragment; при отказе hash перечитывается и запрос повторяется один раз"""
+        response = self.session.post(self._update_url(), headers=self.headers, data=data, timeout=30)
+        if self._rejected(response):
+            logging.warning(f"⚠️ Fragment отклонил запрос (HTTP {response.status_code}), обновляем api hash")
+            response = self.session.post(self._update_url(force=True), headers=self.headers, data=data, timeout=30)
+        return response
+
+    def warm_up(self):
+        """Открывает соединение с Fragment и получает hash заранее, до первой покупки"""
+        self._update_url()
+
+    def resolve_recipient(self, recipient, use_cache=True):
+        """
+        recipient Fragment для username и признак, что он взят из кэша.
+        None - Fragment подтвердил, что получателя нет; на непонятный ответ - исключение.
+        """
+        cache = get_recipient_cache()
+        if use_cache:
+            cached = cache.lookup(recipient)
+            if cached is not MISSING:
+                return cached, True
+        try:
+            body = self._post(f"query={recipient}&quantity=&method=searchStarsRecipient").json()
+        except ValueError:
+            body = None
+        recipient_id, known = recipient_from_response(body)
+        if not known:
+            # Ответ не говорит ни "найден", ни "не найден": не кэшируем и не считаем отказом
+            raise Exception(f"Неожиданный ответ searchStarsRecipient для @{recipient}: {body}")
+        cache.put(recipient, recipient_id)
+        return recipient_id, False
+
+    def _init_request(self, recipient_id, quantity):
+        return self._post(f"recipient={recipient_id}&quantity={quantity}&method=initBuyStarsRequest").json().get("req_id", "")
 
     def get_data_for_payment(self, recipient, quantity, mnemonics):
         logging.warning(f"Sending {quantity} stars to @{recipient}...")
 
-        url = self._update_url()
-
-        recipient_id_dirt = requests.post(url, headers=self.headers, cookies=self.cookies,
-                                          data=f"query={recipient}&quantity=&method=searchStarsRecipient")
-        recipient_id = recipient_id_dirt.json().get("found", {}).get("recipient", "")
-
+        recipient_id, cached = self.resolve_recipient(recipient)
+        if recipient_id is None:
+            raise Exception(f"Получатель @{recipient} не найден на Fragment")
 
-        req_id_dirt = requests.post(url, headers=self.headers, cookies=self.cookies,
-                                    data=f"recipient={recipient_id}&quantity={quantity}&method=initBuyStarsRequest")
-        req_id = req_id_dirt.json().get("req_id", "")
+        req_id = self._init_request(recipient_id, quantity)
+        if not req_id and cached:
+            # Закэшированный recipient мог устареть: получаем заново и повторяем один раз
+            get_recipient_cache().invalidate(recipient)
+            recipient_id, _ = self.resolve_recipient(recipient, use_cache=False)
+            if recipient_id is None:
+                raise Exception(f"Получатель @{recipient} не найден на Fragment")
+            req_id = self._init_request(recipient_id, quantity)
 
-        encoded_payload = self._payload_get(req_id, mnemonics)
+        encoded_payload = buy_link_payload(req_id, mnemonics)
 
-        buy_payload_dirt = requests.post(url, headers=self.headers, cookies=self.cookies, data=encoded_payload)
+        buy_payload_dirt = self._post(encoded_payload)
         
         # Добавляем отладочную информацию
         logging.info(f"📡 Ответ Fragment API: {buy_payload_dirt.text}")
@@ -83,18 +197,21 @@ class PaymentGet:
         response_json = buy_payload_dirt.json()
         logging.info(f"📊 JSON ответ: {response_json}")
         
-        # Проверяем структуру ответа
-        if "transaction" in response_json and "messages" in response_json["transaction"]:
-            buy_payload = response_json["transaction"]["messages"][0]
-        elif "messages" in response_json:
-            buy_payload = response_json["messages"][0]
-        else:
-            # Если структура другая, ищем нужные поля
-            logging.error(f"❌ Неожиданная структура ответа: {response_json}")
-            raise Exception(f"Неожиданная структура ответа Fragment API: {response_json}")
-
-        address, amount, encoded_message = buy_payload["address"], buy_payload["amount"], buy_payload["payload"]
-        payload = self._message_decode(encoded_message)
+        address, amount, payload = payment_data_from_response(response_json)
         logging.info("Payment data received!")
         logging.warning("Waiting to send transaction...")
         return address, amount, payload
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_payment_client():
+    """Общий клиент Fragment процесса (создается при первом обращении)"""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = PaymentGet()
+        return _client
+
@@ -0,0 +1,111 @@
+"""
+Кэш username -> recipient Fragment (ответ searchStarsRecipient)
+
+Повторные покупки тому же получателю (популярные получатели, покупки себе) не делают
+запрос searchStarsRecipient: найденный recipient хранится RECIPIENT_TTL секунд, ответ
+"пользователь не найден" - NOT_FOUND_TTL секунд, чтобы опечатка не уходила в Fragment
+на каждую попытку. Кэш общий для PaymentGet и AsyncPaymentGet, заполняется и при
+проверке username в боте (check_username_exists).
+"""
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+RECIPIENT_TTL = 6 * 3600
+NOT_FOUND_TTL = 10 * 60
+MAX_RECIPIENTS = 10000
+# Тексты ошибки searchStarsRecipient, означающие, что получателя нет
+NOT_FOUND_ERRORS = ("not found", "no telegram users")
+
+# Результат lookup, когда о получателе ничего не известно
+MISSING = object()
+
+
+def recipient_from_response(body) -> Tuple[Optional[str], bool]:
+    """
+    Разбор ответа searchStarsRecipient: (recipient, определен ли результат).
+    (None, True) - получатель не найден; (None, False) - ответ не позволяет судить.
+    """
+    if not isinstance(body, dict):
+        return None, False
+    recipient = (body.get("found") or {}).get("recipient")
+    if recipient:
+        return recipient, True
+    error = str(body.get("error", "")).lower()
+    if any(marker in error for marker in NOT_FOUND_ERRORS):
+        return None, True
+    return None, False
+
+
+class RecipientCache:
+    """LRU username -> (recipient или None для "не найден", момент истечения)"""
+
+    def __init__(self, max_size: int = MAX_RECIPIENTS, ttl: float = RECIPIENT_TTL,
+                 not_found_ttl: float = NOT_FOUND_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.not_found_ttl = not_found_ttl
+        self._lock = threading.Lock()
+        self._entries: "OrderedDict[str, Tuple[Optional[str], float]]" = OrderedDict()
+        self.hits = 0
+        self.not_found_hits = 0
+        self.misses = 0
+        self.invalidated = 0
+
+    @staticmethod
+    def _key(username: str) -> str:
+        return username.lstrip('@').lower()
+
+    def lookup(self, username: str):
+        """recipient, None для закэшированного "не найден" или MISSING"""
+        key = self._key(username)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] <= time.monotonic():
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return MISSING
+            self._entries.move_to_end(key)
+            if entry[0] is None:
+                self.not_found_hits += 1
+            else:
+                self.hits += 1
+            return entry[0]
+
+    def put(self, username: str, recipient: Optional[str]):
+        """Запоминает recipient; None - получатель не найден (хранится меньше)"""
+        key = self._key(username)
+        expires = time.monotonic() + (self.ttl if recipient else self.not_found_ttl)
+        with self._lock:
+            self._entries[key] = (recipient or None, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, username: str):
+        """Удаляет запись, если Fragment не принял закэшированный recipient"""
+        with self._lock:
+            if self._entries.pop(self._key(username), None) is not None:
+                self.invalidated += 1
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.not_found_hits + self.misses
+            return {
+                "cached": len(self._entries),
+                "hits": self.hits,
+                "not_found_hits": self.not_found_hits,
+                "misses": self.misses,
+                "invalidated": self.invalidated,
+                "hit_rate": (self.hits + self.not_found_hits) / lookups if lookups else 0.0,
+            }
+
+
+_cache = RecipientCache()
+
+
+def get_recipient_cache() -> RecipientCache:
+    """Общий кэш получателей процесса"""
+    return _cache
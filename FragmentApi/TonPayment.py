@@ -1,12 +1,23 @@
 """
 Модуль для обработки прямых TON переводов
+
+Запросы к TON Center и CoinGecko идут через общие aiohttp-сессии (Functions.HttpSessions)
+в фоновом цикле событий: синхронные методы для обработчиков вызывают корутины через run_coro.
 """
-import requests
 import time
 import logging
 from typing import Dict, Optional, List
+
+from Functions.AsyncLoop import run_coro
+from Functions.HttpSessions import get_session
 from config import TON_WALLET_ADDRESS, TON_COMMISSION_PERCENT, TON_CENTER_API_KEY, TON_CENTER_API_URL
 
+COINGECKO_PRICE_URL = "https://api.coingecko.com/api/v3/simple/price"
+# Ожидание ответа из синхронного кода (секунды)
+REQUEST_TIMEOUT = 30
+# Fallback курс (примерно 200 рублей за TON)
+FALLBACK_RATE = 200
+
 class TonPayment:
     """Класс для работы с прямыми TON переводами"""
     
@@ -17,7 +28,7 @@ class TonPayment:
         self.api_url = TON_CENTER_API_URL
         logging.info("✅ TON Payment инициализирован")
     
-    def get_wallet_transactions(self, limit: int = 50) -> List[Dict]:
+    async def get_wallet_transactions_async(self, limit: int = 50) -> List[Dict]:
         """Получает последние транзакции кошелька через TON Center API"""
         try:
             headers = {
@@ -25,71 +36,70 @@ class TonPayment:
             }
             
             # Получаем последние транзакции
-            response = requests.get(
-                f"{self.api_url}/getTransactions",
-                params={
-                    'address': self.wallet_address,
-                    'limit': limit,
-                    'archival': True
-                },
-                headers=headers
-            )
-            
-            if response.status_code == 200:
-                data = response.json()
-                if data.get('ok'):
-                    return data.get('result', [])
-                else:
-                    logging.error(f"TON Center API error: {data.get('error', 'Unknown error')}")
+            params = {
+                'address': self.wallet_address,
+                'limit': limit,
+                'archival': 'true'
+            }
+            async with get_session("toncenter").get(f"{self.api_url}/getTransactions",
+                                                    params=params, headers=headers) as response:
+                if response.status != 200:
+                    logging.error(f"TON Center API HTTP error: {response.status}")
                     return []
-            else:
-                logging.error(f"TON Center API HTTP error: {response.status_code}")
-                return []
+                data = await response.json(content_type=None)
+            
+            if data.get('ok'):
+                return data.get('result', [])
+            logging.error(f"TON Center API error: {data.get('error', 'Unknown error')}")
+            return []
                 
         except Exception as e:
             logging.error(f"Ошибка получения транзакций: {e}")
             return []
     
-    def rubles_to_ton(self, rubles: float) -> float:
-        """Конвертирует рубли в TON по текущему курсу"""
+    def get_wallet_transactions(self, limit: int = 50) -> List[Dict]:
+        """Синхронная обертка get_wallet_transactions_async для обработчиков"""
         try:
-            # Получаем курс TON к рублю
-            response = requests.get("https://api.coingecko.com/api/v3/simple/price?ids=the-open-network&vs_currencies=rub")
-            if response.status_code == 200:
-                data = response.json()
-                ton_price_rub = data.get("the-open-network", {}).get("rub", 0)
-                if ton_price_rub > 0:
-                    ton_amount = rubles / ton_price_rub
-                    return round(ton_amount, 4)
-            
-            # Fallback курс (примерно 200 рублей за TON)
-            fallback_rate = 200
-            return round(rubles / fallback_rate, 4)
-            
+            return run_coro(self.get_wallet_transactions_async(limit), timeout=REQUEST_TIMEOUT)
+        except Exception as e:
+            logging.error(f"Ошибка получения транзакций: {e}")
+            return []
+    
+    async def get_ton_price_rub_async(self) -> float:
+        """Курс TON к рублю по CoinGecko; 0, если курс получить не удалось"""
+        try:
+            params = {'ids': 'the-open-network', 'vs_currencies': 'rub'}
+            async with get_session("coingecko").get(COINGECKO_PRICE_URL, params=params) as response:
+                if response.status != 200:
+                    logging.error(f"CoinGecko HTTP error: {response.status}")
+                    return 0
+                data = await response.json(content_type=None)
+            return data.get("the-open-network", {}).get("rub", 0)
         except Exception as e:
             logging.error(f"Ошибка получения курса TON: {e}")
-            # Fallback курс
-            fallback_rate = 200
-            return round(rubles / fallback_rate, 4)
+            return 0
     
-    def ton_to_rubles(self, ton_amount: float) -> float:
-        """Конвертирует TON в рубли по текущему курсу"""
+    def get_ton_price_rub(self) -> float:
+        """Синхронная обертка get_ton_price_rub_async для обработчиков"""
         try:
-            response = requests.get("https://api.coingecko.com/api/v3/simple/price?ids=the-open-network&vs_currencies=rub")
-            if response.status_code == 200:
-                data = response.json()
-                ton_price_rub = data.get("the-open-network", {}).get("rub", 0)
-                if ton_price_rub > 0:
-                    return round(ton_amount * ton_price_rub, 2)
-            
-            # Fallback курс
-            fallback_rate = 200
-            return round(ton_amount * fallback_rate, 2)
-            
+            return run_coro(self.get_ton_price_rub_async(), timeout=REQUEST_TIMEOUT)
         except Exception as e:
             logging.error(f"Ошибка получения курса TON: {e}")
-            fallback_rate = 200
-            return round(ton_amount * fallback_rate, 2)
+            return 0
+    
+    def rubles_to_ton(self, rubles: float) -> float:
+        """Конвертирует рубли в TON по текущему курсу"""
+        ton_price_rub = self.get_ton_price_rub()
+        if ton_price_rub > 0:
+            return round(rubles / ton_price_rub, 4)
+        return round(rubles / FALLBACK_RATE, 4)
+    
+    def ton_to_rubles(self, ton_amount: float) -> float:
+        """Конвертирует TON в рубли по текущему курсу"""
+        ton_price_rub = self.get_ton_price_rub()
+        if ton_price_rub > 0:
+            return round(ton_amount * ton_price_rub, 2)
+        return round(ton_amount * FALLBACK_RATE, 2)
     
     def create_payment_request(self, user_id: int, amount_rub: float) -> Dict:
         """Создает запрос на пополнение через TON"""
@@ -0,0 +1,116 @@
+"""
+Один долгоживущий цикл событий в фоновом потоке для корутин из синхронных обработчиков
+
+Вместо asyncio.run(...) на каждую покупку и каждый лог обработчик вызывает
+run_coro(coro, timeout): корутина выполняется в общем цикле, поэтому aiohttp-сессии
+(Functions.HttpSessions) и клиенты, созданные в корутинах, живут между вызовами.
+"""
+import asyncio
+import concurrent.futures
+import logging
+import threading
+from typing import Optional
+
+from Functions.HttpSessions import close_sessions
+
+
+class AsyncLoop:
+    def __init__(self, name: str = "async-loop"):
+        self.loop = asyncio.new_event_loop()
+        self._started = threading.Event()
+        self._thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self._thread.start()
+        self._started.wait()
+
+        self.completed = 0
+        self.failed = 0
+        self.timed_out = 0
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.call_soon(self._started.set)
+        self.loop.run_forever()
+
+    def run_coro(self, coro, timeout: Optional[float] = None):
+        """
+        Выполняет корутину в фоновом цикле и ждет результат.
+        При таймауте корутина отменяется и выбрасывается concurrent.futures.TimeoutError.
+        """
+        if threading.current_thread() is self._thread:
+            coro.close()
+            raise RuntimeError("run_coro нельзя вызывать из потока цикла событий: используйте await")
+
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        try:
+            result = future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            self.timed_out += 1
+            raise
+        except Exception:
+            self.failed += 1
+            raise
+        self.completed += 1
+        return result
+
+    def spawn(self, coro) -> concurrent.futures.Future:
+        """Запускает корутину без ожидания; ошибка попадает в лог"""
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+
+        def done(f: concurrent.futures.Future):
+            if f.cancelled():
+                return
+            if f.exception() is not None:
+                self.failed += 1
+                logging.error(f"❌ Ошибка фоновой задачи: {f.exception()}")
+            else:
+                self.completed += 1
+
+        future.add_done_callback(done)
+        return future
+
+    def stats(self):
+        return {
+            "completed": self.completed,
+            "failed": self.failed,
+            "timed_out": self.timed_out,
+            "tasks": len(asyncio.all_tasks(self.loop)) if self.loop.is_running() else 0,
+        }
+
+    def stop(self, timeout: float = 10.0):
+        """Закрывает HTTP-сессии цикла и останавливает поток"""
+        if not self.loop.is_running():
+            return
+        try:
+            asyncio.run_coroutine_threadsafe(close_sessions(), self.loop).result(timeout)
+        except Exception as e:
+            logging.warning(f"⚠️ Ошибка закрытия HTTP-сессий: {e}")
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join(timeout)
+        logging.info("✅ Фоновый цикл событий остановлен")
+
+
+_default: Optional[AsyncLoop] = None
+_default_lock = threading.Lock()
+
+
+def get_loop() -> AsyncLoop:
+    """Общий фоновый цикл процесса (создается при первом обращении)"""
+    global _default
+    with _default_lock:
+        if _default is None:
+            _default = AsyncLoop()
+        return _default
+
+
+def run_coro(coro, timeout: Optional[float] = None):
+    return get_loop().run_coro(coro, timeout)
+
+
+def spawn(coro) -> concurrent.futures.Future:
+    return get_loop().spawn(coro)
+
+
+async def run_blocking(fn, *args):
+    """Выполняет блокирующую функцию в пуле потоков, не останавливая цикл событий"""
+    return await asyncio.get_running_loop().run_in_executor(None, fn, *args)
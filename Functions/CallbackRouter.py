@@ -0,0 +1,142 @@
+"""
+Таблица маршрутов callback_data: точные значения в словаре, префиксы (check_ton_payment_<id>)
+в префиксном дереве. Маршрут сам объявляет, нужны ли ему данные пользователя, поэтому
+хранилище читается только для таких маршрутов. По каждому маршруту ведется гистограмма времени.
+"""
+import bisect
+import logging
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+# Верхние границы корзин гистограммы, мс
+LATENCY_BUCKETS_MS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000, 60000)
+
+
+class LatencyHistogram:
+    """Гистограмма времени выполнения с фиксированными корзинами (перцентили - по верхней границе корзины)"""
+    __slots__ = ("counts", "count", "errors", "total_ms", "max_ms")
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.count = 0
+        self.errors = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+
+    def observe(self, elapsed_ms: float, failed: bool = False):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS_MS, elapsed_ms)] += 1
+        self.count += 1
+        self.errors += failed
+        self.total_ms += elapsed_ms
+        self.max_ms = max(self.max_ms, elapsed_ms)
+
+    def percentile(self, fraction: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = fraction * self.count
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= rank:
+                return LATENCY_BUCKETS_MS[index] if index < len(LATENCY_BUCKETS_MS) else self.max_ms
+        return self.max_ms
+
+
+class Route:
+    __slots__ = ("name", "handler", "needs_user", "histogram")
+
+    def __init__(self, name: str, handler: Callable, needs_user: bool):
+        self.name = name
+        self.handler = handler
+        self.needs_user = needs_user
+        self.histogram = LatencyHistogram()
+
+
+# Ключ узла префиксного дерева, под которым лежит маршрут
+_ROUTE_KEY = ""
+
+
+class CallbackRouter:
+    """
+    Обработчик маршрута вызывается как handler(call, user_id, user_data);
+    user_data загружается через load_user только для маршрутов с needs_user=True.
+    """
+
+    def __init__(self, load_user: Callable[[str], object]):
+        self.load_user = load_user
+        self._exact: Dict[str, Route] = {}
+        self._trie: Dict = {}
+        self._routes: List[Route] = []
+        self._lock = threading.Lock()
+        self.unknown = 0
+
+    def route(self, *values: str, prefix: Optional[str] = None, needs_user: bool = False):
+        """Декоратор: регистрирует обработчик для точных значений и/или префикса callback_data"""
+        def decorator(handler: Callable):
+            route = Route(handler.__name__, handler, needs_user)
+            self._routes.append(route)
+            for value in values:
+                if value in self._exact:
+                    raise ValueError(f"Маршрут {value} уже зарегистрирован")
+                self._exact[value] = route
+            if prefix is not None:
+                node = self._trie
+                for char in prefix:
+                    node = node.setdefault(char, {})
+                if _ROUTE_KEY in node:
+                    raise ValueError(f"Префикс {prefix} уже зарегистрирован")
+                node[_ROUTE_KEY] = route
+            return handler
+        return decorator
+
+    def resolve(self, data: str) -> Optional[Route]:
+        """Точное совпадение, иначе самый длинный зарегистрированный префикс"""
+        route = self._exact.get(data)
+        if route is not None:
+            return route
+        node = self._trie
+        for char in data:
+            node = node.get(char)
+            if node is None:
+                break
+            route = node.get(_ROUTE_KEY, route)
+        return route
+
+    def dispatch(self, call, user_id: str) -> bool:
+        """Выполняет маршрут для call.data; False, если маршрута нет"""
+        route = self.resolve(call.data or "")
+        if route is None:
+            self.unknown += 1
+            logging.warning(f"⚠️ Нет обработчика для callback: {call.data}")
+            return False
+
+        started = time.perf_counter()
+        failed = True
+        try:
+            user_data = self.load_user(user_id) if route.needs_user else None
+            route.handler(call, user_id, user_data)
+            failed = False
+        finally:
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            with self._lock:
+                route.histogram.observe(elapsed_ms, failed)
+        return True
+
+    def stats(self) -> List[Tuple[str, Dict]]:
+        """Маршруты, по которым были вызовы, по убыванию числа вызовов"""
+        with self._lock:
+            result = [
+                (route.name, {
+                    "count": route.histogram.count,
+                    "errors": route.histogram.errors,
+                    "avg_ms": route.histogram.total_ms / route.histogram.count,
+                    "p50_ms": route.histogram.percentile(0.5),
+                    "p95_ms": route.histogram.percentile(0.95),
+                    "p99_ms": route.histogram.percentile(0.99),
+                    "max_ms": route.histogram.max_ms,
+                })
+                for route in self._routes if route.histogram.count
+            ]
+        result.sort(key=lambda item: item[1]["count"], reverse=True)
+        return result
@@ -0,0 +1,150 @@
+"""
+Параллельная обработка обновлений Telegram с сохранением порядка внутри каждого чата
+"""
+import functools
+import logging
+import threading
+import time
+from collections import deque
+from typing import Callable, Deque, Dict, Tuple
+
+
+class ChatDispatcher:
+    """
+    Ограниченный пул потоков: обновления разных чатов обрабатываются параллельно,
+    обновления одного чата - строго по очереди в порядке поступления.
+
+    У каждого чата своя очередь задач. В общей очереди готовых чатов чат стоит
+    не больше одного раза, поэтому его задачи никогда не выполняются одновременно,
+    а долгая покупка одного пользователя занимает только один поток.
+    """
+
+    def __init__(self, workers: int = 8, max_pending: int = 1000, name: str = "updates"):
+        self.workers = workers
+        self.max_pending = max_pending
+
+        self._lock = threading.Lock()
+        self._ready = threading.Condition(self._lock)
+        self._has_room = threading.Condition(self._lock)
+        # chat_id -> задачи (fn, args, время постановки)
+        self._queues: Dict[object, Deque[Tuple[Callable, tuple, float]]] = {}
+        # Чаты с задачами, которые сейчас не обрабатываются ни одним потоком
+        self._ready_chats: Deque[object] = deque()
+        self._pending = 0
+        self._stopping = False
+
+        # Метрики
+        self.processed = 0
+        self.failed = 0
+        self.max_depth = 0
+        self.total_wait_ms = 0.0
+        self.max_wait_ms = 0.0
+
+        self._threads = [
+            threading.Thread(target=self._worker, name=f"{name}-{index}", daemon=True)
+            for index in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, chat_id, fn: Callable, *args):
+        """
+        Ставит задачу в очередь чата. Если задач больше max_pending, ждет,
+        пока освободится место: polling притормаживает вместо роста памяти.
+        """
+        with self._lock:
+            while self._pending >= self.max_pending and not self._stopping:
+                self._has_room.wait()
+            if self._stopping:
+                raise RuntimeError("Диспетчер обновлений остановлен")
+
+            queue = self._queues.get(chat_id)
+            if queue is None:
+                # Чат не обрабатывается и не ждет: ставим его в очередь готовых
+                queue = self._queues[chat_id] = deque()
+                self._ready_chats.append(chat_id)
+                self._ready.notify()
+            queue.append((fn, args, time.perf_counter()))
+
+            self._pending += 1
+            self.max_depth = max(self.max_depth, self._pending)
+
+    def _worker(self):
+        while True:
+            with self._lock:
+                while not self._ready_chats and not self._stopping:
+                    self._ready.wait()
+                if not self._ready_chats:
+                    return
+                chat_id = self._ready_chats.popleft()
+                fn, args, queued_at = self._queues[chat_id].popleft()
+
+            wait_ms = (time.perf_counter() - queued_at) * 1000
+            try:
+                fn(*args)
+                failed = False
+            except Exception as e:
+                failed = True
+                logging.error(f"❌ Ошибка обработки обновления чата {chat_id}: {e}", exc_info=True)
+
+            with self._lock:
+                self._pending -= 1
+                self.processed += 1
+                self.failed += failed
+                self.total_wait_ms += wait_ms
+                self.max_wait_ms = max(self.max_wait_ms, wait_ms)
+
+                if self._queues[chat_id]:
+                    # У чата есть следующие обновления: в конец очереди, чтобы не задерживать другие чаты
+                    self._ready_chats.append(chat_id)
+                    self._ready.notify()
+                else:
+                    del self._queues[chat_id]
+                self._has_room.notify_all()
+
+    def per_chat(self, chat_of: Callable):
+        """
+        Декоратор обработчика telebot: обработчик выполняется в пуле,
+        chat_of(update) выбирает очередь, в которой сохраняется порядок
+        """
+        def decorator(handler: Callable):
+            @functools.wraps(handler)
+            def wrapper(update):
+                self.submit(chat_of(update), handler, update)
+            return wrapper
+        return decorator
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "workers": self.workers,
+                "pending": self._pending,
+                "active_chats": len(self._queues),
+                "max_depth": self.max_depth,
+                "processed": self.processed,
+                "failed": self.failed,
+                "avg_wait_ms": self.total_wait_ms / self.processed if self.processed else 0.0,
+                "max_wait_ms": self.max_wait_ms,
+            }
+
+    def stop(self, timeout: float = 10.0):
+        """Дорабатывает уже принятые обновления и останавливает потоки"""
+        deadline = time.monotonic() + timeout
+        with self._lock:
+            while self._pending and time.monotonic() < deadline:
+                self._has_room.wait(timeout=max(0.0, deadline - time.monotonic()))
+            self._stopping = True
+            self._ready.notify_all()
+            self._has_room.notify_all()
+        for thread in self._threads:
+            thread.join(timeout=max(0.0, deadline - time.monotonic()))
+        logging.info(f"✅ Диспетчер обновлений остановлен, обработано: {self.processed}")
+
+
+def chat_of_message(message) -> int:
+    return message.chat.id
+
+
+def chat_of_callback(call) -> int:
+    # У callback от inline-сообщения нет message: очередь по пользователю
+    return call.message.chat.id if call.message is not None else call.from_user.id
@@ -0,0 +1,74 @@
+"""
+Общие aiohttp-сессии для исходящих HTTP-запросов из корутин (Toncenter, Fragment, CoinGecko, APays)
+
+Сессия держит пул keep-alive соединений, поэтому повторные запросы к тому же хосту
+не открывают новое TCP/TLS-соединение. aiohttp-сессия привязана к циклу событий:
+для каждого цикла и каждого имени создается одна сессия, close_sessions() закрывает
+сессии текущего цикла. В боте все корутины идут в общем цикле Functions.AsyncLoop,
+поэтому сессии живут между покупками.
+"""
+import asyncio
+import logging
+import threading
+import weakref
+from typing import Dict
+
+import aiohttp
+
+# Имя сессии -> максимум одновременных соединений в ее пуле
+SESSION_LIMITS = {
+    "toncenter": 20,
+    "fragment": 10,
+    "coingecko": 4,
+    "apays": 10,
+}
+DEFAULT_LIMIT = 10
+DEFAULT_TIMEOUT = aiohttp.ClientTimeout(total=30, connect=10)
+
+_lock = threading.Lock()
+_sessions: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Dict[str, aiohttp.ClientSession]]" = \
+    weakref.WeakKeyDictionary()
+_created = 0
+
+
+def get_session(name: str = "default") -> aiohttp.ClientSession:
+    """Сессия с именем name для текущего цикла событий (вызывать внутри корутины)"""
+    global _created
+    loop = asyncio.get_running_loop()
+    with _lock:
+        sessions = _sessions.get(loop)
+        if sessions is None:
+            sessions = _sessions[loop] = {}
+        session = sessions.get(name)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(
+                limit=SESSION_LIMITS.get(name, DEFAULT_LIMIT),
+                ttl_dns_cache=300,
+                keepalive_timeout=60,
+            )
+            session = sessions[name] = aiohttp.ClientSession(connector=connector, timeout=DEFAULT_TIMEOUT)
+            _created += 1
+        return session
+
+
+async def close_sessions():
+    """Закрывает сессии текущего цикла событий"""
+    loop = asyncio.get_running_loop()
+    with _lock:
+        sessions = _sessions.pop(loop, {})
+    for name, session in sessions.items():
+        try:
+            await session.close()
+        except Exception as e:
+            logging.warning(f"⚠️ Ошибка закрытия HTTP-сессии {name}: {e}")
+
+
+def stats() -> Dict:
+    with _lock:
+        return {
+            "loops": len(_sessions),
+            "open_sessions": sum(
+                1 for sessions in _sessions.values() for session in sessions.values() if not session.closed
+            ),
+            "created_sessions": _created,
+        }
@@ -0,0 +1,143 @@
+"""
+Подготовка изображений бота (старт.jpeg, чек.jpeg, ава.jpeg) к отправке в Telegram
+
+Исходники весят ~3 МБ, а Telegram все равно показывает фото не больше 1280 px по длинной
+стороне. Оптимизатор уменьшает и пережимает каждое изображение один раз и кладет результат
+в каталог кэша под именем из хэша исходника, поэтому повторный запуск ничего не пересчитывает.
+
+Без Pillow бот продолжает отправлять исходные файлы.
+
+Запуск вручную: python -m Functions.ImageOptimizer старт.jpeg чек.jpeg ава.jpeg
+"""
+import hashlib
+import logging
+import os
+import sys
+import threading
+from typing import Dict, Iterable, List, Tuple
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+    ImageOps = None
+
+# Максимальная сторона фото, которую показывает Telegram
+MAX_SIDE = 1280
+JPEG_QUALITY = 85
+DEFAULT_CACHE_DIR = "media_optimized"
+
+
+def _sha256(path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+class ImageOptimizer:
+    """
+    Отдает путь к оптимизированной копии изображения. Копия создается при первом
+    обращении (или в optimize_all при запуске) и хранится как <sha256 исходника>_<сторона>_q<качество>.jpg;
+    если пережатый файл не меньше исходного, используется исходный.
+    """
+
+    def __init__(self, cache_dir: str = DEFAULT_CACHE_DIR, max_side: int = MAX_SIDE,
+                 quality: int = JPEG_QUALITY):
+        self.cache_dir = cache_dir
+        self.max_side = max_side
+        self.quality = quality
+        self._lock = threading.Lock()
+        # path -> (mtime_ns, size, путь к отправляемому файлу)
+        self._resolved: Dict[str, Tuple[int, int, str]] = {}
+        # path -> (байт исходника, байт после оптимизации)
+        self._savings: Dict[str, Tuple[int, int]] = {}
+
+    @property
+    def enabled(self) -> bool:
+        return Image is not None
+
+    def _optimized_path(self, digest: str) -> str:
+        return os.path.join(self.cache_dir, f"{digest}_{self.max_side}_q{self.quality}.jpg")
+
+    def _optimize(self, path: str, target: str):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with Image.open(path) as image:
+            image = ImageOps.exif_transpose(image)
+            if image.mode != "RGB":
+                image = image.convert("RGB")
+            image.thumbnail((self.max_side, self.max_side), Image.LANCZOS)
+            tmp_path = target + ".tmp"
+            image.save(tmp_path, "JPEG", quality=self.quality, optimize=True, progressive=True)
+        os.replace(tmp_path, target)
+
+    def resolve(self, path: str) -> str:
+        """Путь к файлу, который нужно отправлять вместо path"""
+        if not self.enabled or not os.path.exists(path):
+            return path
+
+        stat = os.stat(path)
+        with self._lock:
+            cached = self._resolved.get(path)
+            if cached and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+                return cached[2]
+
+            result = path
+            try:
+                target = self._optimized_path(_sha256(path))
+                if not os.path.exists(target):
+                    self._optimize(path, target)
+                    logging.info(f"🖼 Изображение {path} оптимизировано: {target}")
+                optimized_size = os.path.getsize(target)
+                if optimized_size < stat.st_size:
+                    result = target
+                self._savings[path] = (stat.st_size, min(optimized_size, stat.st_size))
+            except Exception as e:
+                logging.warning(f"⚠️ Не удалось оптимизировать {path}, отправляем исходник: {e}")
+
+            self._resolved[path] = (stat.st_mtime_ns, stat.st_size, result)
+            return result
+
+    def optimize_all(self, paths: Iterable[str]) -> Dict:
+        """Оптимизирует изображения заранее (при запуске) и пишет в лог экономию"""
+        if not self.enabled:
+            logging.info("⚠️ Pillow не установлен, изображения отправляются без оптимизации")
+            return self.report()
+
+        for path in paths:
+            if os.path.exists(path):
+                self.resolve(path)
+
+        report = self.report()
+        for path, source, optimized in report["images"]:
+            logging.info(f"🖼 {path}: {source / 1024:.0f} КБ -> {optimized / 1024:.0f} КБ")
+        logging.info(
+            f"✅ Изображения оптимизированы: {report['source_bytes'] / 1024:.0f} КБ -> "
+            f"{report['optimized_bytes'] / 1024:.0f} КБ (экономия {report['saved_percent']:.0f}%)"
+        )
+        return report
+
+    def report(self) -> Dict:
+        with self._lock:
+            images: List[Tuple[str, int, int]] = [
+                (path, source, optimized) for path, (source, optimized) in self._savings.items()
+            ]
+        source_bytes = sum(source for _, source, _ in images)
+        optimized_bytes = sum(optimized for _, _, optimized in images)
+        return {
+            "enabled": self.enabled,
+            "images": images,
+            "source_bytes": source_bytes,
+            "optimized_bytes": optimized_bytes,
+            "saved_bytes": source_bytes - optimized_bytes,
+            "saved_percent": (1 - optimized_bytes / source_bytes) * 100 if source_bytes else 0.0,
+        }
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format="%(message)s")
+    if Image is None:
+        print("Для оптимизации нужен Pillow: pip install Pillow")
+        sys.exit(1)
+    ImageOptimizer().optimize_all(sys.argv[1:] or ["старт.jpeg", "чек.jpeg", "ава.jpeg"])
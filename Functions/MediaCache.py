@@ -0,0 +1,169 @@
+"""
+Реестр file_id Telegram для локальных изображений (старт.jpeg, чек.jpeg, ава.jpeg)
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+from typing import Dict, Optional, Tuple
+
+from telebot.apihelper import ApiTelegramException
+from telebot.types import InputMediaPhoto
+
+# Признаки ошибки Telegram, когда сохраненный file_id больше не принимается
+FILE_ID_ERRORS = (
+    "wrong file identifier",
+    "wrong remote file identifier",
+    "file reference",
+    "file_id",
+    "wrong type of the web page content",
+    "failed to get http url content",
+)
+
+
+def is_file_id_error(error: Exception) -> bool:
+    if not isinstance(error, ApiTelegramException):
+        return False
+    description = str(error.description or error).lower()
+    return any(marker in description for marker in FILE_ID_ERRORS)
+
+
+class MediaCache:
+    """
+    Загружает каждое изображение в Telegram один раз и дальше отправляет его по file_id.
+    Ключ реестра - sha256 содержимого файла, поэтому замена картинки на диске
+    приводит к новой загрузке. Реестр сохраняется в JSON и переживает перезапуск.
+    Если передан optimizer (ImageOptimizer), отправляется его уменьшенная копия файла.
+    """
+
+    def __init__(self, bot, registry_path: str = "media_cache.json", optimizer=None):
+        self.bot = bot
+        self.optimizer = optimizer
+        self.registry_path = registry_path
+        self._lock = threading.Lock()
+        self._file_ids: Dict[str, str] = {}
+        # path -> (mtime_ns, size, sha256): файл перехешируется только после изменения
+        self._digests: Dict[str, Tuple[int, int, str]] = {}
+
+        self.uploads = 0
+        self.cached_sends = 0
+
+        if os.path.exists(registry_path):
+            try:
+                with open(registry_path, 'r', encoding='utf-8') as f:
+                    self._file_ids = json.load(f)
+                logging.info(f"✅ Реестр file_id загружен: {len(self._file_ids)} изображений")
+            except (OSError, ValueError) as e:
+                logging.warning(f"⚠️ Реестр file_id не прочитан, изображения будут загружены заново: {e}")
+
+    def _digest(self, path: str) -> str:
+        stat = os.stat(path)
+        cached = self._digests.get(path)
+        if cached and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+            return cached[2]
+        sha256 = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                sha256.update(chunk)
+        digest = sha256.hexdigest()
+        self._digests[path] = (stat.st_mtime_ns, stat.st_size, digest)
+        return digest
+
+    def _save(self):
+        tmp_path = self.registry_path + ".tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self._file_ids, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, self.registry_path)
+
+    def _resolve(self, path: str) -> str:
+        return self.optimizer.resolve(path) if self.optimizer is not None else path
+
+    def get_file_id(self, path: str) -> Optional[str]:
+        with self._lock:
+            return self._file_ids.get(self._digest(path))
+
+    def remember(self, path: str, message) -> Optional[str]:
+        """Сохраняет file_id самой большой версии фото из ответа Telegram"""
+        photos = getattr(message, "photo", None)
+        if not photos:
+            return None
+        file_id = photos[-1].file_id
+        with self._lock:
+            digest = self._digest(path)
+            if self._file_ids.get(digest) != file_id:
+                self._file_ids[digest] = file_id
+                try:
+                    self._save()
+                except OSError as e:
+                    logging.error(f"❌ Ошибка сохранения реестра file_id: {e}")
+        return file_id
+
+    def forget(self, path: str):
+        with self._lock:
+            if self._file_ids.pop(self._digest(path), None) is not None:
+                try:
+                    self._save()
+                except OSError as e:
+                    logging.error(f"❌ Ошибка сохранения реестра file_id: {e}")
+
+    def send_photo(self, chat_id, path: str, **kwargs):
+        """send_photo по file_id; файл загружается, только если file_id нет или Telegram его отклонил"""
+        path = self._resolve(path)
+        file_id = self.get_file_id(path)
+        if file_id:
+            try:
+                message = self.bot.send_photo(chat_id=chat_id, photo=file_id, **kwargs)
+                self.cached_sends += 1
+                return message
+            except ApiTelegramException as e:
+                if not is_file_id_error(e):
+                    raise
+                logging.warning(f"⚠️ Telegram отклонил file_id для {path}, загружаем заново: {e}")
+                self.forget(path)
+
+        with open(path, 'rb') as photo:
+            message = self.bot.send_photo(chat_id=chat_id, photo=photo, **kwargs)
+        self.uploads += 1
+        self.remember(path, message)
+        return message
+
+    def edit_message_media(self, chat_id, message_id, path: str, caption: str = None,
+                           parse_mode: str = None, reply_markup=None):
+        """edit_message_media по file_id с той же логикой повторной загрузки"""
+        path = self._resolve(path)
+        file_id = self.get_file_id(path)
+        if file_id:
+            try:
+                message = self.bot.edit_message_media(
+                    chat_id=chat_id,
+                    message_id=message_id,
+                    media=InputMediaPhoto(media=file_id, caption=caption, parse_mode=parse_mode),
+                    reply_markup=reply_markup
+                )
+                self.cached_sends += 1
+                return message
+            except ApiTelegramException as e:
+                if not is_file_id_error(e):
+                    raise
+                logging.warning(f"⚠️ Telegram отклонил file_id для {path}, загружаем заново: {e}")
+                self.forget(path)
+
+        with open(path, 'rb') as photo:
+            message = self.bot.edit_message_media(
+                chat_id=chat_id,
+                message_id=message_id,
+                media=InputMediaPhoto(media=photo, caption=caption, parse_mode=parse_mode),
+                reply_markup=reply_markup
+            )
+        self.uploads += 1
+        self.remember(path, message)
+        return message
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {
+                "registered": len(self._file_ids),
+                "uploads": self.uploads,
+                "cached_sends": self.cached_sends,
+            }
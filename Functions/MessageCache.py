@@ -0,0 +1,117 @@
+"""
+Состояние отправленных ботом сообщений: какое изображение, подпись и клавиатура сейчас
+показаны в каждом (chat_id, message_id). По нему send_photo_with_text выбирает самое
+дешевое редактирование вместо edit_message_media на каждое нажатие кнопки, а повторное
+нажатие той же кнопки вообще не доходит до Telegram.
+"""
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional, Tuple
+
+# Что нужно изменить в сообщении с фото
+EDIT_MEDIA = "media"
+EDIT_CAPTION = "caption"
+EDIT_MARKUP = "markup"
+EDIT_NONE = "none"
+
+
+def markup_fingerprint(reply_markup) -> Optional[str]:
+    """Строковый отпечаток клавиатуры (telebot сериализует ее в JSON)"""
+    if reply_markup is None:
+        return None
+    to_json = getattr(reply_markup, "to_json", None)
+    return to_json() if to_json is not None else repr(reply_markup)
+
+
+class MessageStateCache:
+    """
+    Ограниченный LRU (chat_id, message_id) -> (изображение, hash подписи, hash клавиатуры).
+    Хранятся только сообщения, отправленные или отредактированные через бот; для
+    неизвестного сообщения план всегда EDIT_MEDIA, то есть прежнее поведение.
+    """
+
+    def __init__(self, max_size: int = 10000):
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._states: "OrderedDict[Tuple[int, int], Tuple[Optional[str], int, int]]" = OrderedDict()
+        self._plans: Dict[str, int] = {EDIT_MEDIA: 0, EDIT_CAPTION: 0, EDIT_MARKUP: 0}
+        # hits - редактирования, пропущенные без запроса к API; misses - отправленные
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _state(media: Optional[str], text: Optional[str], reply_markup) -> Tuple[Optional[str], int, int]:
+        return media, hash(text), hash(markup_fingerprint(reply_markup))
+
+    def remember(self, chat_id, message_id, media: Optional[str] = None, text: Optional[str] = None,
+                 reply_markup=None):
+        """Запоминает, что показывает сообщение после успешной отправки или редактирования"""
+        if not message_id:
+            return
+        key = (chat_id, message_id)
+        state = self._state(media, text, reply_markup)
+        with self._lock:
+            self._states[key] = state
+            self._states.move_to_end(key)
+            while len(self._states) > self.max_size:
+                self._states.popitem(last=False)
+
+    def forget(self, chat_id, message_id):
+        """Сбрасывает состояние, когда неизвестно, чем закончилось редактирование"""
+        with self._lock:
+            self._states.pop((chat_id, message_id), None)
+
+    def media_of(self, chat_id, message_id) -> Optional[str]:
+        with self._lock:
+            state = self._states.get((chat_id, message_id))
+            return state[0] if state else None
+
+    def unchanged(self, chat_id, message_id, media: Optional[str], text: Optional[str], reply_markup) -> bool:
+        """True, если сообщение уже показывает ровно это: редактирование можно не отправлять"""
+        state = self._state(media, text, reply_markup)
+        with self._lock:
+            key = (chat_id, message_id)
+            if self._states.get(key) == state:
+                self._states.move_to_end(key)
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def plan_photo_edit(self, chat_id, message_id, media: str, text: Optional[str], reply_markup) -> str:
+        """
+        EDIT_NONE - сообщение уже показывает то же самое, запрос не нужен;
+        EDIT_MEDIA - сообщение неизвестно или показывает другое изображение;
+        EDIT_CAPTION - изображение то же, изменилась подпись;
+        EDIT_MARKUP - изменилась только клавиатура.
+        """
+        new_media, text_hash, markup_hash = self._state(media, text, reply_markup)
+        with self._lock:
+            key = (chat_id, message_id)
+            state = self._states.get(key)
+            if state is None or state[0] != new_media:
+                plan = EDIT_MEDIA
+            elif state[1] != text_hash:
+                plan = EDIT_CAPTION
+            elif state[2] != markup_hash:
+                plan = EDIT_MARKUP
+            else:
+                self._states.move_to_end(key)
+                self.hits += 1
+                return EDIT_NONE
+            self.misses += 1
+            self._plans[plan] += 1
+            return plan
+
+    def stats(self) -> Dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "tracked": len(self._states),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "media_edits": self._plans[EDIT_MEDIA],
+                "caption_edits": self._plans[EDIT_CAPTION],
+                "markup_edits": self._plans[EDIT_MARKUP],
+            }
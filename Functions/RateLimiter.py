@@ -0,0 +1,218 @@
+"""
+Ограничение исходящих запросов к Telegram Bot API
+
+Все запросы telebot проходят через apihelper.CUSTOM_REQUEST_SENDER. Отправка и
+редактирование сообщений ждут токен общего ведра (~30 сообщений/с) и ведра чата
+(~1 сообщение/с с небольшим запасом на всплеск). Ответы пользователям идут в
+приоритетной полосе, уведомления техподдержки - в фоновой: фоновым запросам
+недоступна часть общего ведра, которая всегда остается для ответов пользователям.
+
+Ответ 429 не роняет polling: retry_after запоминается для чата, из которого он
+пришел, и запрос повторяется после паузы, остальные чаты продолжают работать.
+"""
+import functools
+import logging
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+import requests
+from telebot import apihelper
+
+# Полосы приоритета
+HIGH_PRIORITY = 0
+LOW_PRIORITY = 1
+
+# Методы, на которые распространяются лимиты Telegram на сообщения
+LIMITED_METHOD_PREFIXES = ("send", "edit", "copy", "forward")
+
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity в запасе"""
+    __slots__ = ("rate", "capacity", "tokens", "updated")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def delay(self, now: float, reserve: float = 0.0) -> float:
+        """Сколько ждать до следующего токена сверх reserve (0 - токен есть)"""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        needed = 1 + reserve
+        return 0.0 if self.tokens >= needed else (needed - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1
+
+
+class TelegramRateLimiter:
+    """
+    Планировщик исходящих запросов. Поток, отправляющий сообщение, ждет своей
+    очереди сам; с ChatDispatcher это задерживает только чат, в который идет отправка.
+    """
+
+    def __init__(self, global_rate: float = 30.0, chat_rate: float = 1.0, chat_burst: float = 3.0,
+                 low_priority_reserve: float = 0.3, max_retries: int = 3, low_priority_chats=()):
+        self.global_rate = global_rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        # Доля общего ведра, которую фоновая полоса не трогает
+        self.low_priority_reserve = global_rate * low_priority_reserve
+        self.low_priority_chats = {str(chat_id) for chat_id in low_priority_chats}
+
+        self._session = requests.Session()
+        self._local = threading.local()
+        self._cond = threading.Condition()
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats: Dict[str, TokenBucket] = {}
+        # chat_id -> время, до которого Telegram просил не отправлять (retry_after)
+        self._blocked_until: Dict[str, float] = {}
+
+        # Метрики
+        self.requests = 0
+        self.throttled = 0
+        self.throttled_ms = 0.0
+        self.rate_limited = 0
+        self.retried = 0
+
+    def install(self):
+        """Направляет все запросы telebot через этот планировщик"""
+        apihelper.CUSTOM_REQUEST_SENDER = self.send
+        logging.info(
+            f"✅ Лимит запросов Telegram: {self.global_rate:.0f}/с всего, "
+            f"{self.chat_rate:.0f}/с на чат (запас {self.chat_burst:.0f})"
+        )
+
+    @contextmanager
+    def lane(self, priority: int):
+        """Запросы внутри блока идут в указанной полосе приоритета"""
+        previous = getattr(self._local, "priority", HIGH_PRIORITY)
+        self._local.priority = priority
+        try:
+            yield
+        finally:
+            self._local.priority = previous
+
+    def low_priority(self, fn):
+        """Декоратор: все запросы функции идут в фоновой полосе"""
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with self.lane(LOW_PRIORITY):
+                return fn(*args, **kwargs)
+        return wrapper
+
+    def _acquire(self, chat_id: Optional[str], priority: int):
+        started = time.monotonic()
+        waited = False
+        reserve = self.low_priority_reserve if priority == LOW_PRIORITY else 0.0
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                delay = self._global.delay(now, reserve)
+                bucket = None
+                if chat_id is not None:
+                    bucket = self._chats.get(chat_id)
+                    if bucket is None:
+                        if len(self._chats) >= 10000:
+                            self._prune_chats(now)
+                        bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+                    delay = max(delay, bucket.delay(now), self._blocked_until.get(chat_id, 0.0) - now)
+                if delay <= 0:
+                    self._global.take()
+                    if bucket is not None:
+                        bucket.take()
+                    break
+                waited = True
+                self._cond.wait(delay)
+            if waited:
+                self.throttled += 1
+                self.throttled_ms += (time.monotonic() - started) * 1000
+
+    def _prune_chats(self, now: float):
+        # Полное ведро ничем не отличается от нового: такие чаты можно забыть
+        self._chats = {
+            chat_id: bucket for chat_id, bucket in self._chats.items()
+            if bucket.tokens + (now - bucket.updated) * bucket.rate < bucket.capacity
+        }
+
+    def _block(self, chat_id: Optional[str], retry_after: float):
+        with self._cond:
+            self.rate_limited += 1
+            until = time.monotonic() + retry_after
+            if chat_id is None:
+                # Общий лимит: общее ведро пустеет на retry_after
+                self._global.tokens = -retry_after * self._global.rate
+            else:
+                self._blocked_until[chat_id] = max(self._blocked_until.get(chat_id, 0.0), until)
+                if len(self._blocked_until) > 1000:
+                    now = time.monotonic()
+                    self._blocked_until = {key: value for key, value in self._blocked_until.items() if value > now}
+
+    @staticmethod
+    def _retry_after(response) -> Optional[float]:
+        if response.status_code != 429:
+            return None
+        try:
+            return float(response.json().get("parameters", {}).get("retry_after", 1))
+        except (ValueError, AttributeError):
+            return 1.0
+
+    @staticmethod
+    def _rewind(files):
+        # Повторная загрузка файла должна начаться с начала
+        for value in (files or {}).values():
+            stream = value[1] if isinstance(value, tuple) and len(value) > 1 else value
+            if hasattr(stream, "seek"):
+                stream.seek(0)
+
+    def send(self, method, url, params=None, files=None, timeout=None, proxies=None, **kwargs):
+        """Совместим с apihelper.CUSTOM_REQUEST_SENDER"""
+        method_name = url.rsplit("/", 1)[-1]
+        limited = method_name.startswith(LIMITED_METHOD_PREFIXES)
+        chat_id = None
+        if params and params.get("chat_id") is not None:
+            chat_id = str(params["chat_id"])
+        priority = getattr(self._local, "priority", HIGH_PRIORITY)
+        if chat_id in self.low_priority_chats:
+            priority = LOW_PRIORITY
+
+        attempt = 0
+        while True:
+            if limited:
+                self._acquire(chat_id, priority)
+            self.requests += 1
+            response = self._session.request(method, url, params=params, files=files,
+                                             timeout=timeout, proxies=proxies, **kwargs)
+            retry_after = self._retry_after(response)
+            if retry_after is None or attempt >= self.max_retries:
+                return response
+
+            attempt += 1
+            self.retried += 1
+            logging.warning(
+                f"⚠️ Telegram 429 для {method_name} (чат {chat_id}): повтор через {retry_after:.0f} с"
+            )
+            if limited:
+                # Следующий _acquire дождется конца паузы только для этого чата
+                self._block(chat_id, retry_after)
+            else:
+                self.rate_limited += 1
+                time.sleep(retry_after)
+            self._rewind(files)
+
+    def stats(self) -> Dict:
+        with self._cond:
+            now = time.monotonic()
+            return {
+                "requests": self.requests,
+                "throttled": self.throttled,
+                "avg_throttle_ms": self.throttled_ms / self.throttled if self.throttled else 0.0,
+                "rate_limited": self.rate_limited,
+                "retried": self.retried,
+                "blocked_chats": sum(1 for until in self._blocked_until.values() if until > now),
+            }
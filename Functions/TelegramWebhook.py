@@ -0,0 +1,127 @@
+"""
+Прием обновлений Telegram через webhook (Flask)
+
+Telegram присылает обновления POST-запросом с заголовком X-Telegram-Bot-Api-Secret-Token.
+Сервер сверяет секрет, передает обновление в telebot (обработчики только ставят его
+в очередь ChatDispatcher) и сразу отвечает 200, не дожидаясь обработки.
+
+Для проверки без Telegram: TELEGRAM_API_URL в config.py направляет запросы бота
+на локальный фейковый Bot API, а обновления можно отправлять на WEBHOOK_PATH
+обычным POST-запросом с тем же секретом.
+
+Самопроверка маршрута (без Telegram и сети): python -m Functions.TelegramWebhook
+"""
+import hmac
+import json
+import logging
+import secrets
+import sys
+from typing import Optional
+
+from flask import Flask, abort, request
+from telebot import apihelper
+from telebot.types import Update
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def use_api_url(api_url: Optional[str]):
+    """Переключает telebot на другой Bot API (локальный сервер или фейк для проверки)"""
+    if not api_url:
+        return
+    apihelper.API_URL = api_url.rstrip("/") + "/bot{0}/{1}"
+    apihelper.FILE_URL = api_url.rstrip("/") + "/file/bot{0}/{1}"
+    logging.info(f"✅ Bot API: {api_url}")
+
+
+def generate_secret() -> str:
+    # Telegram допускает в секрете только A-Z, a-z, 0-9, _ и -
+    return secrets.token_urlsafe(32)
+
+
+def create_webhook_app(bot, secret_token: str, path: str = "/telegram/webhook") -> Flask:
+    """Flask-приложение с одним маршрутом для обновлений Telegram"""
+    app = Flask(__name__)
+    app.config["WEBHOOK_STATS"] = {"received": 0, "rejected": 0, "invalid": 0}
+    stats = app.config["WEBHOOK_STATS"]
+    expected = secret_token.encode()
+
+    @app.route(path, methods=["POST"])
+    def telegram_webhook():
+        received = request.headers.get(SECRET_HEADER, "").encode()
+        if not hmac.compare_digest(received, expected):
+            stats["rejected"] += 1
+            logging.warning(f"⚠️ Webhook: неверный секрет от {request.remote_addr}")
+            abort(403)
+
+        try:
+            update = Update.de_json(json.loads(request.get_data(as_text=True)))
+        except (ValueError, TypeError, KeyError) as e:
+            stats["invalid"] += 1
+            logging.error(f"❌ Webhook: некорректное обновление: {e}")
+            # 200, чтобы Telegram не присылал то же обновление повторно
+            return "", 200
+
+        stats["received"] += 1
+        # Обработчики ставят обновление в очередь диспетчера и сразу возвращаются
+        bot.process_new_updates([update])
+        return "", 200
+
+    return app
+
+
+def run_webhook(bot, url: str, secret_token: str, host: str = "0.0.0.0", port: int = 8443,
+                path: str = "/telegram/webhook", allowed_updates=None):
+    """Регистрирует webhook в Telegram и запускает сервер (блокирует поток)"""
+    app = create_webhook_app(bot, secret_token, path)
+    webhook_url = url.rstrip("/") + path
+    bot.remove_webhook()
+    if not bot.set_webhook(url=webhook_url, secret_token=secret_token, allowed_updates=allowed_updates):
+        raise RuntimeError(f"Telegram не принял webhook {webhook_url}")
+    logging.info(f"✅ Webhook установлен: {webhook_url}, слушаем {host}:{port}")
+    app.run(host=host, port=port, threaded=True)
+
+
+def self_check() -> bool:
+    """Отправляет обновление с верным и неверным секретом в приложение webhook и проверяет ответы"""
+    class RecordingBot:
+        def __init__(self):
+            self.updates = []
+
+        def process_new_updates(self, updates):
+            self.updates.extend(updates)
+
+    bot = RecordingBot()
+    secret = generate_secret()
+    path = "/telegram/webhook"
+    client = create_webhook_app(bot, secret, path).test_client()
+    update = {
+        "update_id": 1,
+        "message": {
+            "message_id": 1,
+            "date": 0,
+            "chat": {"id": 1, "type": "private"},
+            "from": {"id": 1, "is_bot": False, "first_name": "Test"},
+            "text": "/start"
+        }
+    }
+
+    checks = []
+    response = client.post(path, json=update, headers={SECRET_HEADER: secret})
+    checks.append(("верный секрет: 200", response.status_code == 200))
+    checks.append(("верный секрет: обновление передано боту",
+                   len(bot.updates) == 1 and bot.updates[0].message.text == "/start"))
+
+    response = client.post(path, json=update, headers={SECRET_HEADER: secret + "x"})
+    checks.append(("неверный секрет: 403", response.status_code == 403))
+    response = client.post(path, json=update)
+    checks.append(("без секрета: 403", response.status_code == 403))
+    checks.append(("неверный секрет: обновление не передано", len(bot.updates) == 1))
+
+    for name, ok in checks:
+        print(f"{'✅' if ok else '❌'} {name}")
+    return all(ok for _, ok in checks)
+
+
+if __name__ == "__main__":
+    sys.exit(0 if self_check() else 1)
@@ -40,6 +40,31 @@ WALLET_MAX_PROTOCOL_VERSION = 2
 # PAYMENT_METHODS = { ... }  # Не используется в коде
 
 
+# Хранилище пользователей: "sqlite" (по умолчанию), "json" (один файл users_data.json) или "memory" (для тестов)
+STORAGE_BACKEND = "sqlite"
+STORAGE_PATH = None  # None - путь по умолчанию: users_data.db или users_data.json
+# Бинарный снимок для быстрого старта JSON-хранилища (пишется при остановке, None - выключено)
+STORAGE_SNAPSHOT_PATH = None  # например "users_data.snap"
+USER_CACHE_SIZE = 50000  # Пользователей в памяти (вытесняются давно не использованные)
+
+# Обработка обновлений: разные чаты параллельно, внутри чата - по порядку
+UPDATE_WORKERS = 8  # Потоков обработчиков
+UPDATE_QUEUE_LIMIT = 1000  # Необработанных обновлений, после которых polling ждет
+
+# Лимиты исходящих сообщений Telegram
+TELEGRAM_GLOBAL_RATE = 30.0  # Сообщений в секунду на всего бота
+TELEGRAM_CHAT_RATE = 1.0  # Сообщений в секунду в один чат
+
+# Прием обновлений: "polling" или "webhook" (при ошибке webhook бот переходит на polling)
+BOT_MODE = "polling"
+WEBHOOK_URL = None  # Публичный HTTPS-адрес сервера, например "https://your-domain.com"
+WEBHOOK_SECRET = None  # Секрет заголовка X-Telegram-Bot-Api-Secret-Token (None - случайный при запуске)
+WEBHOOK_HOST = "0.0.0.0"
+WEBHOOK_PORT = 8443
+WEBHOOK_PATH = "/telegram/webhook"
+# Свой Bot API (локальный сервер или фейк для проверки), None - https://api.telegram.org
+TELEGRAM_API_URL = None  # например "http://127.0.0.1:8081"
+
 # Настройки логирования
 LOG_LEVEL = "INFO"
 LOG_FILE = "bot.log"
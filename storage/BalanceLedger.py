@@ -0,0 +1,174 @@
+"""
+Журнал изменений баланса (append-only) со снимками для быстрого старта
+
+Журнал считается источником истины для балансов: reconcile() при запуске сравнивает
+его с хранилищем пользователей и перезаписывает в хранилище балансы, которые с ним расходятся.
+"""
+import json
+import logging
+import os
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+# Типы событий баланса
+TOPUP = "topup"
+PURCHASE = "purchase"
+REFUND = "refund"
+
+
+class BalanceLedger:
+    """
+    Каждое изменение баланса дописывается в журнал одной строкой с fsync.
+    Фоновый компактор сворачивает журнал в снимок, а старый сегмент журнала
+    сохраняется в архив для аудита (хранятся последние keep_archives архивов).
+    При старте читается снимок и хвост журнала.
+    """
+
+    def __init__(self, log_path: str = "balance_ledger.log", snapshot_path: str = "balance_snapshot.json",
+                 compact_interval: float = 300.0, compact_threshold: int = 10000, keep_archives: int = 10):
+        self.log_path = log_path
+        self.snapshot_path = snapshot_path
+        self.compact_interval = compact_interval
+        self.compact_threshold = compact_threshold
+        self.keep_archives = keep_archives
+
+        self._lock = threading.RLock()
+        self.balances: Dict[str, float] = {}
+        self.last_seq = 0
+        self.snapshot_seq = 0
+
+        self._replay()
+        self._log = open(self.log_path, 'a', encoding='utf-8')
+
+        self._stop_event = threading.Event()
+        self._compactor = threading.Thread(target=self._compact_loop, name="balance-ledger-compact", daemon=True)
+        self._compactor.start()
+
+    def _replay(self):
+        """Восстанавливает балансы: снимок + события журнала после него"""
+        if os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path, 'r', encoding='utf-8') as f:
+                snapshot = json.load(f)
+            self.balances = snapshot.get("balances", {})
+            self.snapshot_seq = self.last_seq = snapshot.get("seq", 0)
+
+        replayed = 0
+        if os.path.exists(self.log_path):
+            with open(self.log_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        event = json.loads(line)
+                    except ValueError:
+                        # Недописанная строка после аварийной остановки
+                        logging.warning(f"⚠️ Пропущена поврежденная строка журнала баланса: {line!r}")
+                        continue
+                    if event["seq"] <= self.snapshot_seq:
+                        continue
+                    self.balances[event["user_id"]] = event["balance"]
+                    self.last_seq = event["seq"]
+                    replayed += 1
+
+        logging.info(f"✅ Журнал баланса загружен: {len(self.balances)} пользователей, "
+                     f"событий после снимка: {replayed}")
+
+    def append(self, user_id: str, kind: str, amount: float, balance: float, **details) -> int:
+        """Записывает событие баланса и возвращает его номер"""
+        with self._lock:
+            self.last_seq += 1
+            event = {
+                "seq": self.last_seq,
+                "ts": time.time(),
+                "user_id": user_id,
+                "kind": kind,
+                "amount": amount,
+                "balance": balance,
+            }
+            if details:
+                event["details"] = details
+            self._log.write(json.dumps(event, ensure_ascii=False) + "\n")
+            self._log.flush()
+            os.fsync(self._log.fileno())
+            self.balances[user_id] = balance
+            return self.last_seq
+
+    def get_balance(self, user_id: str) -> Optional[float]:
+        with self._lock:
+            return self.balances.get(user_id)
+
+    def compact(self):
+        """Сворачивает журнал в снимок и переносит старый сегмент в архив"""
+        with self._lock:
+            if self.last_seq == self.snapshot_seq:
+                return
+
+            tmp_path = self.snapshot_path + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({"seq": self.last_seq, "balances": self.balances}, f, ensure_ascii=False)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.snapshot_path)
+
+            self._log.close()
+            os.replace(self.log_path, f"{self.log_path}.{self.last_seq}")
+            self._log = open(self.log_path, 'a', encoding='utf-8')
+
+            logging.info(f"✅ Журнал баланса свернут в снимок (событий: {self.last_seq - self.snapshot_seq})")
+            self.snapshot_seq = self.last_seq
+            self._prune_archives()
+
+    def _archives(self) -> List[Tuple[int, str]]:
+        """Архивы сегментов журнала (<log_path>.<seq>) по возрастанию seq"""
+        directory = os.path.dirname(os.path.abspath(self.log_path))
+        prefix = os.path.basename(self.log_path) + "."
+        archives = []
+        for name in os.listdir(directory):
+            if name.startswith(prefix) and name[len(prefix):].isdigit():
+                archives.append((int(name[len(prefix):]), os.path.join(directory, name)))
+        archives.sort()
+        return archives
+
+    def _prune_archives(self):
+        """Удаляет архивы сверх keep_archives; все они уже покрыты записанным снимком"""
+        for seq, path in self._archives()[:-self.keep_archives or None]:
+            try:
+                os.remove(path)
+            except OSError as e:
+                logging.warning(f"⚠️ Не удалось удалить архив журнала баланса {path}: {e}")
+
+    def _compact_loop(self):
+        last_compact = time.monotonic()
+        while not self._stop_event.wait(min(self.compact_interval, 5.0)):
+            pending = self.last_seq - self.snapshot_seq
+            if pending >= self.compact_threshold or (
+                    pending and time.monotonic() - last_compact >= self.compact_interval):
+                try:
+                    self.compact()
+                except Exception as e:
+                    logging.error(f"❌ Ошибка свертки журнала баланса: {e}")
+                last_compact = time.monotonic()
+
+    def reconcile(self, store) -> int:
+        """
+        Исправляет балансы в хранилище, если оно отстало от журнала (например, после сбоя).
+        Журнал главнее: расходящийся баланс в хранилище перезаписывается значением из журнала.
+        """
+        fixed = 0
+        with self._lock:
+            balances = dict(self.balances)
+        for user_id, balance in balances.items():
+            user_data = store.get_user(user_id)
+            if user_data is None or abs(user_data.get("balance", 0) - balance) < 1e-9:
+                continue
+            logging.warning(f"⚠️ Баланс {user_id} восстановлен из журнала: "
+                            f"{user_data.get('balance', 0):.2f} → {balance:.2f} ₽")
+            user_data["balance"] = balance
+            store.put_user(user_id, user_data)
+            fixed += 1
+        return fixed
+
+    def close(self):
+        self._stop_event.set()
+        self._compactor.join(timeout=6)
+        with self._lock:
+            self._log.close()
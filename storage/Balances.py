@@ -0,0 +1,121 @@
+"""
+Атомарные операции с балансом: пополнение и резервирование средств под покупку
+"""
+import itertools
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+from storage.BalanceLedger import PURCHASE
+
+
+class BalanceManager:
+    """
+    Все изменения баланса выполняются под блокировкой конкретного пользователя.
+    Покупка идет в три шага: reserve (холд на сумму до обращения к Fragment),
+    затем commit (списание) или release (снятие холда).
+    """
+
+    def __init__(self, store, ledger):
+        self.store = store
+        self.ledger = ledger
+
+        self._locks_guard = threading.Lock()
+        self._locks: Dict[str, threading.RLock] = {}
+
+        # Холды живут только в памяти: после перезапуска они снимаются сами,
+        # так как списание до commit не происходит
+        self._holds: Dict[int, Dict] = {}
+        self._held_by_user: Dict[str, float] = {}
+        self._hold_ids = itertools.count(1)
+
+    def _user_lock(self, user_id: str) -> threading.RLock:
+        with self._locks_guard:
+            lock = self._locks.get(user_id)
+            if lock is None:
+                lock = self._locks[user_id] = threading.RLock()
+            return lock
+
+    @contextmanager
+    def locked(self, user_id: str):
+        """Блокировка пользователя для любых чтение-изменение-запись его записи"""
+        with self._user_lock(user_id):
+            yield
+
+    def available_balance(self, user_id: str) -> float:
+        """Баланс за вычетом действующих холдов"""
+        with self.locked(user_id):
+            user_data = self.store.get_user(user_id) or {}
+            return user_data.get("balance", 0) - self._held_by_user.get(user_id, 0)
+
+    def credit(self, user_id: str, amount: float, kind: str, **details) -> Dict:
+        """
+        Пополняет баланс и возвращает обновленную запись пользователя.
+        Запись не создается: для неизвестного пользователя (не прошел /start) - KeyError.
+        """
+        with self.locked(user_id):
+            user_data = self.store.get_user(user_id)
+            if user_data is None:
+                logging.error(f"❌ Пополнение {amount:.2f} ₽ для неизвестного пользователя {user_id} не выполнено")
+                raise KeyError(f"Пользователь {user_id} не найден")
+            user_data["balance"] = user_data.get("balance", 0) + amount
+            self.ledger.append(user_id, kind, amount, user_data["balance"], **details)
+            self.store.put_user(user_id, user_data)
+            return user_data
+
+    def reserve(self, user_id: str, amount: float) -> Optional[int]:
+        """Ставит холд на сумму; None, если свободных средств недостаточно"""
+        with self.locked(user_id):
+            if self.available_balance(user_id) < amount:
+                return None
+            hold_id = next(self._hold_ids)
+            self._holds[hold_id] = {"user_id": user_id, "amount": amount}
+            self._held_by_user[user_id] = self._held_by_user.get(user_id, 0) + amount
+            logging.info(f"🔒 Холд #{hold_id}: {amount:.2f} ₽ для пользователя {user_id}")
+            return hold_id
+
+    def _drop_hold(self, hold_id: int) -> Optional[Dict]:
+        hold = self._holds.pop(hold_id, None)
+        if hold is None:
+            return None
+        user_id = hold["user_id"]
+        remaining = self._held_by_user.get(user_id, 0) - hold["amount"]
+        if remaining > 1e-9:
+            self._held_by_user[user_id] = remaining
+        else:
+            self._held_by_user.pop(user_id, None)
+        return hold
+
+    def commit(self, hold_id: int, purchase: Dict) -> Optional[Dict]:
+        """Списывает зарезервированную сумму и записывает покупку"""
+        hold = self._holds.get(hold_id)
+        if hold is None:
+            logging.error(f"❌ Холд #{hold_id} не найден при списании")
+            return None
+
+        user_id = hold["user_id"]
+        amount = hold["amount"]
+        with self.locked(user_id):
+            if self._drop_hold(hold_id) is None:
+                return None
+            user_data = self.store.get_user(user_id) or {}
+            user_data["balance"] = user_data.get("balance", 0) - amount
+            user_data["stars_bought"] = user_data.get("stars_bought", 0) + purchase.get("stars", 0)
+            user_data["total_spent"] = user_data.get("total_spent", 0) + amount
+            self.ledger.append(user_id, PURCHASE, -amount, user_data["balance"],
+                               stars=purchase.get("stars"), recipient=purchase.get("recipient"))
+            self.store.put_user(user_id, user_data)
+            self.store.append_purchase(user_id, dict(purchase, cost=amount))
+            self.store.increment_stats(total_stars=purchase.get("stars", 0), total_rub=amount)
+            logging.info(f"✅ Холд #{hold_id} списан: {amount:.2f} ₽")
+            return self.store.get_user(user_id)
+
+    def release(self, hold_id: int):
+        """Снимает холд без списания (ошибка покупки); повторный вызов безопасен"""
+        hold = self._holds.get(hold_id)
+        if hold is None:
+            return
+        with self.locked(hold["user_id"]):
+            if self._drop_hold(hold_id) is not None:
+                logging.info(f"🔓 Холд #{hold_id} снят: {hold['amount']:.2f} ₽")
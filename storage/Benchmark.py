@@ -0,0 +1,191 @@
+"""
+Замер задержек операций хранилищ пользователей на синтетических данных
+
+Запуск: python -m storage.Benchmark --users 1000 100000 1000000 --backends memory sqlite json
+Память словарей против UserRecord: python -m storage.Benchmark --memory --users 1000000
+"""
+import argparse
+import json
+import logging
+import os
+import random
+import shutil
+import statistics
+import tempfile
+import time
+import tracemalloc
+from typing import Callable, Dict, List
+
+from storage.Records import Purchase, Referral, UserRecord
+from storage.Storage import DEFAULT_PATHS, create_store
+
+
+def _synthetic_user(index: int) -> Dict:
+    user_id = str(100000000 + index)
+    purchases = [
+        {"id": seq, "date": "01.01.2025 12:00", "stars": 50 + seq, "cost": (50 + seq) * 1.35,
+         "recipient": f"@user{index}", "status": "Выполнено"}
+        for seq in range(1, index % 5 + 1)
+    ]
+    return {
+        "username": f"user{index}",
+        "balance": float(index % 1000),
+        "stars_bought": sum(purchase["stars"] for purchase in purchases),
+        "subscriptions_bought": 0,
+        "total_spent": sum(purchase["cost"] for purchase in purchases),
+        "referral_code": f"ref_{user_id}",
+        "referred_by": None,
+        "referral_discount": 0.0,
+        "referral_earnings": 0.0,
+        "referral_withdrawn": 0.0,
+        "schema_version": 2,
+        "purchases": purchases,
+        "referrals": [
+            {"user_id": str(200000000 + index * 2 + n), "username": f"ref{index}_{n}",
+             "registration_date": "01.01.2025 12:00", "total_spent": 0.0, "stars_bought": 0}
+            for n in range(index % 3)
+        ],
+    }
+
+
+def _write_synthetic_json(path: str, users: int):
+    """Пишет users_data.json потоково, не держа все записи в памяти"""
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write("{")
+        for index in range(users):
+            if index:
+                f.write(",")
+            f.write(f'"{100000000 + index}": ')
+            json.dump(_synthetic_user(index), f, ensure_ascii=False)
+        f.write("}")
+
+
+def _measure(operation: Callable[[], None], ops: int, budget: float) -> Dict:
+    """Выполняет операцию до ops раз или пока не истечет бюджет времени"""
+    samples: List[float] = []
+    deadline = time.perf_counter() + budget
+    while len(samples) < ops and time.perf_counter() < deadline:
+        started = time.perf_counter()
+        operation()
+        samples.append((time.perf_counter() - started) * 1000)
+    samples.sort()
+    return {
+        "ops": len(samples),
+        "mean_ms": statistics.fmean(samples) if samples else 0.0,
+        "p50_ms": samples[len(samples) // 2] if samples else 0.0,
+        "p99_ms": samples[min(len(samples) - 1, int(len(samples) * 0.99))] if samples else 0.0,
+    }
+
+
+def _traced_bytes(build) -> int:
+    """Память, занятая построенными записями (tracemalloc)"""
+    tracemalloc.start()
+    users = build()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del users
+    return current
+
+
+def measure_memory(users: int):
+    """Сравнивает память словарей и записей (storage.Records) на синтетических пользователях"""
+    def build_dicts():
+        return {str(100000000 + index): _synthetic_user(index) for index in range(users)}
+
+    def build_records():
+        records = {}
+        for index in range(users):
+            data = _synthetic_user(index)
+            user_id = str(100000000 + index)
+            records[user_id] = (
+                UserRecord.from_dict(user_id, data),
+                [Purchase.from_dict(purchase) for purchase in data["purchases"]],
+                [Referral.from_dict(referral) for referral in data["referrals"]],
+            )
+        return records
+
+    dict_bytes = _traced_bytes(build_dicts)
+    record_bytes = _traced_bytes(build_records)
+    print(f"Пользователей: {users}")
+    print(f"dict       {dict_bytes / 2 ** 20:9.1f} МБ ({dict_bytes / users:6.0f} байт на пользователя)")
+    print(f"UserRecord {record_bytes / 2 ** 20:9.1f} МБ ({record_bytes / users:6.0f} байт на пользователя)")
+    print(f"Экономия: {(1 - record_bytes / dict_bytes) * 100:.0f}%")
+
+
+def run_backend(backend: str, users: int, source_json: str, workdir: str, ops: int, budget: float) -> Dict:
+    path = os.path.join(workdir, f"bench_{backend}_{users}")
+    if backend == "json":
+        # JSON-хранилище открывает готовый файл как есть
+        shutil.copyfile(source_json, path)
+
+    started = time.perf_counter()
+    store = create_store(backend, path if DEFAULT_PATHS[backend] else None)
+    if backend != "json":
+        store.import_json(source_json)
+    load_seconds = time.perf_counter() - started
+
+    rng = random.Random(users)
+    random_id = lambda: str(100000000 + rng.randrange(users))
+    new_ids = iter(range(users, users * 2 + ops * 10))
+    purchase = {"date": "01.01.2025 12:00", "stars": 100, "cost": 135.0, "recipient": "@bench", "status": "Выполнено"}
+
+    def put_user():
+        user_id = random_id()
+        user_data = store.get_user(user_id)
+        user_data["balance"] += 1
+        store.put_user(user_id, user_data)
+
+    users_iter = iter(store.iterate_users())
+
+    def iterate_users():
+        # Стоимость одного шага перебора
+        next(users_iter)
+
+    results = {
+        "load_s": load_seconds,
+        "get_user": _measure(lambda: store.get_user(random_id()), ops, budget),
+        "get_user_missing": _measure(lambda: store.get_user(str(next(new_ids))), ops, budget),
+        "put_user": _measure(put_user, ops, budget),
+        "append_purchase": _measure(lambda: store.append_purchase(random_id(), purchase), ops, budget),
+        "get_purchases_page": _measure(lambda: store.get_purchases_page(random_id(), 0, 10), ops, budget),
+        "iterate_users": _measure(iterate_users, min(ops, users), budget),
+        "get_stats": _measure(store.get_stats, ops, budget),
+    }
+    store.close()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк хранилищ пользователей")
+    parser.add_argument("--users", type=int, nargs="+", default=[1000, 100000, 1000000])
+    parser.add_argument("--backends", nargs="+", default=list(DEFAULT_PATHS), choices=list(DEFAULT_PATHS))
+    parser.add_argument("--ops", type=int, default=1000, help="операций каждого вида")
+    parser.add_argument("--budget", type=float, default=10.0, help="секунд на один вид операций")
+    parser.add_argument("--memory", action="store_true", help="только замер памяти словарей и UserRecord")
+    args = parser.parse_args()
+
+    if args.memory:
+        for users in args.users:
+            measure_memory(users)
+        return
+
+    logging.basicConfig(level=logging.WARNING)
+    workdir = tempfile.mkdtemp(prefix="storage_bench_")
+    try:
+        for users in args.users:
+            source_json = os.path.join(workdir, f"users_{users}.json")
+            _write_synthetic_json(source_json, users)
+            for backend in args.backends:
+                results = run_backend(backend, users, source_json, workdir, args.ops, args.budget)
+                print(f"\n📊 {backend}, пользователей: {users}, загрузка: {results.pop('load_s'):.2f} с")
+                print(f"{'операция':<20}{'ops':>8}{'mean, мс':>12}{'p50, мс':>12}{'p99, мс':>12}")
+                for name, result in results.items():
+                    print(f"{name:<20}{result['ops']:>8}{result['mean_ms']:>12.4f}"
+                          f"{result['p50_ms']:>12.4f}{result['p99_ms']:>12.4f}")
+            os.remove(source_json)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
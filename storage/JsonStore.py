@@ -0,0 +1,96 @@
+"""
+Хранилище пользователей в одном JSON-файле (прежний формат users_data.json)
+"""
+import json
+import logging
+import os
+from typing import Dict, Iterable, Optional, Tuple
+
+from storage.MemoryStore import MemoryUserStore
+from storage.Snapshot import snapshot_is_fresh
+
+
+class JsonUserStore(MemoryUserStore):
+    """
+    Данные держатся в памяти, а файл целиком перезаписывается после каждого изменения
+    (через временный файл, чтобы не получить обрезанный JSON при сбое).
+    Подходит для небольшого числа пользователей и для сравнения с другими хранилищами.
+
+    Если задан snapshot_path, при остановке пишется бинарный снимок, и следующий
+    запуск читает его вместо JSON, пока JSON не станет свежее снимка.
+    """
+
+    def __init__(self, path: str = "users_data.json", snapshot_path: Optional[str] = None):
+        super().__init__()
+        self.path = path
+        self.snapshot_path = snapshot_path
+        loaded = False
+        if snapshot_is_fresh(path, snapshot_path):
+            try:
+                self.load_snapshot(snapshot_path)
+                loaded = True
+                logging.info(f"✅ Пользователи загружены из снимка {snapshot_path}")
+            except (OSError, ValueError, EOFError, TypeError) as e:
+                logging.warning(f"⚠️ Снимок {snapshot_path} не прочитан, загружаем JSON: {e}")
+                self._users.clear()
+                self._purchases.clear()
+                self._referrals.clear()
+        if not loaded and os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                self.load_users(json.load(f))
+        logging.info(f"✅ JSON хранилище пользователей открыто: {path} ({self.count_users()} пользователей)")
+
+    def _save(self):
+        with self._lock:
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(self.dump_users(), f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, self.path)
+
+    def put_user(self, user_id: str, user_data: Dict):
+        with self._lock:
+            super().put_user(user_id, user_data)
+            self._save()
+
+    def put_users(self, items: Iterable[Tuple[str, Dict]]):
+        with self._lock:
+            super().put_users(items)
+            self._save()
+
+    def append_purchase(self, user_id: str, purchase: Dict) -> int:
+        with self._lock:
+            seq = super().append_purchase(user_id, purchase)
+            self._save()
+            return seq
+
+    def add_referral(self, referrer_id: str, referral: Dict) -> bool:
+        with self._lock:
+            added = super().add_referral(referrer_id, referral)
+            if added:
+                self._save()
+            return added
+
+    def update_referral(self, referrer_id: str, referred_id: str, total_spent: float, stars_bought: int):
+        with self._lock:
+            super().update_referral(referrer_id, referred_id, total_spent, stars_bought)
+            self._save()
+
+    def import_json(self, json_path: str = "users_data.json") -> int:
+        with self._lock:
+            count = super().import_json(json_path)
+            self._save()
+            return count
+
+    def import_json_once(self, json_path: str = "users_data.json") -> int:
+        # Собственный файл уже загружен в __init__
+        if os.path.abspath(json_path) == os.path.abspath(self.path):
+            return 0
+        return super().import_json_once(json_path)
+
+    def close(self):
+        if self.snapshot_path:
+            try:
+                self.dump_snapshot(self.snapshot_path)
+                logging.info(f"✅ Снимок пользователей записан: {self.snapshot_path}")
+            except OSError as e:
+                logging.error(f"❌ Ошибка записи снимка пользователей: {e}")
@@ -0,0 +1,222 @@
+"""
+Хранилище пользователей в памяти процесса (для тестов и как основа JSON-хранилища)
+"""
+import json
+import logging
+import os
+import threading
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from storage.Records import Purchase, Referral, UserRecord
+from storage.Snapshot import dumps_rows, gc_paused, loads_rows, pack_user, read_snapshot_bytes, write_snapshot_bytes
+from storage.SqliteStore import USER_FIELDS, PURCHASE_FIELDS, REFERRAL_FIELDS, STAT_KEYS
+
+
+class MemoryUserStore:
+    """Та же модель данных, что и у SqliteUserStore, но без диска; записи хранятся в __slots__-объектах"""
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._users: Dict[str, UserRecord] = {}
+        self._purchases: Dict[str, List[Purchase]] = {}
+        # referrer_id -> {user_id: реферал}, порядок добавления сохраняется
+        self._referrals: Dict[str, Dict[str, Referral]] = {}
+        self._stats = {key: 0 for key in STAT_KEYS}
+
+    @staticmethod
+    def _to_record(user_id: str, user_data: Dict) -> UserRecord:
+        return UserRecord.from_dict(user_id, user_data)
+
+    @staticmethod
+    def _to_purchase(seq: int, purchase: Dict) -> Purchase:
+        return Purchase(seq, *(purchase.get(name) for name in PURCHASE_FIELDS))
+
+    @staticmethod
+    def _user_dict(record: UserRecord) -> Dict:
+        # Формат хранилища, как у SqliteUserStore: NULL-поля не возвращаются
+        return {name: getattr(record, name) for name in USER_FIELDS if getattr(record, name) is not None}
+
+    def get_user(self, user_id: str) -> Optional[Dict]:
+        """Возвращает данные пользователя или None"""
+        with self._lock:
+            record = self._users.get(user_id)
+            if record is None:
+                return None
+            return self._user_dict(record)
+
+    def put_user(self, user_id: str, user_data: Dict):
+        """Сохраняет скалярные поля пользователя (покупки и рефералы пишутся отдельно)"""
+        with self._lock:
+            self._users[user_id] = self._to_record(user_id, user_data)
+
+    def put_users(self, items: Iterable[Tuple[str, Dict]]):
+        with self._lock:
+            for user_id, user_data in items:
+                self._users[user_id] = self._to_record(user_id, user_data)
+
+    def append_purchase(self, user_id: str, purchase: Dict) -> int:
+        """Добавляет покупку и возвращает её порядковый номер"""
+        with self._lock:
+            purchases = self._purchases.setdefault(user_id, [])
+            seq = len(purchases) + 1
+            purchases.append(self._to_purchase(seq, purchase))
+            return seq
+
+    def get_purchases_page(self, user_id: str, page: int = 0, page_size: int = 10) -> List[Dict]:
+        """Одна страница истории покупок, новые сверху"""
+        with self._lock:
+            purchases = self._purchases.get(user_id, [])
+            end = len(purchases) - page * page_size
+            if end <= 0:
+                return []
+            start = max(0, end - page_size)
+            return [purchase.to_dict() for purchase in reversed(purchases[start:end])]
+
+    def count_purchases(self, user_id: str) -> int:
+        with self._lock:
+            return len(self._purchases.get(user_id, []))
+
+    def iterate_purchases(self, user_id: str) -> Iterator[Dict]:
+        with self._lock:
+            purchases = [purchase.to_dict() for purchase in self._purchases.get(user_id, [])]
+        return iter(purchases)
+
+    def add_referral(self, referrer_id: str, referral: Dict) -> bool:
+        """Добавляет реферала; False, если он уже привязан к этому рефереру"""
+        with self._lock:
+            referrals = self._referrals.setdefault(referrer_id, {})
+            if referral["user_id"] in referrals:
+                return False
+            referrals[referral["user_id"]] = Referral(
+                referral["user_id"], *(referral.get(name) for name in REFERRAL_FIELDS)
+            )
+            return True
+
+    def update_referral(self, referrer_id: str, referred_id: str, total_spent: float, stars_bought: int):
+        """Обновляет статистику одного реферала"""
+        with self._lock:
+            referral = self._referrals.get(referrer_id, {}).get(referred_id)
+            if referral is not None:
+                referral.total_spent = total_spent
+                referral.stars_bought = stars_bought
+
+    def iterate_referrals(self) -> Iterator[Tuple[str, Dict]]:
+        """Все пары (реферер, реферал) в порядке добавления (для построения индекса)"""
+        with self._lock:
+            pairs = [
+                (referrer_id, referral.to_dict())
+                for referrer_id, referrals in self._referrals.items() for referral in referrals.values()
+            ]
+        return iter(pairs)
+
+    def iterate_users(self, below_version: Optional[int] = None) -> Iterator[Tuple[str, Dict]]:
+        """Перебирает всех пользователей; below_version - только устаревшие записи"""
+        with self._lock:
+            user_ids = [
+                user_id for user_id, record in self._users.items()
+                if below_version is None or record.schema_version < below_version
+            ]
+        for user_id in user_ids:
+            user_data = self.get_user(user_id)
+            if user_data is not None:
+                yield user_id, user_data
+
+    def get_stats(self) -> Dict:
+        with self._lock:
+            return dict(self._stats)
+
+    def increment_stats(self, **deltas):
+        with self._lock:
+            for key, value in deltas.items():
+                if key in STAT_KEYS:
+                    self._stats[key] += value
+
+    def rebuild_stats(self) -> Dict:
+        """Пересчитывает счетчики по всем пользователям"""
+        with self._lock:
+            self._stats = {
+                "total_stars": sum(record.stars_bought for record in self._users.values()),
+                "total_rub": sum(record.total_spent for record in self._users.values()),
+                "user_count": len(self._users),
+            }
+            return dict(self._stats)
+
+    def count_users(self) -> int:
+        with self._lock:
+            return len(self._users)
+
+    def load_users(self, users_data: Dict):
+        """Загружает пользователей в формате старого users_data.json (покупки и рефералы внутри записи)"""
+        with self._lock, gc_paused():
+            for user_id, user_data in users_data.items():
+                self._users[user_id] = self._to_record(user_id, user_data)
+                self._purchases[user_id] = [
+                    self._to_purchase(seq, purchase)
+                    for seq, purchase in enumerate(user_data.get("purchases", []), 1)
+                ]
+                self._referrals[user_id] = {}
+                for referral in user_data.get("referrals", []):
+                    if referral["user_id"] not in self._referrals[user_id]:
+                        self._referrals[user_id][referral["user_id"]] = Referral(
+                            referral["user_id"], *(referral.get(name) for name in REFERRAL_FIELDS)
+                        )
+            self.rebuild_stats()
+
+    def dump_users(self) -> Dict:
+        """Все пользователи в формате старого users_data.json"""
+        with self._lock:
+            users_data = {}
+            for user_id, record in self._users.items():
+                user_data = self._user_dict(record)
+                user_data["purchases"] = [purchase.to_dict() for purchase in self._purchases.get(user_id, [])]
+                user_data["referrals"] = [referral.to_dict() for referral in self._referrals.get(user_id, {}).values()]
+                users_data[user_id] = user_data
+            return users_data
+
+    def load_snapshot(self, snapshot_path: str) -> int:
+        """Загружает пользователей из бинарного снимка напрямую во внутренние структуры"""
+        (user_fields, purchase_fields, referral_fields), rows = loads_rows(read_snapshot_bytes(snapshot_path))
+        # Порядок полей снимка совпадает с записями - создаем их позиционно, без промежуточных словарей
+        purchases_positional = tuple(purchase_fields) == Purchase.__slots__
+        referrals_positional = tuple(referral_fields) == Referral.__slots__
+        with self._lock, gc_paused():
+            for user_id, values, purchases, referrals, _ in rows:
+                self._users[user_id] = self._to_record(user_id, dict(zip(user_fields, values)))
+                self._purchases[user_id] = [
+                    Purchase(*purchase) if purchases_positional
+                    else Purchase.from_dict(dict(zip(purchase_fields, purchase)))
+                    for purchase in purchases
+                ]
+                self._referrals[user_id] = {
+                    referral[0]: Referral(*referral) if referrals_positional
+                    else Referral.from_dict(dict(zip(referral_fields, referral)))
+                    for referral in referrals
+                }
+            self.rebuild_stats()
+        return len(rows)
+
+    def dump_snapshot(self, snapshot_path: str):
+        """Записывает всех пользователей в бинарный снимок"""
+        with self._lock:
+            data = dumps_rows(
+                pack_user(user_id, self._user_dict(record), self._purchases.get(user_id, []),
+                          self._referrals.get(user_id, {}).values())
+                for user_id, record in self._users.items()
+            )
+        write_snapshot_bytes(data, snapshot_path)
+
+    def import_json(self, json_path: str = "users_data.json") -> int:
+        """Импорт пользователей из старого users_data.json"""
+        with open(json_path, 'r', encoding='utf-8') as f:
+            users_data = json.load(f)
+        self.load_users(users_data)
+        logging.info(f"✅ Импортировано пользователей из {json_path}: {len(users_data)}")
+        return len(users_data)
+
+    def import_json_once(self, json_path: str = "users_data.json") -> int:
+        if self.count_users() > 0 or not os.path.exists(json_path):
+            return 0
+        return self.import_json(json_path)
+
+    def close(self):
+        pass
@@ -0,0 +1,70 @@
+"""
+Версионированные миграции записей пользователей
+"""
+import logging
+from typing import Dict, Tuple
+
+# Текущая версия структуры записи пользователя
+SCHEMA_VERSION = 2
+
+
+def _add_missing_fields(user_data: Dict, user_id: str):
+    """v1: недостающие поля статистики и реферальной системы"""
+    user_data.setdefault("stars_bought", 0)
+    user_data.setdefault("subscriptions_bought", 0)
+    user_data.setdefault("total_spent", 0.0)
+
+    # Реферальная система
+    user_data.setdefault("referral_earnings", 0.0)
+    user_data.setdefault("referral_withdrawn", 0.0)
+    user_data.setdefault("referral_code", f"ref_{user_id}")
+    user_data.setdefault("referred_by", None)
+    user_data.setdefault("referral_discount", 0.0)  # Скидка в рублях за звезду
+
+
+def _recount_purchase_totals(user_data: Dict, user_id: str):
+    """v2: один раз пересчитываем total_spent и stars_bought по истории покупок,
+    дальше они поддерживаются инкрементально при списании"""
+    purchases = user_data.get("purchases", [])
+    if purchases:
+        user_data["total_spent"] = sum(purchase.get("cost", 0) for purchase in purchases)
+        user_data["stars_bought"] = sum(purchase.get("stars", 0) for purchase in purchases)
+
+
+# (версия, функция): функция переводит запись с версии-1 на указанную версию
+MIGRATIONS = [
+    (1, _add_missing_fields),
+    (2, _recount_purchase_totals),
+]
+
+
+def migrate_user(user_data: Dict, user_id: str) -> Tuple[Dict, bool]:
+    """Применяет недостающие миграции к словарю или UserRecord; для актуальной записи - O(1)"""
+    version = user_data.get("schema_version") or 0
+    if version >= SCHEMA_VERSION:
+        return user_data, False
+
+    for target_version, migration in MIGRATIONS:
+        if version < target_version:
+            migration(user_data, user_id)
+    user_data["schema_version"] = SCHEMA_VERSION
+    return user_data, True
+
+
+def migrate_all(store) -> int:
+    """Однократно обновляет все устаревшие записи в хранилище (при запуске)"""
+    migrated = 0
+    for user_id, user_data in store.iterate_users(below_version=SCHEMA_VERSION):
+        # История покупок нужна только миграции пересчета, в записи она не хранится
+        if (user_data.get("schema_version") or 0) < 2:
+            user_data["purchases"] = list(store.iterate_purchases(user_id))
+        user_data, _ = migrate_user(user_data, user_id)
+        user_data.pop("purchases", None)
+        store.put_user(user_id, user_data)
+        migrated += 1
+
+    if migrated:
+        logging.info(f"✅ Миграция пользователей до версии {SCHEMA_VERSION}: обновлено {migrated}")
+        # Пересчет v2 меняет stars_bought/total_spent: общая статистика строится заново
+        store.rebuild_stats()
+    return migrated
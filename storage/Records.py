@@ -0,0 +1,209 @@
+"""
+Компактные записи пользователя, покупки и реферала (__slots__ вместо словарей)
+
+Замер памяти против словарей: python -m storage.Benchmark --memory --users 1000000
+"""
+import inspect
+from typing import Dict, Optional, Tuple
+
+
+_required_cache: Dict[type, Tuple[str, ...]] = {}
+
+
+def _required_fields(cls) -> Tuple[str, ...]:
+    """Обязательные поля записи (параметры __init__ без значения по умолчанию)"""
+    required = _required_cache.get(cls)
+    if required is None:
+        required = _required_cache[cls] = tuple(
+            name for name, parameter in list(inspect.signature(cls.__init__).parameters.items())[1:]
+            if parameter.default is inspect.Parameter.empty
+        )
+    return required
+
+
+class SlottedRecord:
+    """
+    Общая часть записей: доступ по атрибутам, а для кода хранилищ и миграций,
+    который работает со словарями, - также record["поле"], get, setdefault, keys.
+    """
+    __slots__ = ()
+
+    def keys(self):
+        return self.__slots__
+
+    def items(self):
+        return [(name, getattr(self, name)) for name in self.__slots__]
+
+    def __contains__(self, name) -> bool:
+        return name in self.__slots__
+
+    def __getitem__(self, name):
+        if name not in self.__slots__:
+            raise KeyError(name)
+        return getattr(self, name)
+
+    def __setitem__(self, name, value):
+        if name not in self.__slots__:
+            raise KeyError(name)
+        setattr(self, name, value)
+
+    def get(self, name, default=None):
+        return getattr(self, name) if name in self.__slots__ else default
+
+    def setdefault(self, name, default=None):
+        """Как у словаря: поле без значения (None) получает default"""
+        if name not in self.__slots__:
+            raise KeyError(name)
+        value = getattr(self, name)
+        if value is None:
+            setattr(self, name, default)
+            value = default
+        return value
+
+    def pop(self, name, *default):
+        """
+        Поле записи удалить нельзя, поэтому оно сбрасывается к значению по умолчанию из __init__,
+        а прежнее значение возвращается. Поля вне записи (например, старый список purchases)
+        отсутствуют: возвращается default, без него - KeyError.
+        """
+        if name not in self.__slots__:
+            if default:
+                return default[0]
+            raise KeyError(name)
+        required = _required_fields(type(self))
+        if name in required:
+            raise TypeError(f"Поле {name} обязательно для {type(self).__name__} и не может быть удалено")
+        empty = type(self)(*(getattr(self, field) for field in required))
+        value = getattr(self, name)
+        setattr(self, name, getattr(empty, name))
+        return value
+
+    def to_dict(self) -> Dict:
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __eq__(self, other) -> bool:
+        return type(self) is type(other) and self.items() == other.items()
+
+    def __repr__(self) -> str:
+        fields = ", ".join(f"{name}={getattr(self, name)!r}" for name in self.__slots__)
+        return f"{type(self).__name__}({fields})"
+
+
+class Purchase(SlottedRecord):
+    __slots__ = ("id", "date", "stars", "cost", "recipient", "status")
+
+    id: int
+    date: Optional[str]
+    stars: int
+    cost: float
+    recipient: Optional[str]
+    status: Optional[str]
+
+    def __init__(self, id: int, date: Optional[str] = None, stars: int = 0, cost: float = 0.0,
+                 recipient: Optional[str] = None, status: Optional[str] = None):
+        self.id = id
+        self.date = date
+        self.stars = stars
+        self.cost = cost
+        self.recipient = recipient
+        self.status = status
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "Purchase":
+        return cls(data.get("id") or 0, data.get("date"), data.get("stars") or 0, data.get("cost") or 0.0,
+                   data.get("recipient"), data.get("status"))
+
+
+class Referral(SlottedRecord):
+    __slots__ = ("user_id", "username", "registration_date", "total_spent", "stars_bought")
+
+    user_id: str
+    username: Optional[str]
+    registration_date: Optional[str]
+    total_spent: float
+    stars_bought: int
+
+    def __init__(self, user_id: str, username: Optional[str] = None, registration_date: Optional[str] = None,
+                 total_spent: float = 0.0, stars_bought: int = 0):
+        self.user_id = user_id
+        self.username = username
+        self.registration_date = registration_date
+        self.total_spent = total_spent
+        self.stars_bought = stars_bought
+
+    @classmethod
+    def from_dict(cls, data: Dict) -> "Referral":
+        return cls(data["user_id"], data.get("username"), data.get("registration_date"),
+                   data.get("total_spent") or 0.0, data.get("stars_bought") or 0)
+
+    def copy(self) -> "Referral":
+        return Referral(self.user_id, self.username, self.registration_date, self.total_spent, self.stars_bought)
+
+
+class UserRecord(SlottedRecord):
+    """Запись пользователя; покупки и рефералы хранятся отдельно (журнал покупок, реферальный индекс)"""
+    __slots__ = ("user_id", "username", "balance", "stars_bought", "subscriptions_bought", "total_spent",
+                 "referral_code", "referred_by", "referral_discount", "referral_earnings",
+                 "referral_withdrawn", "schema_version")
+
+    user_id: str
+    username: Optional[str]
+    balance: float
+    stars_bought: int
+    subscriptions_bought: int
+    total_spent: float
+    referral_code: str
+    referred_by: Optional[str]
+    referral_discount: float
+    referral_earnings: float
+    referral_withdrawn: float
+    schema_version: int
+
+    def __init__(self, user_id: str, username: Optional[str] = None, balance: float = 0.0,
+                 stars_bought: int = 0, subscriptions_bought: int = 0, total_spent: float = 0.0,
+                 referral_code: Optional[str] = None, referred_by: Optional[str] = None,
+                 referral_discount: float = 0.0, referral_earnings: float = 0.0,
+                 referral_withdrawn: float = 0.0, schema_version: int = 0):
+        self.user_id = user_id
+        self.username = username
+        self.balance = balance
+        self.stars_bought = stars_bought
+        self.subscriptions_bought = subscriptions_bought
+        self.total_spent = total_spent
+        self.referral_code = referral_code or f"ref_{user_id}"
+        self.referred_by = referred_by
+        self.referral_discount = referral_discount
+        self.referral_earnings = referral_earnings
+        self.referral_withdrawn = referral_withdrawn
+        self.schema_version = schema_version
+
+    @classmethod
+    def from_dict(cls, user_id: str, data: Dict) -> "UserRecord":
+        """Запись из словаря хранилища; отсутствующие и NULL-поля получают значения по умолчанию"""
+        return cls(
+            user_id,
+            username=data.get("username"),
+            balance=data.get("balance") or 0.0,
+            stars_bought=data.get("stars_bought") or 0,
+            subscriptions_bought=data.get("subscriptions_bought") or 0,
+            total_spent=data.get("total_spent") or 0.0,
+            referral_code=data.get("referral_code"),
+            referred_by=data.get("referred_by"),
+            referral_discount=data.get("referral_discount") or 0.0,
+            referral_earnings=data.get("referral_earnings") or 0.0,
+            referral_withdrawn=data.get("referral_withdrawn") or 0.0,
+            schema_version=data.get("schema_version") or 0,
+        )
+
+    @classmethod
+    def coerce(cls, user_id: str, data) -> "UserRecord":
+        """Копия записи или новая запись из словаря"""
+        if isinstance(data, UserRecord):
+            return data.copy()
+        return cls.from_dict(user_id, data)
+
+    def copy(self) -> "UserRecord":
+        record = UserRecord.__new__(UserRecord)
+        for name in self.__slots__:
+            setattr(record, name, getattr(self, name))
+        return record
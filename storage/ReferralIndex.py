@@ -0,0 +1,113 @@
+"""
+Индекс реферального графа с готовыми счетчиками по каждому рефереру
+"""
+import logging
+import threading
+from typing import Dict, List, Optional
+
+from storage.Records import Referral, SlottedRecord
+
+# Реферал считается квалифицированным после стольких рублей расходов
+QUALIFIED_REFERRAL_SPENT = 500.0
+
+
+class ReferralSummary(SlottedRecord):
+    """Сводка реферера: всего приглашенных, квалифицированных, оборот и звезды рефералов"""
+    __slots__ = ("count", "qualified", "turnover", "stars")
+
+    count: int
+    qualified: int
+    turnover: float
+    stars: int
+
+    def __init__(self, count: int = 0, qualified: int = 0, turnover: float = 0.0, stars: int = 0):
+        self.count = count
+        self.qualified = qualified
+        self.turnover = turnover
+        self.stars = stars
+
+    def copy(self) -> "ReferralSummary":
+        return ReferralSummary(self.count, self.qualified, self.turnover, self.stars)
+
+
+class ReferralIndex:
+    """
+    Держит в памяти список рефералов каждого реферера, обратную связь
+    реферал -> реферер и сводку по рефереру. Строится один раз при запуске,
+    дальше обновляется на каждом событии (новый реферал, расход реферала),
+    поэтому реферальные экраны не пересчитывают списки.
+    Изменения сразу пишутся в хранилище (write-through).
+    """
+
+    def __init__(self, store):
+        self.store = store
+        self._lock = threading.RLock()
+        self._referrals: Dict[str, Dict[str, Referral]] = {}
+        self._referrer_of: Dict[str, str] = {}
+        self._summaries: Dict[str, ReferralSummary] = {}
+
+        count = 0
+        for referrer_id, referral in store.iterate_referrals():
+            self._index(referrer_id, Referral.from_dict(referral))
+            count += 1
+        logging.info(f"✅ Реферальный индекс построен: {count} рефералов, {len(self._summaries)} рефереров")
+
+    def _index(self, referrer_id: str, referral: Referral):
+        referrals = self._referrals.setdefault(referrer_id, {})
+        if referral.user_id in referrals:
+            return
+        referrals[referral.user_id] = referral
+        self._referrer_of.setdefault(referral.user_id, referrer_id)
+
+        summary = self._summaries.setdefault(referrer_id, ReferralSummary())
+        summary.count += 1
+        summary.turnover += referral.total_spent
+        summary.stars += referral.stars_bought
+        if referral.total_spent >= QUALIFIED_REFERRAL_SPENT:
+            summary.qualified += 1
+
+    def add_referral(self, referrer_id: str, referral: Dict) -> bool:
+        """Добавляет реферала; False, если он уже привязан к этому рефереру"""
+        with self._lock:
+            if not self.store.add_referral(referrer_id, referral):
+                return False
+            self._index(referrer_id, Referral.from_dict(referral))
+            return True
+
+    def record_spend(self, referred_id: str, total_spent: float, stars_bought: int) -> Optional[str]:
+        """
+        Обновляет расходы реферала и сводку его реферера за O(1).
+        Возвращает id реферера или None, если пользователь никем не приглашен.
+        """
+        with self._lock:
+            referrer_id = self._referrer_of.get(referred_id)
+            if referrer_id is None:
+                return None
+            referral = self._referrals[referrer_id][referred_id]
+            summary = self._summaries[referrer_id]
+
+            was_qualified = referral.total_spent >= QUALIFIED_REFERRAL_SPENT
+            summary.turnover += total_spent - referral.total_spent
+            summary.stars += stars_bought - referral.stars_bought
+            referral.total_spent = total_spent
+            referral.stars_bought = stars_bought
+            is_qualified = total_spent >= QUALIFIED_REFERRAL_SPENT
+            if is_qualified != was_qualified:
+                summary.qualified += 1 if is_qualified else -1
+
+            self.store.update_referral(referrer_id, referred_id, total_spent, stars_bought)
+            return referrer_id
+
+    def referrer_of(self, referred_id: str) -> Optional[str]:
+        with self._lock:
+            return self._referrer_of.get(referred_id)
+
+    def summary(self, referrer_id: str) -> ReferralSummary:
+        with self._lock:
+            summary = self._summaries.get(referrer_id)
+            return summary.copy() if summary is not None else ReferralSummary()
+
+    def referrals_of(self, referrer_id: str) -> List[Referral]:
+        """Рефералы в порядке приглашения (копии)"""
+        with self._lock:
+            return [referral.copy() for referral in self._referrals.get(referrer_id, {}).values()]
@@ -0,0 +1,216 @@
+"""
+Компактный бинарный снимок таблицы пользователей для быстрого холодного старта
+
+Записи хранятся кортежами в порядке полей (без повторения ключей в каждой записи)
+и сериализуются через marshal; повторяющиеся строки (username, получатель, статус)
+интернируются, поэтому в файле и в памяти они хранятся один раз.
+
+Конвертация:
+    python -m storage.Snapshot to-snapshot users_data.json users_data.snap
+    python -m storage.Snapshot to-json users_data.snap users_data.json
+    python -m storage.Snapshot bench users_data.json users_data.snap
+"""
+import gc
+import json
+import logging
+import marshal
+import os
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from storage.SqliteStore import USER_FIELDS, PURCHASE_FIELDS, REFERRAL_FIELDS
+
+SNAPSHOT_MAGIC = b"TGUSNAP1"
+SNAPSHOT_VERSION = 1
+
+_USER_FIELDS = tuple(USER_FIELDS)
+_PURCHASE_FIELDS = ("id",) + PURCHASE_FIELDS
+_REFERRAL_FIELDS = ("user_id",) + REFERRAL_FIELDS
+# Строковые поля с большим числом повторов
+_INTERNED_USER = {"username", "referred_by"}
+_INTERNED_PURCHASE = {"date", "recipient", "status"}
+_INTERNED_REFERRAL = {"username", "registration_date"}
+
+
+def _intern(value):
+    return sys.intern(value) if isinstance(value, str) else value
+
+
+def _pack(record: Dict, fields: tuple, interned: set) -> tuple:
+    return tuple(
+        _intern(record.get(name)) if name in interned else record.get(name)
+        for name in fields
+    )
+
+
+@contextmanager
+def gc_paused():
+    """
+    Отключает сборщик мусора на время массового создания записей:
+    иначе он многократно обходит миллионы только что созданных словарей
+    """
+    gc_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if gc_enabled:
+            gc.enable()
+
+
+def pack_user(user_id: str, user_data: Dict, purchases: Iterable[Dict], referrals: Iterable[Dict]) -> tuple:
+    """Одна запись снимка: (user_id, поля, покупки, рефералы, прочие поля)"""
+    extra = {key: value for key, value in user_data.items()
+             if key not in USER_FIELDS and key not in ("purchases", "referrals")}
+    return (
+        user_id,
+        _pack(user_data, _USER_FIELDS, _INTERNED_USER),
+        tuple(_pack(purchase, _PURCHASE_FIELDS, _INTERNED_PURCHASE) for purchase in purchases),
+        tuple(_pack(referral, _REFERRAL_FIELDS, _INTERNED_REFERRAL) for referral in referrals),
+        extra or None,
+    )
+
+
+def dumps_rows(rows: Iterable[tuple]) -> bytes:
+    header = (SNAPSHOT_VERSION, _USER_FIELDS, _PURCHASE_FIELDS, _REFERRAL_FIELDS)
+    return SNAPSHOT_MAGIC + marshal.dumps((header, list(rows)))
+
+
+def loads_rows(data: bytes) -> Tuple[Tuple[tuple, tuple, tuple], List[tuple]]:
+    """Возвращает ((поля пользователя, поля покупки, поля реферала), записи)"""
+    if not data.startswith(SNAPSHOT_MAGIC):
+        raise ValueError("Файл не является снимком пользователей")
+    (version, user_fields, purchase_fields, referral_fields), rows = marshal.loads(data[len(SNAPSHOT_MAGIC):])
+    if version != SNAPSHOT_VERSION:
+        raise ValueError(f"Неподдерживаемая версия снимка: {version}")
+    return (user_fields, purchase_fields, referral_fields), rows
+
+
+def dumps_users(users_data: Dict) -> bytes:
+    """Сериализует пользователей в формате users_data.json в бинарный снимок"""
+    return dumps_rows(
+        pack_user(user_id, user_data, user_data.get("purchases", []), user_data.get("referrals", []))
+        for user_id, user_data in users_data.items()
+    )
+
+
+def loads_users(data: bytes) -> Dict:
+    """Восстанавливает пользователей в формате users_data.json из бинарного снимка"""
+    (user_fields, purchase_fields, referral_fields), rows = loads_rows(data)
+    # Строки уже разделяются внутри marshal (интернированы при записи), повторно не интернируем
+    users_data = {}
+    with gc_paused():
+        for user_id, values, purchases, referrals, extra in rows:
+            # None не восстанавливаем: отсутствующие поля заполнит миграция
+            user_data = {name: value for name, value in zip(user_fields, values) if value is not None}
+            if extra:
+                user_data.update(extra)
+            user_data["purchases"] = [dict(zip(purchase_fields, purchase)) for purchase in purchases]
+            user_data["referrals"] = [dict(zip(referral_fields, referral)) for referral in referrals]
+            users_data[user_id] = user_data
+    return users_data
+
+
+def write_snapshot_bytes(data: bytes, snapshot_path: str):
+    """Атомарно записывает снимок (через временный файл)"""
+    tmp_path = snapshot_path + ".tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, snapshot_path)
+
+
+def read_snapshot_bytes(snapshot_path: str) -> bytes:
+    with open(snapshot_path, 'rb') as f:
+        return f.read()
+
+
+def snapshot_is_fresh(json_path: str, snapshot_path: Optional[str]) -> bool:
+    """Снимок есть и не старше JSON (после аварийной остановки свежее будет JSON)"""
+    if not snapshot_path or not os.path.exists(snapshot_path):
+        return False
+    return not os.path.exists(json_path) or os.path.getmtime(snapshot_path) >= os.path.getmtime(json_path)
+
+
+def write_snapshot(users_data: Dict, snapshot_path: str):
+    write_snapshot_bytes(dumps_users(users_data), snapshot_path)
+
+
+def read_snapshot(snapshot_path: str) -> Dict:
+    return loads_users(read_snapshot_bytes(snapshot_path))
+
+
+def json_to_snapshot(json_path: str, snapshot_path: str) -> int:
+    with open(json_path, 'r', encoding='utf-8') as f:
+        users_data = json.load(f)
+    write_snapshot(users_data, snapshot_path)
+    return len(users_data)
+
+
+def snapshot_to_json(snapshot_path: str, json_path: str) -> int:
+    users_data = read_snapshot(snapshot_path)
+    tmp_path = json_path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(users_data, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, json_path)
+    return len(users_data)
+
+
+def _measure_load(loader) -> tuple:
+    """Время загрузки и память (tracemalloc замедляет выделения, поэтому отдельным прогоном)"""
+    started = time.perf_counter()
+    users_data = loader()
+    elapsed = time.perf_counter() - started
+    del users_data
+
+    tracemalloc.start()
+    users_data = loader()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del users_data
+    return elapsed, current, peak
+
+
+def bench(json_path: str, snapshot_path: str):
+    """Сравнивает холодный старт хранилища из JSON и из снимка"""
+    from storage.MemoryStore import MemoryUserStore
+
+    def load_json():
+        store = MemoryUserStore()
+        with open(json_path, 'r', encoding='utf-8') as f:
+            store.load_users(json.load(f))
+        return store
+
+    def load_snapshot():
+        store = MemoryUserStore()
+        store.load_snapshot(snapshot_path)
+        return store
+
+    results = {
+        "json": _measure_load(load_json),
+        "snapshot": _measure_load(load_snapshot),
+    }
+    for name, path in (("json", json_path), ("snapshot", snapshot_path)):
+        elapsed, current, peak = results[name]
+        print(f"{name:<10} файл {os.path.getsize(path) / 2 ** 20:8.1f} МБ | загрузка {elapsed:7.2f} с | "
+              f"память {current / 2 ** 20:8.1f} МБ (пик {peak / 2 ** 20:8.1f} МБ)")
+    json_time, snapshot_time = results["json"][0], results["snapshot"][0]
+    json_peak, snapshot_peak = results["json"][2], results["snapshot"][2]
+    print(f"Ускорение загрузки: x{json_time / snapshot_time:.1f}, пик памяти меньше в {json_peak / snapshot_peak:.1f} раза")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    commands = {"to-snapshot": json_to_snapshot, "to-json": snapshot_to_json}
+    if len(sys.argv) != 4 or sys.argv[1] not in list(commands) + ["bench"]:
+        print(__doc__)
+        sys.exit(1)
+    if sys.argv[1] == "bench":
+        bench(sys.argv[2], sys.argv[3])
+    else:
+        count = commands[sys.argv[1]](sys.argv[2], sys.argv[3])
+        print(f"✅ Сконвертировано пользователей: {count}")
@@ -0,0 +1,327 @@
+"""
+Хранилище пользователей на SQLite (одна строка на пользователя)
+"""
+import json
+import logging
+import os
+import sqlite3
+import sys
+import threading
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+# Скалярные поля пользователя и значения по умолчанию
+USER_FIELDS = {
+    "username": None,
+    "balance": 0.0,
+    "stars_bought": 0,
+    "subscriptions_bought": 0,
+    "total_spent": 0.0,
+    "referral_code": None,
+    "referred_by": None,
+    "referral_discount": 0.0,
+    "referral_earnings": 0.0,
+    "referral_withdrawn": 0.0,
+    "schema_version": 0,
+}
+
+PURCHASE_FIELDS = ("date", "stars", "cost", "recipient", "status")
+REFERRAL_FIELDS = ("username", "registration_date", "total_spent", "stars_bought")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id TEXT PRIMARY KEY,
+    username TEXT,
+    balance REAL DEFAULT 0,
+    stars_bought INTEGER DEFAULT 0,
+    subscriptions_bought INTEGER DEFAULT 0,
+    total_spent REAL DEFAULT 0,
+    referral_code TEXT,
+    referred_by TEXT,
+    referral_discount REAL DEFAULT 0,
+    referral_earnings REAL DEFAULT 0,
+    referral_withdrawn REAL DEFAULT 0,
+    schema_version INTEGER DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS purchases (
+    user_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    date TEXT,
+    stars INTEGER,
+    cost REAL,
+    recipient TEXT,
+    status TEXT,
+    PRIMARY KEY (user_id, seq)
+);
+CREATE TABLE IF NOT EXISTS referrals (
+    referrer_id TEXT NOT NULL,
+    user_id TEXT NOT NULL,
+    username TEXT,
+    registration_date TEXT,
+    total_spent REAL DEFAULT 0,
+    stars_bought INTEGER DEFAULT 0,
+    PRIMARY KEY (referrer_id, user_id)
+);
+CREATE TABLE IF NOT EXISTS stats (
+    key TEXT PRIMARY KEY,
+    value REAL NOT NULL DEFAULT 0
+);
+"""
+
+# Глобальные счетчики, которые поддерживаются инкрементально
+STAT_KEYS = ("total_stars", "total_rub", "user_count")
+
+
+class SqliteUserStore:
+    """Точечное чтение и запись пользователей вместо перезаписи всего users_data.json"""
+
+    def __init__(self, path: str = "users_data.db"):
+        self.path = path
+        # Одно соединение на процесс, доступ сериализуется блокировкой
+        self._lock = threading.RLock()
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.executescript(SCHEMA)
+        self._add_missing_columns()
+        if self._conn.execute("SELECT COUNT(*) FROM stats").fetchone()[0] == 0:
+            self.rebuild_stats()
+        logging.info(f"✅ SQLite хранилище пользователей открыто: {path}")
+
+    def _add_missing_columns(self):
+        """Добавляет колонки, появившиеся после создания базы"""
+        existing = {row["name"] for row in self._conn.execute("PRAGMA table_info(users)")}
+        if "schema_version" not in existing:
+            self._conn.execute("ALTER TABLE users ADD COLUMN schema_version INTEGER DEFAULT 0")
+
+    def _row_to_user(self, row: sqlite3.Row) -> Dict:
+        # NULL-поля пропускаем, чтобы update_user_structure заполнил их значениями по умолчанию
+        # Покупки и рефералы в запись не загружаются: история покупок читается постранично,
+        # рефералы - через реферальный индекс
+        return {name: row[name] for name in USER_FIELDS if row[name] is not None}
+
+    def get_user(self, user_id: str) -> Optional[Dict]:
+        """Возвращает данные пользователя или None"""
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM users WHERE user_id = ?", (user_id,)).fetchone()
+            if row is None:
+                return None
+            return self._row_to_user(row)
+
+    def put_user(self, user_id: str, user_data: Dict):
+        """Сохраняет скалярные поля пользователя (покупки и рефералы пишутся отдельно)"""
+        values = [user_data.get(name, default) for name, default in USER_FIELDS.items()]
+        columns = ", ".join(USER_FIELDS)
+        placeholders = ", ".join("?" for _ in USER_FIELDS)
+        updates = ", ".join(f"{name} = excluded.{name}" for name in USER_FIELDS)
+        with self._lock:
+            self._conn.execute(
+                f"INSERT INTO users (user_id, {columns}) VALUES (?, {placeholders}) "
+                f"ON CONFLICT(user_id) DO UPDATE SET {updates}",
+                [user_id] + values
+            )
+
+    def put_users(self, items: Iterable[Tuple[str, Dict]]):
+        """Сохраняет пачку пользователей одной транзакцией"""
+        columns = ", ".join(USER_FIELDS)
+        placeholders = ", ".join("?" for _ in USER_FIELDS)
+        updates = ", ".join(f"{name} = excluded.{name}" for name in USER_FIELDS)
+        rows = [
+            [user_id] + [user_data.get(name, default) for name, default in USER_FIELDS.items()]
+            for user_id, user_data in items
+        ]
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                self._conn.executemany(
+                    f"INSERT INTO users (user_id, {columns}) VALUES (?, {placeholders}) "
+                    f"ON CONFLICT(user_id) DO UPDATE SET {updates}",
+                    rows
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+    def append_purchase(self, user_id: str, purchase: Dict) -> int:
+        """Добавляет покупку и возвращает её порядковый номер"""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                seq = self._conn.execute(
+                    "SELECT COALESCE(MAX(seq), 0) + 1 FROM purchases WHERE user_id = ?", (user_id,)
+                ).fetchone()[0]
+                self._conn.execute(
+                    "INSERT INTO purchases (user_id, seq, date, stars, cost, recipient, status) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    [user_id, seq] + [purchase.get(name) for name in PURCHASE_FIELDS]
+                )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+        return seq
+
+    @staticmethod
+    def _row_to_purchase(row: sqlite3.Row) -> Dict:
+        return dict({"id": row["seq"]}, **{name: row[name] for name in PURCHASE_FIELDS})
+
+    def get_purchases_page(self, user_id: str, page: int = 0, page_size: int = 10) -> List[Dict]:
+        """Одна страница истории покупок, новые сверху (читается только эта страница по индексу)"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT * FROM purchases WHERE user_id = ? ORDER BY seq DESC LIMIT ? OFFSET ?",
+                (user_id, page_size, page * page_size)
+            ).fetchall()
+        return [self._row_to_purchase(row) for row in rows]
+
+    def count_purchases(self, user_id: str) -> int:
+        with self._lock:
+            return self._conn.execute(
+                "SELECT COUNT(*) FROM purchases WHERE user_id = ?", (user_id,)
+            ).fetchone()[0]
+
+    def iterate_purchases(self, user_id: str) -> Iterator[Dict]:
+        """Все покупки пользователя по порядку (для служебных задач)"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT * FROM purchases WHERE user_id = ? ORDER BY seq", (user_id,)
+            ).fetchall()
+        for row in rows:
+            yield self._row_to_purchase(row)
+
+    def add_referral(self, referrer_id: str, referral: Dict) -> bool:
+        """Добавляет реферала; False, если он уже привязан к этому рефереру"""
+        with self._lock:
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO referrals (referrer_id, user_id, username, registration_date, "
+                "total_spent, stars_bought) VALUES (?, ?, ?, ?, ?, ?)",
+                [referrer_id, referral["user_id"]] + [referral.get(name) for name in REFERRAL_FIELDS]
+            )
+            return cursor.rowcount > 0
+
+    def update_referral(self, referrer_id: str, referred_id: str, total_spent: float, stars_bought: int):
+        """Обновляет статистику одного реферала"""
+        with self._lock:
+            self._conn.execute(
+                "UPDATE referrals SET total_spent = ?, stars_bought = ? WHERE referrer_id = ? AND user_id = ?",
+                (total_spent, stars_bought, referrer_id, referred_id)
+            )
+
+    def iterate_referrals(self) -> Iterator[Tuple[str, Dict]]:
+        """Все пары (реферер, реферал) в порядке добавления (для построения индекса)"""
+        with self._lock:
+            rows = self._conn.execute("SELECT * FROM referrals ORDER BY rowid").fetchall()
+        for row in rows:
+            yield row["referrer_id"], dict({"user_id": row["user_id"]}, **{name: row[name] for name in REFERRAL_FIELDS})
+
+    def iterate_users(self, below_version: Optional[int] = None) -> Iterator[Tuple[str, Dict]]:
+        """Перебирает всех пользователей (для служебных задач, не для обработчиков);
+        below_version - только записи со schema_version ниже указанной"""
+        with self._lock:
+            if below_version is None:
+                rows = self._conn.execute("SELECT user_id FROM users")
+            else:
+                rows = self._conn.execute(
+                    "SELECT user_id FROM users WHERE COALESCE(schema_version, 0) < ?", (below_version,)
+                )
+            user_ids = [row[0] for row in rows]
+        for user_id in user_ids:
+            user_data = self.get_user(user_id)
+            if user_data is not None:
+                yield user_id, user_data
+
+    def get_stats(self) -> Dict:
+        """Глобальные счетчики (звезды, рубли, пользователи) за O(1)"""
+        with self._lock:
+            rows = self._conn.execute("SELECT key, value FROM stats").fetchall()
+        stats = {key: 0 for key in STAT_KEYS}
+        stats.update({row["key"]: row["value"] for row in rows})
+        stats["total_stars"] = int(stats["total_stars"])
+        stats["user_count"] = int(stats["user_count"])
+        return stats
+
+    def increment_stats(self, **deltas):
+        """Увеличивает счетчики, например increment_stats(total_stars=50, total_rub=67.5)"""
+        with self._lock:
+            self._conn.executemany(
+                "INSERT INTO stats (key, value) VALUES (?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = value + excluded.value",
+                [(key, value) for key, value in deltas.items() if key in STAT_KEYS]
+            )
+
+    def rebuild_stats(self) -> Dict:
+        """Пересчитывает счетчики по всем пользователям"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT COALESCE(SUM(stars_bought), 0), COALESCE(SUM(total_spent), 0), COUNT(*) FROM users"
+            ).fetchone()
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO stats (key, value) VALUES (?, ?)",
+                zip(STAT_KEYS, row)
+            )
+        logging.info(f"✅ Счетчики пересчитаны: звезд {row[0]}, рублей {row[1]:.2f}, пользователей {row[2]}")
+        return self.get_stats()
+
+    def count_users(self) -> int:
+        with self._lock:
+            return self._conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+
+    def import_json(self, json_path: str = "users_data.json") -> int:
+        """Одноразовый импорт пользователей из старого users_data.json"""
+        with open(json_path, 'r', encoding='utf-8') as f:
+            users_data = json.load(f)
+
+        columns = ", ".join(USER_FIELDS)
+        placeholders = ", ".join("?" for _ in USER_FIELDS)
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                for user_id, user_data in users_data.items():
+                    self._conn.execute(
+                        f"INSERT OR REPLACE INTO users (user_id, {columns}) VALUES (?, {placeholders})",
+                        [user_id] + [user_data.get(name, default) for name, default in USER_FIELDS.items()]
+                    )
+                    self._conn.execute("DELETE FROM purchases WHERE user_id = ?", (user_id,))
+                    for seq, purchase in enumerate(user_data.get("purchases", []), 1):
+                        self._conn.execute(
+                            "INSERT INTO purchases (user_id, seq, date, stars, cost, recipient, status) "
+                            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                            [user_id, seq] + [purchase.get(name) for name in PURCHASE_FIELDS]
+                        )
+                    self._conn.execute("DELETE FROM referrals WHERE referrer_id = ?", (user_id,))
+                    for referral in user_data.get("referrals", []):
+                        self._conn.execute(
+                            "INSERT OR IGNORE INTO referrals (referrer_id, user_id, username, registration_date, "
+                            "total_spent, stars_bought) VALUES (?, ?, ?, ?, ?, ?)",
+                            [user_id, referral["user_id"]] + [referral.get(name) for name in REFERRAL_FIELDS]
+                        )
+                self._conn.execute("COMMIT")
+            except Exception:
+                self._conn.execute("ROLLBACK")
+                raise
+
+        self.rebuild_stats()
+        logging.info(f"✅ Импортировано пользователей из {json_path}: {len(users_data)}")
+        return len(users_data)
+
+    def import_json_once(self, json_path: str = "users_data.json") -> int:
+        """Импортирует JSON только в пустую базу (первый запуск после перехода на SQLite)"""
+        if self.count_users() > 0 or not os.path.exists(json_path):
+            return 0
+        return self.import_json(json_path)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+if __name__ == "__main__":
+    # Ручной импорт: python -m storage.SqliteStore users_data.json users_data.db
+    source = sys.argv[1] if len(sys.argv) > 1 else "users_data.json"
+    target = sys.argv[2] if len(sys.argv) > 2 else "users_data.db"
+    logging.basicConfig(level=logging.INFO)
+    store = SqliteUserStore(target)
+    count = store.import_json(source)
+    store.close()
+    print(f"✅ Импортировано {count} пользователей из {source} в {target}")
@@ -0,0 +1,77 @@
+"""
+Общий интерфейс хранилища пользователей и выбор реализации по имени
+"""
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+try:
+    from typing import Protocol
+except ImportError:
+    # Python < 3.8: интерфейс остается описанием без проверки типов
+    Protocol = object
+
+
+class Storage(Protocol):
+    """Операции, которые бот и UserCache вызывают у хранилища"""
+
+    def get_user(self, user_id: str) -> Optional[Dict]: ...
+
+    def put_user(self, user_id: str, user_data: Dict): ...
+
+    def put_users(self, items: Iterable[Tuple[str, Dict]]): ...
+
+    def append_purchase(self, user_id: str, purchase: Dict) -> int: ...
+
+    def get_purchases_page(self, user_id: str, page: int = 0, page_size: int = 10) -> List[Dict]: ...
+
+    def count_purchases(self, user_id: str) -> int: ...
+
+    def iterate_purchases(self, user_id: str) -> Iterator[Dict]: ...
+
+    def add_referral(self, referrer_id: str, referral: Dict) -> bool: ...
+
+    def update_referral(self, referrer_id: str, referred_id: str, total_spent: float, stars_bought: int): ...
+
+    def iterate_referrals(self) -> Iterator[Tuple[str, Dict]]: ...
+
+    def iterate_users(self, below_version: Optional[int] = None) -> Iterator[Tuple[str, Dict]]: ...
+
+    def get_stats(self) -> Dict: ...
+
+    def increment_stats(self, **deltas): ...
+
+    def rebuild_stats(self) -> Dict: ...
+
+    def count_users(self) -> int: ...
+
+    def import_json(self, json_path: str = "users_data.json") -> int: ...
+
+    def import_json_once(self, json_path: str = "users_data.json") -> int: ...
+
+    def close(self): ...
+
+
+# Имя хранилища -> путь по умолчанию
+DEFAULT_PATHS = {
+    "sqlite": "users_data.db",
+    "json": "users_data.json",
+    "memory": None,
+}
+
+
+def create_store(backend: str = "sqlite", path: Optional[str] = None, snapshot_path: Optional[str] = None) -> Storage:
+    """
+    Создает хранилище по имени из config.py: sqlite, json или memory.
+    snapshot_path - бинарный снимок для быстрого старта JSON-хранилища
+    """
+    if backend not in DEFAULT_PATHS:
+        raise ValueError(f"Неизвестное хранилище пользователей: {backend} (доступны: {', '.join(DEFAULT_PATHS)})")
+    path = path or DEFAULT_PATHS[backend]
+
+    if backend == "sqlite":
+        from storage.SqliteStore import SqliteUserStore
+        return SqliteUserStore(path)
+    if backend == "json":
+        from storage.JsonStore import JsonUserStore
+        return JsonUserStore(path, snapshot_path)
+    from storage.MemoryStore import MemoryUserStore
+    return MemoryUserStore()
@@ -0,0 +1,183 @@
+"""
+Кэш пользователей в памяти процесса с отложенной пакетной записью
+"""
+import logging
+import threading
+import time
+from collections import OrderedDict
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from storage.Records import UserRecord
+
+
+class UserCache:
+    """
+    Держит пользователей в памяти и сбрасывает изменённые записи в хранилище
+    одной транзакцией по таймеру или при остановке. В памяти не больше max_size записей:
+    вытесняются давно не использованные и только уже сброшенные (не из _dirty).
+    Покупки и рефералы пишутся в хранилище сразу (write-through) и в кэше не держатся.
+    """
+
+    def __init__(self, store, flush_interval: float = 2.0, max_size: int = 50000):
+        self.store = store
+        self.flush_interval = flush_interval
+        self.max_size = max_size
+
+        self._lock = threading.RLock()
+        self._users: "OrderedDict[str, UserRecord]" = OrderedDict()
+        self._dirty = set()
+
+        # Счетчики для наблюдения под нагрузкой
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.flushes = 0
+        self.flushed_users = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self.total_flush_ms = 0.0
+
+        self._stop_event = threading.Event()
+        self._flusher = threading.Thread(target=self._flush_loop, name="user-cache-flush", daemon=True)
+        self._flusher.start()
+
+    def _load(self, user_id: str) -> Optional[UserRecord]:
+        record = self._users.get(user_id)
+        if record is not None:
+            self._users.move_to_end(user_id)
+            self.hits += 1
+            return record
+
+        self.misses += 1
+        user_data = self.store.get_user(user_id)
+        if user_data is None:
+            return None
+        record = self._users[user_id] = UserRecord.from_dict(user_id, user_data)
+        self._evict()
+        return record
+
+    def _evict(self):
+        """Вытесняет самые старые сброшенные записи сверх max_size; несброшенные остаются"""
+        excess = len(self._users) - self.max_size
+        if excess <= 0:
+            return
+        for user_id in list(self._users):
+            if excess <= 0:
+                break
+            if user_id in self._dirty:
+                continue
+            del self._users[user_id]
+            self.evictions += 1
+            excess -= 1
+
+    def get_user(self, user_id: str) -> Optional[UserRecord]:
+        """Возвращает копию записи, чтобы обработчики не меняли кэш в обход put_user"""
+        with self._lock:
+            record = self._load(user_id)
+            return record.copy() if record is not None else None
+
+    def put_user(self, user_id: str, user_data):
+        """Принимает UserRecord или словарь"""
+        with self._lock:
+            self._users[user_id] = UserRecord.coerce(user_id, user_data)
+            self._users.move_to_end(user_id)
+            self._dirty.add(user_id)
+            self._evict()
+
+    def append_purchase(self, user_id: str, purchase: Dict) -> int:
+        return self.store.append_purchase(user_id, purchase)
+
+    def get_purchases_page(self, user_id: str, page: int = 0, page_size: int = 10) -> List[Dict]:
+        return self.store.get_purchases_page(user_id, page, page_size)
+
+    def count_purchases(self, user_id: str) -> int:
+        return self.store.count_purchases(user_id)
+
+    def iterate_purchases(self, user_id: str) -> Iterator[Dict]:
+        return self.store.iterate_purchases(user_id)
+
+    def add_referral(self, referrer_id: str, referral: Dict) -> bool:
+        return self.store.add_referral(referrer_id, referral)
+
+    def update_referral(self, referrer_id: str, referred_id: str, total_spent: float, stars_bought: int):
+        self.store.update_referral(referrer_id, referred_id, total_spent, stars_bought)
+
+    def iterate_referrals(self) -> Iterator[Tuple[str, Dict]]:
+        return self.store.iterate_referrals()
+
+    def iterate_users(self, below_version: Optional[int] = None) -> Iterator[Tuple[str, Dict]]:
+        self.flush()
+        return self.store.iterate_users(below_version=below_version)
+
+    def get_stats(self) -> Dict:
+        return self.store.get_stats()
+
+    def increment_stats(self, **deltas):
+        self.store.increment_stats(**deltas)
+
+    def rebuild_stats(self) -> Dict:
+        self.flush()
+        return self.store.rebuild_stats()
+
+    def count_users(self) -> int:
+        self.flush()
+        return self.store.count_users()
+
+    def import_json_once(self, json_path: str = "users_data.json") -> int:
+        return self.store.import_json_once(json_path)
+
+    def flush(self):
+        """Сбрасывает все изменённые записи одной пачкой"""
+        with self._lock:
+            if not self._dirty:
+                return
+            # Хранилище пишет пачку под той же блокировкой, копировать записи не нужно
+            batch = [(user_id, self._users[user_id]) for user_id in self._dirty]
+            self._dirty.clear()
+
+            started = time.perf_counter()
+            try:
+                self.store.put_users(batch)
+            except Exception as e:
+                # Возвращаем записи в очередь, чтобы не потерять изменения
+                self._dirty.update(user_id for user_id, _ in batch)
+                logging.error(f"❌ Ошибка сброса кэша пользователей: {e}")
+                return
+
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            self.flushes += 1
+            self.flushed_users += len(batch)
+            self.last_flush_ms = elapsed_ms
+            self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+            self.total_flush_ms += elapsed_ms
+            # Сброшенные записи снова можно вытеснять
+            self._evict()
+
+    def _flush_loop(self):
+        while not self._stop_event.wait(self.flush_interval):
+            self.flush()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            requests_total = self.hits + self.misses
+            return {
+                "cached_users": len(self._users),
+                "dirty_users": len(self._dirty),
+                "evictions": self.evictions,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / requests_total if requests_total else 0.0,
+                "flushes": self.flushes,
+                "flushed_users": self.flushed_users,
+                "last_flush_ms": self.last_flush_ms,
+                "max_flush_ms": self.max_flush_ms,
+                "avg_flush_ms": self.total_flush_ms / self.flushes if self.flushes else 0.0,
+            }
+
+    def close(self):
+        """Останавливает фоновый сброс и записывает оставшиеся изменения"""
+        self._stop_event.set()
+        self._flusher.join(timeout=self.flush_interval + 1)
+        self.flush()
+        self.store.close()
+        logging.info("✅ Кэш пользователей сброшен при остановке")
@@ -1,19 +1,59 @@
 import telebot
-from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton, Message, CallbackQuery, InputMediaPhoto
+from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton, Message, CallbackQuery
 import json
 import os
 import time
+import atexit
+import threading
 import asyncio
+import concurrent.futures
+import aiohttp
 from datetime import datetime
 from config import BOT_TOKEN, EMOJIS, APAYS_CLIENT_ID, APAYS_SECRET_KEY, APAYS_BASE_URL, PAYMENT_MIN_AMOUNT, PAYMENT_MAX_AMOUNT, APAYS_ENABLED, TON_WALLET_ADDRESS, TON_COMMISSION_PERCENT, TON_ENABLED, APAYS_COMMISSION_PERCENT, APAYS_MIN_AMOUNT, TON_MIN_AMOUNT
 from FragmentApi.BuyStars import buy_stars
+from FragmentApi.AsyncPaymentGet import warm_up_async_client, get_async_payment_client
+from FragmentApi.RecipientCache import get_recipient_cache
+from wallet.WalletIdentity import warm_up as warm_up_wallet
 from FragmentApi.APaysPayment import APaysPayment
 from FragmentApi.TonPayment import TonPayment
 from Functions.LogInit import log_init
+from Functions.MediaCache import MediaCache
+from Functions.ImageOptimizer import ImageOptimizer
+from Functions.AsyncLoop import get_loop, run_coro, spawn, run_blocking
+from Functions.RateLimiter import TelegramRateLimiter
+from Functions.TelegramWebhook import use_api_url, run_webhook, generate_secret
+from Functions.CallbackRouter import CallbackRouter
+from Functions.Dispatcher import ChatDispatcher, chat_of_message, chat_of_callback
+from Functions.MessageCache import MessageStateCache, EDIT_CAPTION, EDIT_MARKUP, EDIT_NONE, EDIT_MEDIA
+from storage.Storage import create_store
+from storage.UserCache import UserCache
+from storage.BalanceLedger import BalanceLedger, TOPUP
+from storage.Balances import BalanceManager
+from storage.Migrations import migrate_user, migrate_all
+from storage.Records import UserRecord
+from storage.ReferralIndex import ReferralIndex
 import logging
 
-# Инициализация бота
-bot = telebot.TeleBot(BOT_TOKEN)
+# Инициализация бота: telebot только принимает обновления, обработчики выполняет ChatDispatcher
+bot = telebot.TeleBot(BOT_TOKEN, threaded=False)
+
+# Свой Bot API (локальный сервер Telegram или фейк для проверки), None - api.telegram.org
+try:
+    from config import TELEGRAM_API_URL
+except ImportError:
+    TELEGRAM_API_URL = None
+use_api_url(TELEGRAM_API_URL)
+
+# Прием обновлений: "polling" (по умолчанию) или "webhook"
+try:
+    from config import BOT_MODE, WEBHOOK_URL, WEBHOOK_SECRET, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH
+except ImportError:
+    BOT_MODE = "polling"
+    WEBHOOK_URL = None
+    WEBHOOK_SECRET = None
+    WEBHOOK_HOST = "0.0.0.0"
+    WEBHOOK_PORT = 8443
+    WEBHOOK_PATH = "/telegram/webhook"
 
 # Инициализация APays клиента (только если включен)
 apays = None
@@ -42,6 +82,34 @@ except Exception as e:
 # Импортируем константы поддержки
 from config import SUPPORT_USERNAME, SUPPORT_CHAT_ID
 
+# Все исходящие запросы к Telegram идут через планировщик с лимитами (30/с всего, 1/с на чат);
+# уведомления техподдержки уступают ответам пользователям
+try:
+    from config import TELEGRAM_GLOBAL_RATE
+except ImportError:
+    TELEGRAM_GLOBAL_RATE = 30.0
+try:
+    from config import TELEGRAM_CHAT_RATE
+except ImportError:
+    TELEGRAM_CHAT_RATE = 1.0
+rate_limiter = TelegramRateLimiter(
+    global_rate=TELEGRAM_GLOBAL_RATE,
+    chat_rate=TELEGRAM_CHAT_RATE,
+    low_priority_chats=[SUPPORT_CHAT_ID, SUPPORT_USERNAME]
+)
+rate_limiter.install()
+
+# Изображения бота уменьшаются до размера показа в Telegram (кэш в media_optimized/);
+# без Pillow отправляются исходники. Копия создается при первой отправке, при запуске бота - заранее в фоне
+BOT_IMAGES = ["старт.jpeg", "чек.jpeg", "ава.jpeg"]
+image_optimizer = ImageOptimizer('media_optimized')
+
+# Изображения загружаются в Telegram один раз, дальше отправляются по file_id
+media_cache = MediaCache(bot, 'media_cache.json', optimizer=image_optimizer)
+
+# Что показывает каждое сообщение бота: при смене только текста или кнопок фото не перезаливается
+message_states = MessageStateCache(max_size=10000)
+
 # Функция для безопасного редактирования сообщений
 def safe_edit_message(chat_id, message_id, text, reply_markup=None, photo_path=None):
     """
@@ -52,7 +120,9 @@ def safe_edit_message(chat_id, message_id, text, reply_markup=None, photo_path=N
             # Если есть изображение, используем send_photo_with_text
             send_photo_with_text(chat_id, text, photo_path, reply_markup, message_id)
         else:
-            # Если нет изображения, редактируем как текст
+            # Если нет изображения, редактируем как текст (повторное нажатие той же кнопки пропускаем)
+            if message_states.unchanged(chat_id, message_id, None, text, reply_markup):
+                return
             bot.edit_message_text(
                 chat_id=chat_id,
                 message_id=message_id,
@@ -60,6 +130,7 @@ def safe_edit_message(chat_id, message_id, text, reply_markup=None, photo_path=N
                 reply_markup=reply_markup,
                 parse_mode='HTML'
             )
+            message_states.remember(chat_id, message_id, None, text, reply_markup)
     except Exception as e:
         logging.error(f"Ошибка редактирования сообщения: {e}")
         # Проверяем тип ошибки для более точной обработки
@@ -68,21 +139,25 @@ def safe_edit_message(chat_id, message_id, text, reply_markup=None, photo_path=N
         # Если это ошибка "message is not modified", игнорируем её
         if "message is not modified" in error_str or "message_not_modified" in error_str:
             logging.info("Сообщение не изменилось, игнорируем ошибку")
+            if not photo_path:
+                message_states.remember(chat_id, message_id, None, text, reply_markup)
             return
         
+        message_states.forget(chat_id, message_id)
+        
         # Если это ошибка "message to edit not found", отправляем новое сообщение
         if "message to edit not found" in error_str or "message_not_found" in error_str:
             logging.info("Сообщение для редактирования не найдено, отправляем новое")
             try:
                 if photo_path and os.path.exists(photo_path):
-                    with open(photo_path, 'rb') as photo:
-                        bot.send_photo(
-                            chat_id=chat_id,
-                            photo=photo,
-                            caption=text,
-                            reply_markup=reply_markup,
-                            parse_mode='HTML'
-                        )
+                    sent = media_cache.send_photo(
+                        chat_id,
+                        photo_path,
+                        caption=text,
+                        reply_markup=reply_markup,
+                        parse_mode='HTML'
+                    )
+                    message_states.remember(chat_id, sent.message_id, photo_path, text, reply_markup)
                 else:
                     bot.send_message(
                         chat_id=chat_id,
@@ -105,14 +180,14 @@ def safe_edit_message(chat_id, message_id, text, reply_markup=None, photo_path=N
             # Для других ошибок пытаемся отправить новое сообщение
             try:
                 if photo_path and os.path.exists(photo_path):
-                    with open(photo_path, 'rb') as photo:
-                        bot.send_photo(
-                            chat_id=chat_id,
-                            photo=photo,
-                            caption=text,
-                            reply_markup=reply_markup,
-                            parse_mode='HTML'
-                        )
+                    sent = media_cache.send_photo(
+                        chat_id,
+                        photo_path,
+                        caption=text,
+                        reply_markup=reply_markup,
+                        parse_mode='HTML'
+                    )
+                    message_states.remember(chat_id, sent.message_id, photo_path, text, reply_markup)
                 else:
                     bot.send_message(
                         chat_id=chat_id,
@@ -140,26 +215,53 @@ def send_photo_with_text(chat_id, text, photo_path, reply_markup=None, message_i
     try:
         if os.path.exists(photo_path):
             if message_id:
-                # Редактируем существующее сообщение
-                with open(photo_path, 'rb') as photo:
-                    try:
-                        # Пытаемся редактировать медиа
-                        bot.edit_message_media(
+                # Редактируем существующее сообщение: если в нем уже это изображение,
+                # меняем только подпись или клавиатуру, без edit_message_media
+                plan = message_states.plan_photo_edit(chat_id, message_id, photo_path, text, reply_markup)
+                if plan == EDIT_NONE:
+                    # То же изображение, подпись и кнопки: запрос "message is not modified" не нужен
+                    return
+                try:
+                    if plan == EDIT_MARKUP:
+                        bot.edit_message_reply_markup(
                             chat_id=chat_id,
                             message_id=message_id,
-                            media=InputMediaPhoto(media=photo, caption=text, parse_mode='HTML'),
                             reply_markup=reply_markup
                         )
-                    except Exception as media_error:
-                        # Если не удалось редактировать медиа, пытаемся отредактировать только подпись
-                        error_str = str(media_error).lower()
-                        
-                        # Если сообщение не изменилось, игнорируем ошибку
-                        if "message is not modified" in error_str or "message_not_modified" in error_str:
-                            logging.info("Медиа сообщение не изменилось, игнорируем ошибку")
-                            return
-                        
-                        try:
+                    elif plan == EDIT_CAPTION:
+                        bot.edit_message_caption(
+                            chat_id=chat_id,
+                            message_id=message_id,
+                            caption=text,
+                            reply_markup=reply_markup,
+                            parse_mode='HTML'
+                        )
+                    else:
+                        # Редактируем медиа (по file_id, без повторной загрузки файла)
+                        media_cache.edit_message_media(
+                            chat_id,
+                            message_id,
+                            photo_path,
+                            caption=text,
+                            parse_mode='HTML',
+                            reply_markup=reply_markup
+                        )
+                    message_states.remember(chat_id, message_id, photo_path, text, reply_markup)
+                except Exception as media_error:
+                    # Не удалось изменить медиа - пробуем только подпись; не удалось изменить подпись
+                    # или кнопки - сразу заменяем медиа целиком (тот же запрос не повторяем)
+                    error_str = str(media_error).lower()
+                    
+                    # Если сообщение не изменилось, игнорируем ошибку
+                    if "message is not modified" in error_str or "message_not_modified" in error_str:
+                        logging.info("Медиа сообщение не изменилось, игнорируем ошибку")
+                        message_states.remember(chat_id, message_id, photo_path, text, reply_markup)
+                        return
+                    
+                    # Что теперь показывает сообщение, неизвестно
+                    message_states.forget(chat_id, message_id)
+                    try:
+                        if plan == EDIT_MEDIA:
                             bot.edit_message_caption(
                                 chat_id=chat_id,
                                 message_id=message_id,
@@ -167,36 +269,49 @@ def send_photo_with_text(chat_id, text, photo_path, reply_markup=None, message_i
                                 reply_markup=reply_markup,
                                 parse_mode='HTML'
                             )
-                        except Exception as caption_error:
-                            caption_error_str = str(caption_error).lower()
-                            
-                            # Если подпись не изменилась, игнорируем ошибку
-                            if "message is not modified" in caption_error_str or "message_not_modified" in caption_error_str:
-                                logging.info("Подпись сообщения не изменилась, игнорируем ошибку")
-                                return
-                            
-                            # Если и это не удалось, отправляем новое сообщение
-                            logging.warning(f"Не удалось редактировать сообщение, отправляем новое: {media_error}, {caption_error}")
-                            bot.send_photo(
-                                chat_id=chat_id,
-                                photo=photo,
+                        else:
+                            media_cache.edit_message_media(
+                                chat_id,
+                                message_id,
+                                photo_path,
                                 caption=text,
-                                reply_markup=reply_markup,
-                                parse_mode='HTML'
+                                parse_mode='HTML',
+                                reply_markup=reply_markup
                             )
+                            message_states.remember(chat_id, message_id, photo_path, text, reply_markup)
+                    except Exception as caption_error:
+                        caption_error_str = str(caption_error).lower()
+                        
+                        # Если подпись не изменилась, игнорируем ошибку
+                        if "message is not modified" in caption_error_str or "message_not_modified" in caption_error_str:
+                            logging.info("Подпись сообщения не изменилась, игнорируем ошибку")
+                            return
+                        
+                        # Если и это не удалось, отправляем новое сообщение
+                        logging.warning(f"Не удалось редактировать сообщение, отправляем новое: {media_error}, {caption_error}")
+                        sent = media_cache.send_photo(
+                            chat_id,
+                            photo_path,
+                            caption=text,
+                            reply_markup=reply_markup,
+                            parse_mode='HTML'
+                        )
+                        message_states.remember(chat_id, sent.message_id, photo_path, text, reply_markup)
             else:
-                # Отправляем новое сообщение
-                with open(photo_path, 'rb') as photo:
-                    bot.send_photo(
-                        chat_id=chat_id,
-                        photo=photo,
-                        caption=text,
-                        reply_markup=reply_markup,
-                        parse_mode='HTML'
-                    )
+                # Отправляем новое сообщение (по file_id, файл загружается только в первый раз)
+                sent = media_cache.send_photo(
+                    chat_id,
+                    photo_path,
+                    caption=text,
+                    reply_markup=reply_markup,
+                    parse_mode='HTML'
+                )
+                message_states.remember(chat_id, sent.message_id, photo_path, text, reply_markup)
         else:
             # Если изображение не найдено, отправляем только текст
             if message_id:
+                if message_states.unchanged(chat_id, message_id, None, text, reply_markup):
+                    return
                 try:
                     bot.edit_message_text(
                         chat_id=chat_id,
@@ -205,14 +320,18 @@ def send_photo_with_text(chat_id, text, photo_path, reply_markup=None, message_i
                         reply_markup=reply_markup,
                         parse_mode='HTML'
                     )
+                    message_states.remember(chat_id, message_id, None, text, reply_markup)
                 except Exception as text_error:
                     text_error_str = str(text_error).lower()
                     
                     # Если сообщение не изменилось, игнорируем ошибку
                     if "message is not modified" in text_error_str or "message_not_modified" in text_error_str:
                         logging.info("Текстовое сообщение не изменилось, игнорируем ошибку")
+                        message_states.remember(chat_id, message_id, None, text, reply_markup)
                         return
                     
+                    message_states.forget(chat_id, message_id)
+                    
                     # Если не удалось отредактировать текст, отправляем новое сообщение
                     logging.warning(f"Не удалось отредактировать текст, отправляем новое: {text_error}")
                     bot.send_message(
@@ -271,6 +390,7 @@ def send_photo_with_text(chat_id, text, photo_path, reply_markup=None, message_i
 user_states = {}
 
 # Функция для отправки сообщений в техподдержку
+@rate_limiter.low_priority
 def send_to_support(message_text):
     """
     Отправляет сообщение в техподдержку с улучшенной обработкой ошибок
@@ -337,10 +457,9 @@ async def get_ton_balance():
     """
     try:
         from config import WALLET_MNEMONICS
-        from wallet.Transactions import Transactions
+        from FragmentApi.BuyStars import get_transactions
         
-        config = {'testnet': False, 'TON_NETWORK': 'mainnet'}
-        transactions = Transactions(config)
+        transactions = get_transactions(testnet=False)
         
         balance_result = await transactions.get_balance(WALLET_MNEMONICS)
         if balance_result.get('success'):
@@ -391,8 +510,8 @@ async def log_stars_purchase(user_id, username, stars_amount, cost, recipient, s
         if not success and error_message:
             log_message += f"\n❌ <b>Ошибка:</b> {error_message}"
         
-        # Отправляем лог в техподдержку
-        send_to_support(log_message)
+        # Отправляем лог в техподдержку (в пуле потоков, чтобы не останавливать цикл событий)
+        await run_blocking(send_to_support, log_message)
         logging.info(f"📤 Лог покупки звезд отправлен в техподдержку: {status_text}")
         
     except Exception as e:
@@ -425,8 +544,8 @@ async def log_balance_topup(user_id, username, amount, payment_method, success,
         if not success and error_message:
             log_message += f"\n❌ <b>Ошибка:</b> {error_message}"
         
-        # Отправляем лог в техподдержку
-        send_to_support(log_message)
+        # Отправляем лог в техподдержку (в пуле потоков, чтобы не останавливать цикл событий)
+        await run_blocking(send_to_support, log_message)
         logging.info(f"📤 Лог пополнения баланса отправлен в техподдержку: {status_text}")
         
     except Exception as e:
@@ -435,13 +554,15 @@ async def log_balance_topup(user_id, username, amount, payment_method, success,
 
 
 # Функция для проверки существования username через Fragment API
+# Сколько ждать ответа Fragment при проверке username, секунды (дольше - проверка пропускается,
+# чтобы не держать поток обработчиков)
+USERNAME_CHECK_TIMEOUT = 4
+
 def check_username_exists(username):
     """
-    Проверяет существование и доступность username через Fragment GraphQL API
+    Проверяет формат username и наличие получателя в Fragment (searchStarsRecipient)
     """
     try:
-        import requests
-        
         # Убираем @ если есть
         clean_username = username.lstrip('@')
         
@@ -461,20 +582,28 @@ def check_username_exists(username):
         # 4. Проверка существования через Fragment API
         logging.info(f"🔍 Проверяем username: {clean_username}")
         
-        # TODO: Добавить реальную проверку через Fragment API когда он станет доступен
-        # Пример кода для будущей реализации:
-        # query = "query ($name: String!) { domain(name: $name) { name state owner { wallet } } }"
-        # response = requests.post("https://fragment.com/graphql", json={"query": query, "variables": {"name": clean_username}})
-        # if domain["state"] == "OPEN": return True, None  # Доступен для покупки
-        # else: return False, f"Username @{clean_username} уже занят"
-        
-        # Пока используем базовую проверку формата
-        logging.info(f"✅ Username {clean_username} прошел базовую проверку")
+        # searchStarsRecipient через общий клиент Fragment: ответ (и "не найден") попадает
+        # в кэш получателей, поэтому покупка этому получателю не повторяет запрос.
+        # Отказываем только на подтвержденное "не найден"; сетевая ошибка, таймаут и непонятный
+        # ответ означают "неизвестно" - проверку пропускаем, получателя проверит сама покупка
+        try:
+            recipient_id, _ = run_coro(
+                get_async_payment_client().resolve_recipient_async(clean_username),
+                timeout=USERNAME_CHECK_TIMEOUT
+            )
+        except (aiohttp.ClientError, asyncio.TimeoutError, concurrent.futures.TimeoutError) as e:
+            logging.warning(f"⚠️ Fragment не ответил на проверку @{clean_username}, пропускаем проверку: {e!r}")
+            return True, None
+        except Exception as e:
+            logging.warning(f"⚠️ Fragment не дал ответа о @{clean_username}, пропускаем проверку: {e}")
+            return True, None
+        if recipient_id is None:
+            logging.info(f"❌ Username {clean_username} не найден на Fragment")
+            return False, f"Пользователь @{clean_username} не найден"
+
+        logging.info(f"✅ Username {clean_username} найден на Fragment")
         return True, None
         
-    except requests.exceptions.RequestException as e:
-        logging.error(f"❌ Ошибка запроса к Fragment API: {e}")
-        return True, None  # Если API недоступен, пропускаем проверку
     except Exception as e:
         logging.error(f"❌ Ошибка проверки username '{username}': {e}")
         return False, "Ошибка проверки username"
@@ -482,53 +611,144 @@ def check_username_exists(username):
 # Константа цены за звезду
 STAR_PRICE = 1.35  # ₽ за звезду
 
-# Загружаем данные пользователей
-def load_users_data():
+# Хранилище пользователей выбирается в config.py (по умолчанию SQLite) и работает за кэшем в памяти
+try:
+    from config import STORAGE_BACKEND
+except ImportError:
+    STORAGE_BACKEND = "sqlite"
+try:
+    from config import STORAGE_PATH
+except ImportError:
+    STORAGE_PATH = None
+try:
+    from config import STORAGE_SNAPSHOT_PATH
+except ImportError:
+    STORAGE_SNAPSHOT_PATH = None
+try:
+    from config import USER_CACHE_SIZE
+except ImportError:
+    USER_CACHE_SIZE = 50000
+user_store = UserCache(create_store(STORAGE_BACKEND, STORAGE_PATH, STORAGE_SNAPSHOT_PATH), max_size=USER_CACHE_SIZE)
+# Несброшенные изменения записываются при остановке процесса
+atexit.register(user_store.close)
+# Одноразовый перенос данных из старого users_data.json
+user_store.import_json_once('users_data.json')
+# Однократно обновляем устаревшие записи до текущей версии схемы
+migrate_all(user_store)
+# Рефералы и счетчики квалифицированных рефералов по каждому рефереру
+referral_index = ReferralIndex(user_store)
+
+# Загружаем данные одного пользователя
+def get_user_data(user_id):
+    user_data = user_store.get_user(user_id) or {}
+    return update_user_structure(user_data, user_id)
+
+# Сохраняем данные одного пользователя
+def save_user_data(user_id, user_data):
+    user_store.put_user(user_id, user_data)
+
+# Журнал изменений баланса: каждое событие сразу пишется на диск,
+# поэтому балансы не теряются, даже если кэш не успел сбросить запись
+balance_ledger = BalanceLedger('balance_ledger.log', 'balance_snapshot.json')
+atexit.register(balance_ledger.close)
+balance_ledger.reconcile(user_store)
+
+# Все изменения баланса идут под блокировкой пользователя (пополнение, холд, списание)
+balance_manager = BalanceManager(user_store, balance_ledger)
+
+# Пул обработчиков обновлений: покупка одного пользователя не задерживает остальных,
+# а обновления одного чата обрабатываются строго по порядку
+try:
+    from config import UPDATE_WORKERS
+except ImportError:
+    UPDATE_WORKERS = 8
+try:
+    from config import UPDATE_QUEUE_LIMIT
+except ImportError:
+    UPDATE_QUEUE_LIMIT = 1000
+# Корутины (покупка звезд, логи) выполняются в одном фоновом цикле событий;
+# останавливается после диспетчера, когда новые корутины уже не ставятся
+async_loop = get_loop()
+atexit.register(async_loop.stop)
+# Клиент Fragment (соединение и api hash) готовится в фоне, пока бот запускается
+spawn(warm_up_async_client())
+# Ключи кошелька из WALLET_MNEMONICS выводятся один раз, в пуле потоков, не задерживая запуск
+try:
+    from config import WALLET_MNEMONICS
+    spawn(run_blocking(warm_up_wallet, WALLET_MNEMONICS))
+except ImportError:
+    pass
+dispatcher = ChatDispatcher(workers=UPDATE_WORKERS, max_pending=UPDATE_QUEUE_LIMIT)
+# Регистрируется после хранилищ, поэтому при остановке дорабатывает раньше, чем они закрываются
+atexit.register(dispatcher.stop)
+
+# Пополняем баланс пользователя и возвращаем обновленные данные
+def credit_balance(user_id, amount, **details):
+    user_data = balance_manager.credit(user_id, amount, TOPUP, **details)
+    return update_user_structure(user_data, user_id)
+
+# TON платежи, уже зачисленные на баланс: кнопка "Проверить платеж" и автопроверка
+# могут подтвердить один платеж почти одновременно, зачисляет его только первая
+credited_payments = set()
+credited_payments_lock = threading.Lock()
+
+# Зачисляем платеж payment_id один раз; None, если он уже зачислен
+def credit_payment_once(user_id, amount, payment_id, **details):
+    with credited_payments_lock:
+        if payment_id in credited_payments:
+            logging.warning(f"⚠️ Платеж {payment_id} уже зачислен, повторное зачисление пропущено")
+            return None
+        credited_payments.add(payment_id)
     try:
-        with open('users_data.json', 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except FileNotFoundError:
-        return {}
-
-# Сохраняем данные пользователей
-def save_users_data(data):
-    with open('users_data.json', 'w', encoding='utf-8') as f:
-        json.dump(data, f, indent=2, ensure_ascii=False)
+        return credit_balance(user_id, amount, payment_id=payment_id, **details)
+    except Exception:
+        # Зачисление не состоялось: платеж можно подтвердить снова
+        with credited_payments_lock:
+            credited_payments.discard(payment_id)
+        raise
+
+# Результат buy_stars: True при успехе, иначе False или словарь send_ton с описанием ошибки
+def purchase_succeeded(result):
+    return result is True or (isinstance(result, dict) and bool(result.get('success')))
+
+def purchase_error(result):
+    if isinstance(result, dict):
+        return str(result.get('error', result.get('message', 'Неизвестная ошибка')))
+    if isinstance(result, str):
+        return result
+    return "Неизвестная ошибка"
+
+# Списываем холд после отправки звезд. Звезды уже ушли, поэтому при ошибке списания
+# холд не снимается (сумма остается зарезервированной), а админы получают уведомление
+def commit_purchase(hold_id, user_id, stars_amount, cost, recipient):
+    try:
+        committed = balance_manager.commit(hold_id, {
+            "date": datetime.now().strftime("%d.%m.%Y %H:%M"),
+            "stars": stars_amount,
+            "cost": cost,
+            "recipient": f"@{recipient}",
+            "status": "completed"
+        })
+        if committed is None:
+            raise RuntimeError(f"холд #{hold_id} не найден")
+        return True
+    except Exception as e:
+        logging.critical(f"❌ Звезды отправлены, но списание не записано (холд #{hold_id}): {e}", exc_info=True)
+        send_to_support(
+            f"🚨 Звезды отправлены, но списание не записано!\n"
+            f"Пользователь ID: {user_id}\n"
+            f"Получатель: @{recipient}\n"
+            f"Количество звезд: {stars_amount}\n"
+            f"Стоимость: {cost:.2f} ₽ (холд #{hold_id})\n"
+            f"Детали ошибки: {e}"
+        )
+        return False
 
-# Обновляем структуру пользователя, добавляя недостающие поля
+# Приводим данные пользователя к UserRecord текущей версии схемы (для актуальных записей - O(1))
 def update_user_structure(user_data, user_id):
-    if "stars_bought" not in user_data:
-        user_data["stars_bought"] = 0
-    if "subscriptions_bought" not in user_data:
-        user_data["subscriptions_bought"] = 0
-    if "total_spent" not in user_data:
-        user_data["total_spent"] = 0.0
-    if "purchases" not in user_data:
-        user_data["purchases"] = []
-    
-    # Реферальная система
-    if "referrals" not in user_data:
-        user_data["referrals"] = []
-    if "referral_earnings" not in user_data:
-        user_data["referral_earnings"] = 0.0
-    if "referral_withdrawn" not in user_data:
-        user_data["referral_withdrawn"] = 0.0
-    if "referral_code" not in user_data:
-        user_data["referral_code"] = f"ref_{user_id}"
-    if "referred_by" not in user_data:
-        user_data["referred_by"] = None
-    if "referral_discount" not in user_data:
-        user_data["referral_discount"] = 0.0  # Скидка в рублях за звезду
-    
-    # Вычисляем total_spent из существующих покупок
-    if user_data["purchases"]:
-        total_spent = sum(purchase.get("cost", 0) for purchase in user_data["purchases"])
-        user_data["total_spent"] = total_spent
-        
-        # Вычисляем stars_bought из существующих покупок
-        stars_bought = sum(purchase.get("stars", 0) for purchase in user_data["purchases"])
-        user_data["stars_bought"] = stars_bought
-    
+    if not isinstance(user_data, UserRecord):
+        user_data = UserRecord.from_dict(user_id, user_data)
+    user_data, _ = migrate_user(user_data, user_id)
     return user_data
 
 # Функции для работы с реферальной системой
@@ -537,12 +757,7 @@ def get_referral_discount(user_data):
     Вычисляет скидку на основе количества приглашенных друзей, пополнивших баланс на 500+ рублей
     Скидка только при наличии ровно 3 квалифицированных рефералов
     """
-    referrals = user_data.get("referrals", [])
-    qualified_referrals = 0
-    
-    for referral in referrals:
-        if referral.get("total_spent", 0) >= 500.0:
-            qualified_referrals += 1
+    qualified_referrals = referral_index.summary(user_data.user_id).qualified
     
     # Скидка только при наличии ровно 3 квалифицированных рефералов
     if qualified_referrals >= 3:
@@ -554,75 +769,70 @@ def update_referral_discount(user_data):
     """
     Обновляет скидку пользователя на основе его рефералов
     """
-    user_data["referral_discount"] = get_referral_discount(user_data)
+    user_data.referral_discount = get_referral_discount(user_data)
     return user_data
 
-def add_referral(referrer_id, referred_id, users_data):
+def add_referral(referrer_id, referred_id, referred_data):
     """
     Добавляет реферала к пользователю
     """
-    if referrer_id not in users_data:
-        return False
-    
-    referrer_data = users_data[referrer_id]
-    referred_data = users_data.get(referred_id, {})
-    
-    # Проверяем, что пользователь еще не является рефералом
-    existing_referrals = [ref["user_id"] for ref in referrer_data.get("referrals", [])]
-    if referred_id in existing_referrals:
-        return False
-    
-    # Добавляем реферала
+    # Добавляем реферала (повторная привязка игнорируется хранилищем)
     referral_info = {
         "user_id": referred_id,
-        "username": referred_data.get("username", "Unknown"),
+        "username": referred_data.username or "Unknown",
         "registration_date": datetime.now().strftime("%d.%m.%Y %H:%M"),
         "total_spent": 0.0,
         "stars_bought": 0
     }
     
-    referrer_data["referrals"].append(referral_info)
-    
-    # Обновляем скидку реферера
-    referrer_data = update_referral_discount(referrer_data)
-    users_data[referrer_id] = referrer_data
+    # Запись реферера меняем под его блокировкой, чтобы не затереть параллельное изменение баланса
+    with balance_manager.locked(referrer_id):
+        referrer_data = user_store.get_user(referrer_id)
+        if referrer_data is None:
+            return False
+        referrer_data = update_user_structure(referrer_data, referrer_id)
+        
+        if not referral_index.add_referral(referrer_id, referral_info):
+            return False
+        
+        # Обновляем скидку реферера
+        referrer_data = update_referral_discount(referrer_data)
+        save_user_data(referrer_id, referrer_data)
     
     # Устанавливаем связь для реферала
-    referred_data["referred_by"] = referrer_id
-    users_data[referred_id] = referred_data
+    referred_data.referred_by = referrer_id
     
     return True
 
-def update_referral_stats(referred_id, users_data):
+def update_referral_stats(referred_id, referred_data):
     """
     Обновляет статистику реферала при покупке
     """
-    referred_data = users_data.get(referred_id, {})
-    referrer_id = referred_data.get("referred_by")
-    
-    if not referrer_id or referrer_id not in users_data:
+    # Реферер находится по обратному индексу, сводка обновляется за O(1)
+    referrer_id = referral_index.record_spend(
+        referred_id,
+        referred_data.total_spent,
+        referred_data.stars_bought
+    )
+    if not referrer_id:
         return
     
-    referrer_data = users_data[referrer_id]
-    referrals = referrer_data.get("referrals", [])
-    
-    # Находим реферала в списке
-    for referral in referrals:
-        if referral["user_id"] == referred_id:
-            referral["total_spent"] = referred_data.get("total_spent", 0)
-            referral["stars_bought"] = referred_data.get("stars_bought", 0)
-            break
-    
-    # Обновляем скидку реферера
-    referrer_data = update_referral_discount(referrer_data)
-    users_data[referrer_id] = referrer_data
+    with balance_manager.locked(referrer_id):
+        referrer_data = user_store.get_user(referrer_id)
+        if referrer_data is None:
+            return
+        
+        # Обновляем скидку реферера
+        referrer_data = update_user_structure(referrer_data, referrer_id)
+        referrer_data = update_referral_discount(referrer_data)
+        save_user_data(referrer_id, referrer_data)
 
 def get_effective_star_price(user_data):
     """
     Возвращает эффективную цену за звезду с учетом скидки
     """
     base_price = STAR_PRICE
-    discount = user_data.get("referral_discount", 0.0)
+    discount = user_data.referral_discount
     return max(base_price - discount, 0.1)  # Минимальная цена 0.1 рубля
 
 # Создаем главное меню
@@ -751,6 +961,22 @@ def create_profile_keyboard():
     )
     return keyboard
 
+# Размер страницы истории покупок
+PURCHASE_HISTORY_PAGE_SIZE = 10
+
+# Создаем клавиатуру для истории покупок с листанием страниц
+def create_purchase_history_keyboard(page, total_pages):
+    keyboard = InlineKeyboardMarkup(row_width=2)
+    navigation = []
+    if page > 0:
+        navigation.append(InlineKeyboardButton("⬅️ Новее", callback_data=f"purchase_history_page_{page - 1}"))
+    if page + 1 < total_pages:
+        navigation.append(InlineKeyboardButton("Старее ➡️", callback_data=f"purchase_history_page_{page + 1}"))
+    if navigation:
+        keyboard.row(*navigation)
+    keyboard.add(InlineKeyboardButton(f"{EMOJIS['back']} Назад", callback_data="profile"))
+    return keyboard
+
 # Создаем клавиатуру для информации
 def create_info_keyboard():
     keyboard = InlineKeyboardMarkup()
@@ -775,22 +1001,24 @@ def create_referral_keyboard():
     )
     return keyboard
 
+# Проверяем, является ли пользователь админом (по chat_id или username)
+def is_admin(from_user):
+    admin_ids = [str(SUPPORT_CHAT_ID), "339294188"]  # Добавьте свои admin ID
+    admin_usernames = ["StarShopsup"]  # Добавьте свои admin usernames
+    
+    return (str(from_user.id) in admin_ids or 
+            from_user.username in admin_usernames)
+
 # Обработчик команды /test_notifications (только для админов)
 @bot.message_handler(commands=['test_notifications'])
+@dispatcher.per_chat(chat_of_message)
 def test_notifications_command(message: Message):
     """
     Команда для тестирования уведомлений техподдержки (только для админов)
     """
     user_id = str(message.from_user.id)
     
-    # Проверяем, является ли пользователь админом (по chat_id или username)
-    admin_ids = [str(SUPPORT_CHAT_ID), "339294188"]  # Добавьте свои admin ID
-    admin_usernames = ["StarShopsup"]  # Добавьте свои admin usernames
-    
-    is_admin = (user_id in admin_ids or 
-                message.from_user.username in admin_usernames)
-    
-    if not is_admin:
+    if not is_admin(message.from_user):
         bot.reply_to(message, "❌ У вас нет прав для выполнения этой команды.")
         return
     
@@ -810,15 +1038,127 @@ def test_notifications_command(message: Message):
         logging.error(f"❌ Ошибка при запуске теста уведомлений: {e}")
 
 
+# Обработчик команды /cache_stats (только для админов)
+@bot.message_handler(commands=['cache_stats'])
+@dispatcher.per_chat(chat_of_message)
+def cache_stats_command(message: Message):
+    """
+    Показывает счетчики кэша пользователей (попадания, промахи, время сброса)
+    """
+    if not is_admin(message.from_user):
+        bot.reply_to(message, "❌ У вас нет прав для выполнения этой команды.")
+        return
+    
+    stats = user_store.stats()
+    stats_text = (
+        f"📊 <b>Кэш пользователей</b>\n\n"
+        f"👥 В памяти: {stats['cached_users']} (не сброшено: {stats['dirty_users']}, "
+        f"вытеснено: {stats['evictions']})\n"
+        f"✅ Попадания: {stats['hits']}\n"
+        f"❌ Промахи: {stats['misses']}\n"
+        f"🎯 Доля попаданий: {stats['hit_rate'] * 100:.1f}%\n"
+        f"💾 Сбросов: {stats['flushes']} ({stats['flushed_users']} записей)\n"
+        f"⏱ Сброс: последний {stats['last_flush_ms']:.1f} мс, "
+        f"средний {stats['avg_flush_ms']:.1f} мс, максимум {stats['max_flush_ms']:.1f} мс"
+    )
+    media_stats = media_cache.stats()
+    stats_text += (
+        f"\n\n🖼 <b>Изображения</b>\n"
+        f"📎 file_id в реестре: {media_stats['registered']}\n"
+        f"⬆️ Загрузок файлов: {media_stats['uploads']}, отправок по file_id: {media_stats['cached_sends']}"
+    )
+    optimizer_report = image_optimizer.report()
+    if optimizer_report['enabled']:
+        stats_text += (
+            f"\n🗜 Оптимизация: {optimizer_report['source_bytes'] / 1024:.0f} КБ -> "
+            f"{optimizer_report['optimized_bytes'] / 1024:.0f} КБ "
+            f"(экономия {optimizer_report['saved_percent']:.0f}%)"
+        )
+    else:
+        stats_text += "\n🗜 Оптимизация выключена (Pillow не установлен)"
+    edit_stats = message_states.stats()
+    stats_text += (
+        f"\n\n✏️ <b>Редактирования сообщений</b>\n"
+        f"⏭ Пропущено без изменений: {edit_stats['hits']}, отправлено: {edit_stats['misses']} "
+        f"({edit_stats['hit_rate'] * 100:.1f}% пропусков)"
+        f"\n✏️ Медиа {edit_stats['media_edits']}, подпись {edit_stats['caption_edits']}, "
+        f"кнопки {edit_stats['markup_edits']} (сообщений в памяти: {edit_stats['tracked']})"
+    )
+    dispatch_stats = dispatcher.stats()
+    stats_text += (
+        f"\n\n⚙️ <b>Обработка обновлений</b>\n"
+        f"🧵 Потоков: {dispatch_stats['workers']}, в очереди: {dispatch_stats['pending']} "
+        f"(чатов: {dispatch_stats['active_chats']}, максимум: {dispatch_stats['max_depth']})\n"
+        f"✅ Обработано: {dispatch_stats['processed']}, с ошибкой: {dispatch_stats['failed']}\n"
+        f"⏱ Ожидание в очереди: среднее {dispatch_stats['avg_wait_ms']:.1f} мс, "
+        f"максимум {dispatch_stats['max_wait_ms']:.1f} мс"
+    )
+    loop_stats = async_loop.stats()
+    stats_text += (
+        f"\n🔁 Корутины: выполнено {loop_stats['completed']}, с ошибкой {loop_stats['failed']}, "
+        f"по таймауту {loop_stats['timed_out']}, сейчас {loop_stats['tasks']}"
+    )
+    limiter_stats = rate_limiter.stats()
+    stats_text += (
+        f"\n\n🚦 <b>Лимиты Telegram</b>\n"
+        f"📨 Запросов: {limiter_stats['requests']}, ждали лимита: {limiter_stats['throttled']} "
+        f"(в среднем {limiter_stats['avg_throttle_ms']:.0f} мс)\n"
+        f"⛔ Ответов 429: {limiter_stats['rate_limited']}, повторов: {limiter_stats['retried']}, "
+        f"чатов на паузе: {limiter_stats['blocked_chats']}"
+    )
+    recipient_stats = get_recipient_cache().stats()
+    stats_text += (
+        f"\n\n🎯 <b>Получатели Fragment</b>\n"
+        f"📇 В кэше: {recipient_stats['cached']}, найдено в кэше: {recipient_stats['hits']}, "
+        f"\"не найден\" из кэша: {recipient_stats['not_found_hits']}, запросов: {recipient_stats['misses']} "
+        f"({recipient_stats['hit_rate'] * 100:.1f}% без запроса)"
+    )
+    route_stats = callback_router.stats()
+    if route_stats:
+        stats_text += "\n\n🧭 <b>Маршруты callback (p50 / p95 / max, мс)</b>"
+        for name, route in route_stats[:10]:
+            stats_text += (
+                f"\n• {name.replace('callback_', '', 1)}: {route['count']} "
+                f"({route['p50_ms']:.0f} / {route['p95_ms']:.0f} / {route['max_ms']:.0f})"
+            )
+            if route['errors']:
+                stats_text += f", ошибок: {route['errors']}"
+    bot.reply_to(message, stats_text, parse_mode='HTML')
+
+
+# Обработчик команды /rebuild_stats (только для админов)
+@bot.message_handler(commands=['rebuild_stats'])
+@dispatcher.per_chat(chat_of_message)
+def rebuild_stats_command(message: Message):
+    """
+    Пересчитывает глобальные счетчики (звезды, рубли, пользователи) по хранилищу
+    """
+    if not is_admin(message.from_user):
+        bot.reply_to(message, "❌ У вас нет прав для выполнения этой команды.")
+        return
+    
+    try:
+        stats = user_store.rebuild_stats()
+        bot.reply_to(
+            message,
+            f"✅ Счетчики пересчитаны\n\n"
+            f"⭐ Звезд продано: {stats['total_stars']:,}\n"
+            f"💰 Оборот: {stats['total_rub']:,.2f} ₽\n"
+            f"👥 Пользователей: {stats['user_count']:,}"
+        )
+        logging.info(f"📊 Счетчики пересчитаны администратором: {message.from_user.username}")
+    except Exception as e:
+        bot.reply_to(message, f"❌ Ошибка пересчета счетчиков: {e}")
+        logging.error(f"❌ Ошибка пересчета счетчиков: {e}")
+
+
 # Обработчик команды /start
 @bot.message_handler(commands=['start'])
+@dispatcher.per_chat(chat_of_message)
 def start(message: Message):
     user_id = str(message.from_user.id)
     username = message.from_user.username or message.from_user.first_name
     
-    # Загружаем данные пользователей
-    users_data = load_users_data()
-    
     # Проверяем реферальную ссылку
     referrer_id = None
     if len(message.text.split()) > 1:
@@ -826,45 +1166,41 @@ def start(message: Message):
         if referral_code.startswith('ref_'):
             referrer_id = referral_code.replace('ref_', '')
     
-    # Создаем нового пользователя, если его нет
-    if user_id not in users_data:
-        users_data[user_id] = {
-            "username": username,
-            "balance": 0.0,  # Начальный баланс
-            "stars_bought": 0,
-            "subscriptions_bought": 0,
-            "total_spent": 0.0,
-            "purchases": []
-        }
-        
-        # Если есть реферальная ссылка, добавляем реферала
-        if referrer_id and referrer_id != user_id:
-            add_referral(referrer_id, user_id, users_data)
-            logging.info(f"✅ Пользователь {user_id} зарегистрирован по реферальной ссылке от {referrer_id}")
-        
-        save_users_data(users_data)
-    else:
-        # Обновляем существующего пользователя
-        users_data[user_id] = update_user_structure(users_data[user_id], user_id)
-        users_data[user_id]["username"] = username
-        save_users_data(users_data)
+    # Запись меняем под блокировкой пользователя, чтобы не затереть параллельное пополнение
+    with balance_manager.locked(user_id):
+        # Загружаем данные пользователя
+        user_data = user_store.get_user(user_id)
+        
+        # Создаем нового пользователя, если его нет
+        if user_data is None:
+            user_data = update_user_structure(UserRecord(user_id, username=username), user_id)
+            user_store.increment_stats(user_count=1)
+        
+            # Если есть реферальная ссылка, добавляем реферала
+            if referrer_id and referrer_id != user_id:
+                add_referral(referrer_id, user_id, user_data)
+                logging.info(f"✅ Пользователь {user_id} зарегистрирован по реферальной ссылке от {referrer_id}")
+        
+            save_user_data(user_id, user_data)
+        else:
+            # Обновляем существующего пользователя
+            user_data = update_user_structure(user_data, user_id)
+            user_data.username = username
+            save_user_data(user_id, user_data)
     
     # Очищаем состояние пользователя
     user_states.pop(user_id, None)
     
-    # Получаем данные пользователя
-    user_data = users_data.get(user_id, {})
-    user_data = update_user_structure(user_data, user_id)
-    user_balance = user_data.get('balance', 0)
+    user_balance = user_data.balance
     
     # Подсчитываем общее количество купленных звезд
-    total_stars = 13430 + sum(user.get('stars_bought', 0) for user in users_data.values()) #для хайпа немного приврём
+    total_stars = 13430 + user_store.get_stats()["total_stars"] #для хайпа немного приврём
     total_rub = total_stars * STAR_PRICE
     
     # Получаем эффективную цену с учетом скидки
     effective_price = get_effective_star_price(user_data)
-    discount = user_data.get("referral_discount", 0.0)
-    qualified_referrals = sum(1 for ref in user_data.get("referrals", []) if ref.get("total_spent", 0) >= 500.0)
+    discount = user_data.referral_discount
+    qualified_referrals = referral_index.summary(user_id).qualified
     
     welcome_text = (
         f"👋 Добро пожаловать в сервис\n\n"
@@ -891,433 +1227,425 @@ def start(message: Message):
         reply_markup=create_main_menu()
     )
 
-# Обработчик callback запросов
-@bot.callback_query_handler(func=lambda call: True)
-def handle_callback(call: CallbackQuery):
-    user_id = str(call.from_user.id)
-    users_data = load_users_data()
+# Маршруты callback_data: обработчик вызывается как handler(call, user_id, user_data),
+# user_data загружается только для маршрутов с needs_user=True
+callback_router = CallbackRouter(load_user=get_user_data)
+
+@callback_router.route("stars", needs_user=True)
+def callback_stars(call: CallbackQuery, user_id: str, user_data=None):
+    # Показываем меню покупки звезд
+    effective_price = get_effective_star_price(user_data)
+    discount = user_data.referral_discount
+    qualified_referrals = referral_index.summary(user_id).qualified
     
-    # Сначала отвечаем на callback, чтобы избежать timeout
-    try:
-        bot.answer_callback_query(call.id)
-    except Exception as e:
-        logging.warning(f"⚠️ Не удалось ответить на callback: {e}")
+    stars_text = (
+        "⭐️ Приобретение Telegram Stars\n\n"
+        f"💰 Текущая цена: {effective_price:.2f} ₽ за звезду"
+    )
+    
+    if discount > 0:
+        stars_text += f"\n🎉 Специальная цена активирована!"
+    elif qualified_referrals > 0:
+        stars_text += f"\n⏳ Прогресс: {qualified_referrals}/3 рефералов (требуется для специальной цены)"
+    
+    stars_text += (
+        f"\n💳 Баланс: {user_data.balance:.2f} ₽\n\n"
+        "Введите количество звезд (50-50000):"
+    )
+    
+    safe_edit_message(
+        chat_id=call.message.chat.id,
+        message_id=call.message.message_id,
+        text=stars_text,
+        reply_markup=create_cancel_keyboard()
+    )
+    user_states[user_id] = {"state": "waiting_stars_amount"}
+
+
+@callback_router.route("topup", needs_user=True)
+def callback_topup(call: CallbackQuery, user_id: str, user_data=None):
+    # Показываем меню выбора способа оплаты
+    
+    topup_text = (
+        "💳 Пополнение баланса\n\n"
+        f"💰 Текущий баланс: {user_data.balance:.2f} ₽\n"
+        f"💸 APays: от {APAYS_MIN_AMOUNT} ₽\n"
+        f"💸 TON: от {TON_MIN_AMOUNT} ₽\n"
+        f"💸 Максимальная сумма: {PAYMENT_MAX_AMOUNT} ₽\n\n"
+        "⚠️ Примечание: Если APays показывает ошибку 'Сервис временно недоступен', используйте TON перевод\n\n"
+        "🔽 Выберите способ оплаты:"
+    )
     
-    if call.data == "stars":
-        # Показываем меню покупки звезд
-        user_data = users_data.get(user_id, {})
-        user_data = update_user_structure(user_data, user_id)
-        effective_price = get_effective_star_price(user_data)
-        discount = user_data.get("referral_discount", 0.0)
-        qualified_referrals = sum(1 for ref in user_data.get("referrals", []) if ref.get("total_spent", 0) >= 500.0)
-        
-        stars_text = (
-            "⭐️ Приобретение Telegram Stars\n\n"
-            f"💰 Текущая цена: {effective_price:.2f} ₽ за звезду"
+    # Создаем клавиатуру с выбором способа оплаты
+    keyboard = InlineKeyboardMarkup()
+    if APAYS_ENABLED and apays:
+        keyboard.add(
+            InlineKeyboardButton(f"💳 APays (+{APAYS_COMMISSION_PERCENT}%)", callback_data="payment_method_apays")
         )
+    keyboard.add(
+        InlineKeyboardButton(f"⚡ Прямой перевод TON (Без комиссии)", callback_data="payment_method_ton")
+    )
+    keyboard.add(
+        InlineKeyboardButton("❌ Отменить", callback_data="back_main")
+    )
+    
+    safe_edit_message(
+        chat_id=call.message.chat.id,
+        message_id=call.message.message_id,
+        text=topup_text,
+        reply_markup=keyboard
+    )
+
+
+@callback_router.route("payment_method_apays")
+def callback_payment_method_apays(call: CallbackQuery, user_id: str, user_data=None):
+    # Выбран APays
+    user_state = user_states.get(user_id, {})
+    custom_amount = user_state.get("custom_amount")
+    
+    if custom_amount:
+        # Если есть пользовательская сумма, проверяем минимальную сумму для APays
+        if custom_amount < APAYS_MIN_AMOUNT:
+            bot.answer_callback_query(
+                call.id, 
+                f"❌ Минимальная сумма для APays: {APAYS_MIN_AMOUNT} ₽"
+            )
+            return
+        
+        # Если есть пользовательская сумма, сразу переходим к пополнению
+        amount = custom_amount
+        
+        # Напрямую вызываем логику пополнения APays
+        if not APAYS_ENABLED or not apays:
+            safe_edit_message(
+                chat_id=call.message.chat.id,
+                message_id=call.message.message_id,
+                text="❌ APays временно недоступен",
+                reply_markup=create_back_keyboard()
+            )
+            return
         
-        if discount > 0:
-            stars_text += f"\n🎉 Специальная цена активирована!"
-        elif qualified_referrals > 0:
-            stars_text += f"\n⏳ Прогресс: {qualified_referrals}/3 рефералов (требуется для специальной цены)"
+        # Создаем платеж
+        payment_data = apays.create_payment(amount)
+        if payment_data and "payment_url" in payment_data:
+            # Сохраняем данные платежа
+            user_states[user_id] = {
+                "state": "waiting_payment_confirmation",
+                "payment_method": "apays",
+                "payment_id": payment_data["payment_id"],
+                "amount": amount
+            }
+            
+            payment_text = (
+                f"💳 APays платеж создан\n\n"
+                f"💰 Сумма: {amount:.2f} ₽\n"
+                f"🆔 ID платежа: {payment_data['payment_id']}\n\n"
+                f"🔗 Ссылка для оплаты:\n{payment_data['payment_url']}\n\n"
+                f"⏳ Ожидаем подтверждения платежа...\n\n"
+                f"⚠️ Если при переходе по ссылке появляется ошибка 'Сервис временно недоступен', попробуйте:\n"
+                f"• Обновить страницу (F5)\n"
+                f"• Отключить блокировщик рекламы\n"
+                f"• Использовать другой браузер\n"
+                f"• Подождать несколько минут и попробовать снова"
+            )
+            
+            safe_edit_message(
+                chat_id=call.message.chat.id,
+                message_id=call.message.message_id,
+                text=payment_text,
+                reply_markup=create_apays_payment_keyboard()
+            )
+        else:
+            safe_edit_message(
+                chat_id=call.message.chat.id,
+                message_id=call.message.message_id,
+                text="❌ Ошибка создания платежа APays",
+                reply_markup=create_back_keyboard()
+            )
+    else:
+        # Обычный процесс ввода суммы
+        user_states[user_id] = {
+            "state": "waiting_topup_amount",
+            "payment_method": "apays"
+        }
         
-        stars_text += (
-            f"\n💳 Баланс: {user_data.get('balance', 0):.2f} ₽\n\n"
-            "Введите количество звезд (50-50000):"
+        topup_text = (
+            "⚪️ Выбран метод: APays\n\n"
+            "✏️ Введите, сколько вы хотите пополнить RUB:"
         )
         
         safe_edit_message(
             chat_id=call.message.chat.id,
             message_id=call.message.message_id,
-            text=stars_text,
+            text=topup_text,
             reply_markup=create_cancel_keyboard()
         )
-        user_states[user_id] = {"state": "waiting_stars_amount"}
-        
+
+
+@callback_router.route("payment_method_ton")
+def callback_payment_method_ton(call: CallbackQuery, user_id: str, user_data=None):
+    # Выбран TON перевод
+    user_state = user_states.get(user_id, {})
+    custom_amount = user_state.get("custom_amount")
+    
+    if custom_amount:
+        logging.info(f"🔍 DEBUG: custom_amount={custom_amount} (тип: {type(custom_amount)})")
+        # Если есть пользовательская сумма, проверяем минимальную сумму для TON
+        if custom_amount < TON_MIN_AMOUNT:
+            bot.answer_callback_query(
+                call.id, 
+                f"❌ Минимальная сумма для TON: {TON_MIN_AMOUNT} ₽"
+            )
+            return
         
-    elif call.data == "topup":
-        # Показываем меню выбора способа оплаты
-        user_data = users_data.get(user_id, {})
-        user_data = update_user_structure(user_data, user_id)
+        # Если есть пользовательская сумма, сразу переходим к пополнению
+        amount = custom_amount
         
-        topup_text = (
-            "💳 Пополнение баланса\n\n"
-            f"💰 Текущий баланс: {user_data.get('balance', 0):.2f} ₽\n"
-            f"💸 APays: от {APAYS_MIN_AMOUNT} ₽\n"
-            f"💸 TON: от {TON_MIN_AMOUNT} ₽\n"
-            f"💸 Максимальная сумма: {PAYMENT_MAX_AMOUNT} ₽\n\n"
-            "⚠️ Примечание: Если APays показывает ошибку 'Сервис временно недоступен', используйте TON перевод\n\n"
-            "🔽 Выберите способ оплаты:"
-        )
+        # Напрямую вызываем логику пополнения TON
+        if not TON_ENABLED or not ton_payment:
+            safe_edit_message(
+                chat_id=call.message.chat.id,
+                message_id=call.message.message_id,
+                text="❌ TON платежи временно недоступны",
+                reply_markup=create_back_keyboard()
+            )
+            return
         
-        # Создаем клавиатуру с выбором способа оплаты
-        keyboard = InlineKeyboardMarkup()
-        if APAYS_ENABLED and apays:
+        # Создаем платеж через TON
+        logging.info(f"🔍 DEBUG: Создаем TON платеж для user_id={user_id} (int: {int(user_id)}), amount={amount} (тип: {type(amount)})")
+        payment_data = ton_payment.create_payment_request(int(user_id), amount)
+        if payment_data and "error" not in payment_data:
+            # Сохраняем данные платежа
+            user_states[user_id] = {
+                "state": "waiting_payment_confirmation",
+                "payment_method": "ton",
+                "amount": amount,
+                "payment_id": payment_data["payment_id"],
+                "comment": payment_data["comment"],
+                "amount_ton": payment_data["amount_ton"],
+                "wallet_address": payment_data["wallet_address"],
+                "created_at": int(time.time())
+            }
+            
+            payment_text = (
+                f"📋 Платеж сформирован\n\n"
+                f"💸 Сумма к отправке: {payment_data['amount_ton']:.4f} TON\n"
+                f"⚠️ Комментарий: <code>{payment_data['comment']}</code>\n"
+                f"💳 Адрес для оплаты: <code>{payment_data['wallet_address']}</code>\n\n"
+                f"‼️ Обязательно указывайте комментарий при отправке монет, в противном случае - пополнение не будет засчитано\n"
+                f"‼️ Окончательная сумма к получению будет рассчитана в момент получения монет\n\n"
+                f"📱 Для оплаты:\n"
+                f"1. Откройте TON кошелек\n"
+                f"2. Отправьте {payment_data['amount_ton']:.4f} TON на указанный адрес\n"
+                f"3. В комментарии укажите: <code>{payment_data['comment']}</code>\n"
+                f"4. Нажмите \"Проверить оплату\" после перевода"
+            )
+            
+            # Создаем клавиатуру с кнопкой проверки оплаты
+            keyboard = InlineKeyboardMarkup()
             keyboard.add(
-                InlineKeyboardButton(f"💳 APays (+{APAYS_COMMISSION_PERCENT}%)", callback_data="payment_method_apays")
+                InlineKeyboardButton("🔍 Проверить оплату", callback_data=f"check_ton_payment_{payment_data['payment_id']}")
             )
-        keyboard.add(
-            InlineKeyboardButton(f"⚡ Прямой перевод TON (Без комиссии)", callback_data="payment_method_ton")
-        )
-        keyboard.add(
-            InlineKeyboardButton("❌ Отменить", callback_data="back_main")
-        )
-        
-        safe_edit_message(
-            chat_id=call.message.chat.id,
-            message_id=call.message.message_id,
-            text=topup_text,
-            reply_markup=keyboard
-        )
-        
-    elif call.data == "payment_method_apays":
-        # Выбран APays
-        user_state = user_states.get(user_id, {})
-        custom_amount = user_state.get("custom_amount")
-        
-        if custom_amount:
-            # Если есть пользовательская сумма, проверяем минимальную сумму для APays
-            if custom_amount < APAYS_MIN_AMOUNT:
-                bot.answer_callback_query(
-                    call.id, 
-                    f"❌ Минимальная сумма для APays: {APAYS_MIN_AMOUNT} ₽"
-                )
-                return
-            
-            # Если есть пользовательская сумма, сразу переходим к пополнению
-            amount = custom_amount
-            
-            # Напрямую вызываем логику пополнения APays
-            if not APAYS_ENABLED or not apays:
-                safe_edit_message(
-                    chat_id=call.message.chat.id,
-                    message_id=call.message.message_id,
-                    text="❌ APays временно недоступен",
-                    reply_markup=create_back_keyboard()
-                )
-                return
-            
-            # Создаем платеж
-            payment_data = apays.create_payment(amount)
-            if payment_data and "payment_url" in payment_data:
-                # Сохраняем данные платежа
-                user_states[user_id] = {
-                    "state": "waiting_payment_confirmation",
-                    "payment_method": "apays",
-                    "payment_id": payment_data["payment_id"],
-                    "amount": amount
-                }
-                
-                payment_text = (
-                    f"💳 APays платеж создан\n\n"
-                    f"💰 Сумма: {amount:.2f} ₽\n"
-                    f"🆔 ID платежа: {payment_data['payment_id']}\n\n"
-                    f"🔗 Ссылка для оплаты:\n{payment_data['payment_url']}\n\n"
-                    f"⏳ Ожидаем подтверждения платежа...\n\n"
-                    f"⚠️ Если при переходе по ссылке появляется ошибка 'Сервис временно недоступен', попробуйте:\n"
-                    f"• Обновить страницу (F5)\n"
-                    f"• Отключить блокировщик рекламы\n"
-                    f"• Использовать другой браузер\n"
-                    f"• Подождать несколько минут и попробовать снова"
-                )
-                
-                safe_edit_message(
-                    chat_id=call.message.chat.id,
-                    message_id=call.message.message_id,
-                    text=payment_text,
-                    reply_markup=create_apays_payment_keyboard()
-                )
-            else:
-                safe_edit_message(
-                    chat_id=call.message.chat.id,
-                    message_id=call.message.message_id,
-                    text="❌ Ошибка создания платежа APays",
-                    reply_markup=create_back_keyboard()
-                )
-        else:
-            # Обычный процесс ввода суммы
-            user_states[user_id] = {
-                "state": "waiting_topup_amount",
-                "payment_method": "apays"
-            }
-            
-            topup_text = (
-                "⚪️ Выбран метод: APays\n\n"
-                "✏️ Введите, сколько вы хотите пополнить RUB:"
+            keyboard.add(
+                InlineKeyboardButton("❌ Отменить", callback_data="cancel")
             )
             
             safe_edit_message(
                 chat_id=call.message.chat.id,
                 message_id=call.message.message_id,
-                text=topup_text,
-                reply_markup=create_cancel_keyboard()
+                text=payment_text,
+                reply_markup=keyboard
             )
-        
-    elif call.data == "payment_method_ton":
-        # Выбран TON перевод
-        user_state = user_states.get(user_id, {})
-        custom_amount = user_state.get("custom_amount")
-        
-        if custom_amount:
-            logging.info(f"🔍 DEBUG: custom_amount={custom_amount} (тип: {type(custom_amount)})")
-            # Если есть пользовательская сумма, проверяем минимальную сумму для TON
-            if custom_amount < TON_MIN_AMOUNT:
-                bot.answer_callback_query(
-                    call.id, 
-                    f"❌ Минимальная сумма для TON: {TON_MIN_AMOUNT} ₽"
-                )
-                return
-            
-            # Если есть пользовательская сумма, сразу переходим к пополнению
-            amount = custom_amount
-            
-            # Напрямую вызываем логику пополнения TON
-            if not TON_ENABLED or not ton_payment:
-                safe_edit_message(
-                    chat_id=call.message.chat.id,
-                    message_id=call.message.message_id,
-                    text="❌ TON платежи временно недоступны",
-                    reply_markup=create_back_keyboard()
-                )
-                return
-            
-            # Создаем платеж через TON
-            logging.info(f"🔍 DEBUG: Создаем TON платеж для user_id={user_id} (int: {int(user_id)}), amount={amount} (тип: {type(amount)})")
-            payment_data = ton_payment.create_payment_request(int(user_id), amount)
-            if payment_data and "error" not in payment_data:
-                # Сохраняем данные платежа
-                user_states[user_id] = {
-                    "state": "waiting_payment_confirmation",
-                    "payment_method": "ton",
-                    "amount": amount,
-                    "payment_id": payment_data["payment_id"],
-                    "comment": payment_data["comment"],
-                    "amount_ton": payment_data["amount_ton"],
-                    "wallet_address": payment_data["wallet_address"],
-                    "created_at": int(time.time())
-                }
-                
-                payment_text = (
-                    f"📋 Платеж сформирован\n\n"
-                    f"💸 Сумма к отправке: {payment_data['amount_ton']:.4f} TON\n"
-                    f"⚠️ Комментарий: <code>{payment_data['comment']}</code>\n"
-                    f"💳 Адрес для оплаты: <code>{payment_data['wallet_address']}</code>\n\n"
-                    f"‼️ Обязательно указывайте комментарий при отправке монет, в противном случае - пополнение не будет засчитано\n"
-                    f"‼️ Окончательная сумма к получению будет рассчитана в момент получения монет\n\n"
-                    f"📱 Для оплаты:\n"
-                    f"1. Откройте TON кошелек\n"
-                    f"2. Отправьте {payment_data['amount_ton']:.4f} TON на указанный адрес\n"
-                    f"3. В комментарии укажите: <code>{payment_data['comment']}</code>\n"
-                    f"4. Нажмите \"Проверить оплату\" после перевода"
-                )
-                
-                # Создаем клавиатуру с кнопкой проверки оплаты
-                keyboard = InlineKeyboardMarkup()
-                keyboard.add(
-                    InlineKeyboardButton("🔍 Проверить оплату", callback_data=f"check_ton_payment_{payment_data['payment_id']}")
-                )
-                keyboard.add(
-                    InlineKeyboardButton("❌ Отменить", callback_data="cancel")
-                )
-                
-                safe_edit_message(
-                    chat_id=call.message.chat.id,
-                    message_id=call.message.message_id,
-                    text=payment_text,
-                    reply_markup=keyboard
-                )
-            else:
-                error_msg = payment_data.get("error", "Неизвестная ошибка") if payment_data else "Ошибка создания платежа"
-                safe_edit_message(
-                    chat_id=call.message.chat.id,
-                    message_id=call.message.message_id,
-                    text=f"❌ Ошибка создания TON платежа: {error_msg}",
-                    reply_markup=create_back_keyboard()
-                )
         else:
-            # Обычный процесс ввода суммы
-            user_states[user_id] = {
-                "state": "waiting_topup_amount",
-                "payment_method": "ton"
-            }
-            
-            topup_text = (
-                "⚪️ Выбран метод: Прямой перевод TON\n\n"
-                "✏️ Введите, сколько вы хотите пополнить RUB:"
-            )
-            
+            error_msg = payment_data.get("error", "Неизвестная ошибка") if payment_data else "Ошибка создания платежа"
             safe_edit_message(
                 chat_id=call.message.chat.id,
                 message_id=call.message.message_id,
-                text=topup_text,
-                reply_markup=create_cancel_keyboard()
+                text=f"❌ Ошибка создания TON платежа: {error_msg}",
+                reply_markup=create_back_keyboard()
             )
+    else:
+        # Обычный процесс ввода суммы
+        user_states[user_id] = {
+            "state": "waiting_topup_amount",
+            "payment_method": "ton"
+        }
         
-    elif call.data == "profile":
-        # Показываем профиль пользователя
-        user_data = users_data.get(user_id, {})
-        user_data = update_user_structure(user_data, user_id)
-        
-        referrals = user_data.get("referrals", [])
-        qualified_referrals = sum(1 for ref in referrals if ref.get("total_spent", 0) >= 500.0)
-        discount = user_data.get("referral_discount", 0.0)
-        
-        if qualified_referrals >= 3:
-            referral_status = "1.30 ₽ за звезду (активирована)"
-        else:
-            referral_status = f"{STAR_PRICE:.2f} ₽ за звезду ({qualified_referrals}/3 рефералов)"
-        
-        profile_text = (
-            f"👤 Профиль пользователя @{user_data.get('username', 'Unknown')}\n\n"
-            f"💰 Текущий баланс: {user_data.get('balance', 0):.2f} ₽\n"
-            f"⭐️ Приобретено звезд: {user_data.get('stars_bought', 0)}\n"
-            f"💸 Общие расходы: {user_data.get('total_spent', 0):.2f} ₽\n\n"
-            f"🎁 Реферальная программа:\n"
-            f"👥 Приглашенных пользователей: {len(referrals)}\n"
-            f"✅ Квалифицированных рефералов: {qualified_referrals}\n"
-            f"🎯 Цена за звезду: {referral_status}"
-        )
-        
-        # Отправляем изображение ава.jpeg с информацией профиля
-        send_photo_with_text(
-            chat_id=call.message.chat.id,
-            text=profile_text,
-            photo_path="ава.jpeg",
-            reply_markup=create_profile_keyboard(),
-            message_id=call.message.message_id
-        )
-        
-    elif call.data == "info":
-        # Показываем информацию о боте
-        info_text = (
-            "ℹ️ Информация о боте\n\n"
-            "🤖 Название: StarShop\n"
-            "💰 Цена: 1.35 ₽ за звезду\n"
-            "📞 Поддержка: @StarShopsup"
-        )
-        
-        safe_edit_message(
-            chat_id=call.message.chat.id,
-            message_id=call.message.message_id,
-            text=info_text,
-            reply_markup=create_info_keyboard()
+        topup_text = (
+            "⚪️ Выбран метод: Прямой перевод TON\n\n"
+            "✏️ Введите, сколько вы хотите пополнить RUB:"
         )
         
-    elif call.data == "purchase_history":
-        # Показываем историю покупок
-        user_data = users_data.get(user_id, {})
-        user_data = update_user_structure(user_data, user_id)
-        
-        purchases = user_data.get('purchases', [])
-        if not purchases:
-            history_text = "📋 История покупок пуста"
-        else:
-            history_text = "📋 История покупок:\n\n"
-            for purchase in purchases[-10:]:  # Показываем последние 10 покупок
-                history_text += (
-                    f"🆔 #{purchase['id']} | {purchase['date']}\n"
-                    f"⭐️ {purchase['stars']} звезд | 💰 {purchase['cost']:.2f} ₽\n"
-                    f"👤 {purchase['recipient']} | {purchase['status']}\n\n"
-                )
-        
         safe_edit_message(
             chat_id=call.message.chat.id,
             message_id=call.message.message_id,
-            text=history_text,
-            reply_markup=create_profile_keyboard()
+            text=topup_text,
+            reply_markup=create_cancel_keyboard()
         )
-        
-    elif call.data.startswith("check_ton_payment_"):
-        # Проверяем TON платеж
-        payment_id = call.data.replace("check_ton_payment_", "")
-        user_state = user_states.get(user_id, {})
-        
-        if user_state.get("payment_method") == "ton" and user_state.get("payment_id") == payment_id:
-            # Проверяем платеж через TON API
-            if ton_payment:
-                try:
-                    result = ton_payment.check_ton_transaction(payment_id, user_state.get("comment"))
+
+
+@callback_router.route("profile", needs_user=True)
+def callback_profile(call: CallbackQuery, user_id: str, user_data=None):
+    # Показываем профиль пользователя
+    
+    referral_summary = referral_index.summary(user_id)
+    qualified_referrals = referral_summary.qualified
+    discount = user_data.referral_discount
+    
+    if qualified_referrals >= 3:
+        referral_status = "1.30 ₽ за звезду (активирована)"
+    else:
+        referral_status = f"{STAR_PRICE:.2f} ₽ за звезду ({qualified_referrals}/3 рефералов)"
+    
+    profile_text = (
+        f"👤 Профиль пользователя @{user_data.username or 'Unknown'}\n\n"
+        f"💰 Текущий баланс: {user_data.balance:.2f} ₽\n"
+        f"⭐️ Приобретено звезд: {user_data.stars_bought}\n"
+        f"💸 Общие расходы: {user_data.total_spent:.2f} ₽\n\n"
+        f"🎁 Реферальная программа:\n"
+        f"👥 Приглашенных пользователей: {referral_summary.count}\n"
+        f"✅ Квалифицированных рефералов: {qualified_referrals}\n"
+        f"🎯 Цена за звезду: {referral_status}"
+    )
+    
+    # Отправляем изображение ава.jpeg с информацией профиля
+    send_photo_with_text(
+        chat_id=call.message.chat.id,
+        text=profile_text,
+        photo_path="ава.jpeg",
+        reply_markup=create_profile_keyboard(),
+        message_id=call.message.message_id
+    )
+
+
+@callback_router.route("info")
+def callback_info(call: CallbackQuery, user_id: str, user_data=None):
+    # Показываем информацию о боте
+    info_text = (
+        "ℹ️ Информация о боте\n\n"
+        "🤖 Название: StarShop\n"
+        "💰 Цена: 1.35 ₽ за звезду\n"
+        "📞 Поддержка: @StarShopsup"
+    )
+    
+    safe_edit_message(
+        chat_id=call.message.chat.id,
+        message_id=call.message.message_id,
+        text=info_text,
+        reply_markup=create_info_keyboard()
+    )
+
+
+@callback_router.route("purchase_history", prefix="purchase_history_page_")
+def callback_purchase_history(call: CallbackQuery, user_id: str, user_data=None):
+    # Показываем историю покупок постранично (читаем из журнала только нужную страницу)
+    page = 0
+    if call.data.startswith("purchase_history_page_"):
+        try:
+            page = max(0, int(call.data.replace("purchase_history_page_", "")))
+        except ValueError:
+            page = 0
+    
+    total_purchases = user_store.count_purchases(user_id)
+    total_pages = max(1, (total_purchases + PURCHASE_HISTORY_PAGE_SIZE - 1) // PURCHASE_HISTORY_PAGE_SIZE)
+    page = min(page, total_pages - 1)
+    purchases = user_store.get_purchases_page(user_id, page, PURCHASE_HISTORY_PAGE_SIZE)
+    
+    if not purchases:
+        history_text = "📋 История покупок пуста"
+        reply_markup = create_profile_keyboard()
+    else:
+        history_text = f"📋 История покупок (стр. {page + 1}/{total_pages}):\n\n"
+        for purchase in purchases:
+            history_text += (
+                f"🆔 #{purchase['id']} | {purchase['date']}\n"
+                f"⭐️ {purchase['stars']} звезд | 💰 {purchase['cost']:.2f} ₽\n"
+                f"👤 {purchase['recipient']} | {purchase['status']}\n\n"
+            )
+        reply_markup = create_purchase_history_keyboard(page, total_pages)
+    
+    safe_edit_message(
+        chat_id=call.message.chat.id,
+        message_id=call.message.message_id,
+        text=history_text,
+        reply_markup=reply_markup
+    )
+
+
+@callback_router.route(prefix="check_ton_payment_")
+def callback_check_ton_payment_id(call: CallbackQuery, user_id: str, user_data=None):
+    # Проверяем TON платеж
+    payment_id = call.data.replace("check_ton_payment_", "")
+    user_state = user_states.get(user_id, {})
+    
+    if user_state.get("payment_method") == "ton" and user_state.get("payment_id") == payment_id:
+        # Проверяем платеж через TON API
+        if ton_payment:
+            try:
+                result = ton_payment.check_ton_transaction(payment_id, user_state.get("comment"))
+                
+                if result.get("status") == "approved":
+                    # Платеж подтвержден
+                    amount_ton = result.get("amount", 0)
+                    amount_rub = ton_payment.ton_to_rubles(amount_ton)
                     
-                    if result.get("status") == "approved":
-                        # Платеж подтвержден
-                        amount_ton = result.get("amount", 0)
-                        amount_rub = ton_payment.ton_to_rubles(amount_ton)
-                        
-                        # Пополняем баланс пользователя
-                        user_data = users_data.get(user_id, {})
-                        user_data = update_user_structure(user_data, user_id)
-                        user_data['balance'] = user_data.get('balance', 0) + amount_rub
-                        users_data[user_id] = user_data
-                        save_users_data(users_data)
-                        
-                        # Отправляем лог о пополнении в техподдержку
-                        asyncio.run(log_balance_topup(
-                            user_id=user_id,
-                            username=user_data.get('username', 'Unknown'),
-                            amount=amount_rub,
-                            payment_method="TON (автопополнение)",
-                            success=True
-                        ))
-                        
-                        # Проверяем, есть ли информация о первоначальной покупке
-                        original_purchase = user_state.get("original_purchase")
+                    # Пополняем баланс пользователя
+                    user_data = credit_payment_once(user_id, amount_rub, payment_id, method="TON")
+                    if user_data is None:
+                        bot.answer_callback_query(call.id, "✅ Платеж уже зачислен")
+                        return
+                    
+                    # Отправляем лог о пополнении в техподдержку
+                    spawn(log_balance_topup(
+                        user_id=user_id,
+                        username=user_data.username or 'Unknown',
+                        amount=amount_rub,
+                        payment_method="TON (автопополнение)",
+                        success=True
+                    ))
+                    
+                    # Проверяем, есть ли информация о первоначальной покупке
+                    original_purchase = user_state.get("original_purchase")
+                    
+                    if original_purchase:
+                        # Это пополнение из-за недостаточного баланса для покупки звезд
+                        # Продолжаем покупку звезд
+                        stars_amount = original_purchase.get("stars_amount")
+                        cost = original_purchase.get("cost")
                         
-                        if original_purchase:
-                            # Это пополнение из-за недостаточного баланса для покупки звезд
-                            # Продолжаем покупку звезд
-                            stars_amount = original_purchase.get("stars_amount")
-                            cost = original_purchase.get("cost")
+                        # Проверяем, что баланса теперь достаточно
+                        if user_data.balance >= cost:
+                            # Устанавливаем состояние для продолжения покупки
+                            user_states[user_id] = {
+                                "state": "waiting_recipient_username",
+                                "stars_amount": stars_amount,
+                                "cost": cost
+                            }
+                            
+                            success_text = (
+                                f"✅ Платеж подтвержден!\n\n"
+                                f"💰 Получено: {amount_ton:.4f} TON ({amount_rub:.2f} ₽)\n"
+                                f"💳 Новый баланс: {user_data.balance:.2f} ₽\n\n"
+                                f"🎉 Баланс пополнен! Продолжаем покупку {stars_amount} звезд.\n\n"
+                                f"👤 Введите username получателя (например: @username):"
+                            )
                             
-                            # Проверяем, что баланса теперь достаточно
-                            if user_data.get('balance', 0) >= cost:
-                                # Устанавливаем состояние для продолжения покупки
-                                user_states[user_id] = {
-                                    "state": "waiting_recipient_username",
-                                    "stars_amount": stars_amount,
-                                    "cost": cost
-                                }
-                                
-                                success_text = (
-                                    f"✅ Платеж подтвержден!\n\n"
-                                    f"💰 Получено: {amount_ton:.4f} TON ({amount_rub:.2f} ₽)\n"
-                                    f"💳 Новый баланс: {user_data['balance']:.2f} ₽\n\n"
-                                    f"🎉 Баланс пополнен! Продолжаем покупку {stars_amount} звезд.\n\n"
-                                    f"👤 Введите username получателя (например: @username):"
-                                )
-                                
-                                safe_edit_message(
-                                    chat_id=call.message.chat.id,
-                                    message_id=call.message.message_id,
-                                    text=success_text,
-                                    reply_markup=create_cancel_keyboard()
-                                )
-                            else:
-                                # Баланса все еще недостаточно
-                                user_states.pop(user_id, None)
-                                
-                                success_text = (
-                                    f"✅ Платеж подтвержден!\n\n"
-                                    f"💰 Получено: {amount_ton:.4f} TON ({amount_rub:.2f} ₽)\n"
-                                    f"💳 Новый баланс: {user_data['balance']:.2f} ₽\n\n"
-                                    f"⚠️ Баланса все еще недостаточно для покупки {stars_amount} звезд ({cost:.2f} ₽)\n"
-                                    f"💸 Не хватает: {cost - user_data['balance']:.2f} ₽"
-                                )
-                                
-                                safe_edit_message(
-                                    chat_id=call.message.chat.id,
-                                    message_id=call.message.message_id,
-                                    text=success_text,
-                                    reply_markup=create_main_menu()
-                                )
+                            safe_edit_message(
+                                chat_id=call.message.chat.id,
+                                message_id=call.message.message_id,
+                                text=success_text,
+                                reply_markup=create_cancel_keyboard()
+                            )
                         else:
-                            # Обычное пополнение баланса
+                            # Баланса все еще недостаточно
                             user_states.pop(user_id, None)
                             
                             success_text = (
                                 f"✅ Платеж подтвержден!\n\n"
                                 f"💰 Получено: {amount_ton:.4f} TON ({amount_rub:.2f} ₽)\n"
-                                f"💳 Новый баланс: {user_data['balance']:.2f} ₽\n\n"
-                                f"🎉 Баланс успешно пополнен!"
+                                f"💳 Новый баланс: {user_data.balance:.2f} ₽\n\n"
+                                f"⚠️ Баланса все еще недостаточно для покупки {stars_amount} звезд ({cost:.2f} ₽)\n"
+                                f"💸 Не хватает: {cost - user_data.balance:.2f} ₽"
                             )
                             
                             safe_edit_message(
@@ -1326,67 +1654,36 @@ def handle_callback(call: CallbackQuery):
                                 text=success_text,
                                 reply_markup=create_main_menu()
                             )
-                        
-                    elif result.get("status") == "pending":
-                        # Платеж еще не поступил
-                        pending_text = (
-                            f"⏳ TON платеж обрабатывается...\n\n"
-                            f"💰 Сумма: {user_state.get('amount', 0):.2f} ₽\n"
-                            f"🆔 ID заказа: {payment_id}\n\n"
-                            f"💸 Сумма к отправке: {user_state.get('amount_ton', 0):.4f} TON\n"
-                            f"💳 Адрес для оплаты: <code>{user_state.get('wallet_address', '')}</code>\n"
-                            f"⚠️ Комментарий: <code>{user_state.get('comment', '')}</code>\n\n"
-                            f"‼️ Обязательно указывайте комментарий при отправке монет!\n\n"
-                            f"Попробуйте проверить еще раз через несколько минут."
-                        )
-                        
-                        # Создаем клавиатуру с кнопкой повторной проверки
-                        keyboard = InlineKeyboardMarkup()
-                        keyboard.add(
-                            InlineKeyboardButton("🔍 Проверить снова", callback_data=f"check_ton_payment_{payment_id}")
-                        )
-                        keyboard.add(
-                            InlineKeyboardButton("❌ Отменить", callback_data="cancel")
-                        )
-                        
-                        safe_edit_message(
-                            chat_id=call.message.chat.id,
-                            message_id=call.message.message_id,
-                            text=pending_text,
-                            reply_markup=keyboard
-                        )
-                        
                     else:
-                        # Ошибка проверки
-                        error_text = (
-                            f"⏳ TON платеж обрабатывается...\n\n"
-                            f"💰 Сумма: {user_state.get('amount', 0):.2f} ₽\n"
-                            f"🆔 ID заказа: {payment_id}\n\n"
-                            f"💸 Сумма к отправке: {user_state.get('amount_ton', 0):.4f} TON\n"
-                            f"💳 Адрес для оплаты: <code>{user_state.get('wallet_address', '')}</code>\n"
-                            f"⚠️ Комментарий: <code>{user_state.get('comment', '')}</code>\n\n"
-                            f"‼️ Обязательно указывайте комментарий при отправке монет!\n\n"
-                            f"Попробуйте проверить еще раз через несколько минут."
-                        )
+                        # Обычное пополнение баланса
+                        user_states.pop(user_id, None)
                         
-                        # Создаем клавиатуру с кнопкой повторной проверки
-                        keyboard = InlineKeyboardMarkup()
-                        keyboard.add(
-                            InlineKeyboardButton("🔍 Проверить снова", callback_data=f"check_ton_payment_{payment_id}")
-                        )
-                        keyboard.add(
-                            InlineKeyboardButton("❌ Отменить", callback_data="cancel")
+                        success_text = (
+                            f"✅ Платеж подтвержден!\n\n"
+                            f"💰 Получено: {amount_ton:.4f} TON ({amount_rub:.2f} ₽)\n"
+                            f"💳 Новый баланс: {user_data.balance:.2f} ₽\n\n"
+                            f"🎉 Баланс успешно пополнен!"
                         )
                         
                         safe_edit_message(
                             chat_id=call.message.chat.id,
                             message_id=call.message.message_id,
-                            text=error_text,
-                            reply_markup=keyboard
+                            text=success_text,
+                            reply_markup=create_main_menu()
                         )
-                        
-                except Exception as e:
-                    logging.error(f"Ошибка проверки TON платежа: {e}")
+                    
+                elif result.get("status") == "pending":
+                    # Платеж еще не поступил
+                    pending_text = (
+                        f"⏳ TON платеж обрабатывается...\n\n"
+                        f"💰 Сумма: {user_state.get('amount', 0):.2f} ₽\n"
+                        f"🆔 ID заказа: {payment_id}\n\n"
+                        f"💸 Сумма к отправке: {user_state.get('amount_ton', 0):.4f} TON\n"
+                        f"💳 Адрес для оплаты: <code>{user_state.get('wallet_address', '')}</code>\n"
+                        f"⚠️ Комментарий: <code>{user_state.get('comment', '')}</code>\n\n"
+                        f"‼️ Обязательно указывайте комментарий при отправке монет!\n\n"
+                        f"Попробуйте проверить еще раз через несколько минут."
+                    )
                     
                     # Создаем клавиатуру с кнопкой повторной проверки
                     keyboard = InlineKeyboardMarkup()
@@ -1397,6 +1694,15 @@ def handle_callback(call: CallbackQuery):
                         InlineKeyboardButton("❌ Отменить", callback_data="cancel")
                     )
                     
+                    safe_edit_message(
+                        chat_id=call.message.chat.id,
+                        message_id=call.message.message_id,
+                        text=pending_text,
+                        reply_markup=keyboard
+                    )
+                    
+                else:
+                    # Ошибка проверки
                     error_text = (
                         f"⏳ TON платеж обрабатывается...\n\n"
                         f"💰 Сумма: {user_state.get('amount', 0):.2f} ₽\n"
@@ -1408,475 +1714,356 @@ def handle_callback(call: CallbackQuery):
                         f"Попробуйте проверить еще раз через несколько минут."
                     )
                     
+                    # Создаем клавиатуру с кнопкой повторной проверки
+                    keyboard = InlineKeyboardMarkup()
+                    keyboard.add(
+                        InlineKeyboardButton("🔍 Проверить снова", callback_data=f"check_ton_payment_{payment_id}")
+                    )
+                    keyboard.add(
+                        InlineKeyboardButton("❌ Отменить", callback_data="cancel")
+                    )
+                    
                     safe_edit_message(
                         chat_id=call.message.chat.id,
                         message_id=call.message.message_id,
                         text=error_text,
                         reply_markup=keyboard
                     )
-            else:
+                    
+            except Exception as e:
+                logging.error(f"Ошибка проверки TON платежа: {e}")
+                
+                # Создаем клавиатуру с кнопкой повторной проверки
+                keyboard = InlineKeyboardMarkup()
+                keyboard.add(
+                    InlineKeyboardButton("🔍 Проверить снова", callback_data=f"check_ton_payment_{payment_id}")
+                )
+                keyboard.add(
+                    InlineKeyboardButton("❌ Отменить", callback_data="cancel")
+                )
+                
+                error_text = (
+                    f"⏳ TON платеж обрабатывается...\n\n"
+                    f"💰 Сумма: {user_state.get('amount', 0):.2f} ₽\n"
+                    f"🆔 ID заказа: {payment_id}\n\n"
+                    f"💸 Сумма к отправке: {user_state.get('amount_ton', 0):.4f} TON\n"
+                    f"💳 Адрес для оплаты: <code>{user_state.get('wallet_address', '')}</code>\n"
+                    f"⚠️ Комментарий: <code>{user_state.get('comment', '')}</code>\n\n"
+                    f"‼️ Обязательно указывайте комментарий при отправке монет!\n\n"
+                    f"Попробуйте проверить еще раз через несколько минут."
+                )
+                
                 safe_edit_message(
                     chat_id=call.message.chat.id,
                     message_id=call.message.message_id,
-                    text="❌ TON платежи временно недоступны",
-                    reply_markup=create_cancel_keyboard()
+                    text=error_text,
+                    reply_markup=keyboard
                 )
         else:
             safe_edit_message(
                 chat_id=call.message.chat.id,
                 message_id=call.message.message_id,
-                text="❌ Платеж не найден или истек",
+                text="❌ TON платежи временно недоступны",
                 reply_markup=create_cancel_keyboard()
             )
-
-        
-    elif call.data == "cancel":
-        # Отменяем текущее действие и возвращаемся в главное меню
-        user_states.pop(user_id, None)
-        
-        # Получаем баланс пользователя
-        user_data = users_data.get(user_id, {})
-        user_data = update_user_structure(user_data, user_id)
-        user_balance = user_data.get('balance', 0)
-        
-        main_menu_text = create_main_menu_text(user_balance)
-        
-        # Отправляем фото с главным меню
-        send_photo_with_text(
-            chat_id=call.message.chat.id,
-            text=main_menu_text,
-            photo_path="старт.jpeg",
-            reply_markup=create_main_menu()
-        )
-        
-    elif call.data == "back_main":
-        # Возвращаемся в главное меню
-        user_states.pop(user_id, None)
-        
-        # Получаем баланс пользователя
-        user_data = users_data.get(user_id, {})
-        user_data = update_user_structure(user_data, user_id)
-        user_balance = user_data.get('balance', 0)
-        
-        main_menu_text = create_main_menu_text(user_balance)
-        
-        # Отправляем фото с главным меню
-        send_photo_with_text(
+    else:
+        safe_edit_message(
             chat_id=call.message.chat.id,
-            text=main_menu_text,
-            photo_path="старт.jpeg",
-            reply_markup=create_main_menu()
+            message_id=call.message.message_id,
+            text="❌ Платеж не найден или истек",
+            reply_markup=create_cancel_keyboard()
         )
-        
-    elif call.data == "recipient_self":
-        # Покупаем звезды себе
-        user_data = users_data.get(user_id, {})
-        user_data = update_user_structure(user_data, user_id)
-        
-        stars_amount = user_states.get(user_id, {}).get('stars_amount', 0)
-        
-        if stars_amount == 0:
-            bot.answer_callback_query(call.id, "❌ Ошибка: количество звезд не указано")
-            return
-        
-        # Проверяем баланс
-        cost = stars_amount * STAR_PRICE  # 1.35 ₽ за звезду
-        if user_data.get('balance', 0) < cost:
-            bot.answer_callback_query(call.id, f"❌ Недостаточно средств. Нужно: {cost:.2f} ₽")
-            return
-        
-        # Автоматически подставляем СВОЙ юзернейм
-        recipient = user_data['username']
-        
-        # Сохраняем в общий state confirm_purchase
-        user_states[user_id] = {
-            "state": "confirm_purchase",
-            "stars_amount": stars_amount,
-            "cost": cost,
-            "recipient": recipient
-        }
-        
-        # Логируем сохранение состояния для отладки
-        logging.info(f"✅ Состояние сохранено для пользователя {user_id}: {user_states[user_id]}")
-        
-        # Показываем подтверждение покупки
-        confirm_text = (
-            f"📋 Подтверждение покупки:\n\n"
-            f"👤 Получатель: @{recipient}\n"
-            f"⭐ Количество: {stars_amount} звезд\n"
-            f"💰 Стоимость: {cost:.2f} ₽\n\n"
-            f"🔐 Отправить транзакцию?"
-        )
-        safe_edit_message(
-            chat_id=call.message.chat.id,
-            message_id=call.message.message_id,
-            text=confirm_text,
-            reply_markup=create_confirm_purchase_keyboard()
-        )
-        
-    elif call.data == "confirm_purchase":
-        user_data = users_data.get(user_id, {})
-        user_data = update_user_structure(user_data, user_id)
-        purchase_data = user_states.get(user_id, {})
 
-        if not purchase_data or purchase_data.get("state") != "confirm_purchase":
-            bot.answer_callback_query(call.id, "❌ Сессия устарела")
-            safe_edit_message(
-                chat_id=call.message.chat.id,
-                message_id=call.message.message_id,
-                text="❌ Сессия устарела. Начните сначала.",
-                reply_markup=create_main_menu()
-            )
-            user_states.pop(user_id, None)
-            return
 
-        stars_amount = purchase_data["stars_amount"]
-        cost = purchase_data["cost"]
-        recipient = purchase_data["recipient"]
+@callback_router.route("cancel", needs_user=True)
+def callback_cancel(call: CallbackQuery, user_id: str, user_data=None):
+    # Отменяем текущее действие и возвращаемся в главное меню
+    user_states.pop(user_id, None)
+    
+    # Получаем баланс пользователя
+    user_balance = user_data.balance
+    
+    main_menu_text = create_main_menu_text(user_balance)
+    
+    # Отправляем фото с главным меню
+    send_photo_with_text(
+        chat_id=call.message.chat.id,
+        text=main_menu_text,
+        photo_path="старт.jpeg",
+        reply_markup=create_main_menu()
+    )
 
-        # Проверяем существование username ещё раз
-        username_exists, error_message = check_username_exists(recipient)
-        if not username_exists:
-            bot.answer_callback_query(call.id, f"❌ {error_message}")
-            error_text = (
-                f"❌ {error_message}\n\n"
-                f"Проверьте правильность написания username и попробуйте снова."
-            )
-            safe_edit_message(
-                chat_id=call.message.chat.id,
-                message_id=call.message.message_id,
-                text=error_text,
-                reply_markup=create_back_keyboard()
-            )
-            user_states.pop(user_id, None)
-            return
 
-        # Проверка баланса (ещё раз)
-        if user_data.get('balance', 0) < cost:
-            bot.answer_callback_query(call.id, f"❌ Недостаточно средств")
-            balance_error_text = f"❌ Недостаточно средств. Нужно: {cost:.2f} ₽"
-            safe_edit_message(
-                chat_id=call.message.chat.id,
-                message_id=call.message.message_id,
-                text=balance_error_text,
-                reply_markup=create_back_keyboard()
-            )
-            user_states.pop(user_id, None)
-            return
+@callback_router.route("back_main", needs_user=True)
+def callback_back_main(call: CallbackQuery, user_id: str, user_data=None):
+    # Возвращаемся в главное меню
+    user_states.pop(user_id, None)
+    
+    # Получаем баланс пользователя
+    user_balance = user_data.balance
+    
+    main_menu_text = create_main_menu_text(user_balance)
+    
+    # Отправляем фото с главным меню
+    send_photo_with_text(
+        chat_id=call.message.chat.id,
+        text=main_menu_text,
+        photo_path="старт.jpeg",
+        reply_markup=create_main_menu()
+    )
 
-        # Загрузка мнемоники из config.py
-        try:
-            from config import WALLET_MNEMONICS, WALLET_ADDRESS
-            mnemonics = WALLET_MNEMONICS
-            wallet_address = WALLET_ADDRESS
-            logging.info(f"✅ Кошелек загружен: {wallet_address}")
-        except Exception as e:
-            logging.error(f"Ошибка загрузки кошелька: {e}")
-            wallet_error_text = f"❌ Ошибка загрузки кошелька: {e}"
-            safe_edit_message(
-                chat_id=call.message.chat.id,
-                message_id=call.message.message_id,
-                text=wallet_error_text,
-                reply_markup=create_back_keyboard()
-            )
-            user_states.pop(user_id, None)
-            return
 
-        # Отправка транзакции
-        sending_text = f"🚀 Отправляем {stars_amount} звёзд пользователю @{recipient}..."
+@callback_router.route("recipient_self", needs_user=True)
+def callback_recipient_self(call: CallbackQuery, user_id: str, user_data=None):
+    # Покупаем звезды себе
+    
+    stars_amount = user_states.get(user_id, {}).get('stars_amount', 0)
+    
+    if stars_amount == 0:
+        bot.answer_callback_query(call.id, "❌ Ошибка: количество звезд не указано")
+        return
+    
+    # Проверяем баланс
+    cost = stars_amount * STAR_PRICE  # 1.35 ₽ за звезду
+    if user_data.balance < cost:
+        bot.answer_callback_query(call.id, f"❌ Недостаточно средств. Нужно: {cost:.2f} ₽")
+        return
+    
+    # Автоматически подставляем СВОЙ юзернейм
+    recipient = user_data.username
+    
+    # Сохраняем в общий state confirm_purchase
+    user_states[user_id] = {
+        "state": "confirm_purchase",
+        "stars_amount": stars_amount,
+        "cost": cost,
+        "recipient": recipient
+    }
+    
+    # Логируем сохранение состояния для отладки
+    logging.info(f"✅ Состояние сохранено для пользователя {user_id}: {user_states[user_id]}")
+    
+    # Показываем подтверждение покупки
+    confirm_text = (
+        f"📋 Подтверждение покупки:\n\n"
+        f"👤 Получатель: @{recipient}\n"
+        f"⭐ Количество: {stars_amount} звезд\n"
+        f"💰 Стоимость: {cost:.2f} ₽\n\n"
+        f"🔐 Отправить транзакцию?"
+    )
+    safe_edit_message(
+        chat_id=call.message.chat.id,
+        message_id=call.message.message_id,
+        text=confirm_text,
+        reply_markup=create_confirm_purchase_keyboard()
+    )
+
+
+# Покупка звезд после подтверждения: холд на сумму, отправка через Fragment,
+# затем списание холда (звезды отправлены) или его снятие (не отправлены) и уведомления
+def process_stars_purchase(call, user_id, user_data, stars_amount, cost, recipient):
+    # Резервируем сумму до обращения к Fragment, чтобы параллельные покупки не списали её дважды
+    hold_id = balance_manager.reserve(user_id, cost)
+    if hold_id is None:
+        bot.answer_callback_query(call.id, f"❌ Недостаточно средств")
+        balance_error_text = f"❌ Недостаточно средств. Нужно: {cost:.2f} ₽"
         safe_edit_message(
             chat_id=call.message.chat.id,
             message_id=call.message.message_id,
-            text=sending_text,
-            reply_markup=None
+            text=balance_error_text,
+            reply_markup=create_back_keyboard()
         )
+        user_states.pop(user_id, None)
+        return
 
-        try:
-            result = asyncio.run(
-                buy_stars(
-                    recipient=recipient,
-                    amount=stars_amount,
-                    mnemonics=mnemonics,
-                    version='v4r2',
-                    testnet=False,
-                    send_mode=1,
-                    test_mode=False
-                )
-            )
-            logging.info(f"📊 Результат покупки: {result}")
-
-            # Проверяем результат более детально
-            success = False
-            if isinstance(result, bool):
-                success = result
-            elif isinstance(result, dict):
-                success = result.get('success', False)
-            else:
-                success = bool(result)
-            
-            if success:
-                # Успешно
-                user_data['balance'] -= cost
-                user_data['stars_bought'] += stars_amount
-                user_data['total_spent'] += cost
-                user_data['purchases'].append({
-                    "id": len(user_data['purchases']) + 1,
-                    "date": datetime.now().strftime("%d.%m.%Y %H:%M"),
-                    "stars": stars_amount,
-                    "cost": cost,
-                    "recipient": f"@{recipient}",
-                    "status": "completed"
-                })
-                users_data[user_id] = user_data
-                
-                # Обновляем статистику рефералов
-                update_referral_stats(user_id, users_data)
-                
-                save_users_data(users_data)
+    # Загрузка мнемоники из config.py
+    try:
+        from config import WALLET_MNEMONICS, WALLET_ADDRESS
+        mnemonics = WALLET_MNEMONICS
+        wallet_address = WALLET_ADDRESS
+        logging.info(f"✅ Кошелек загружен: {wallet_address}")
+    except Exception as e:
+        logging.error(f"Ошибка загрузки кошелька: {e}")
+        balance_manager.release(hold_id)
+        wallet_error_text = f"❌ Ошибка загрузки кошелька: {e}"
+        safe_edit_message(
+            chat_id=call.message.chat.id,
+            message_id=call.message.message_id,
+            text=wallet_error_text,
+            reply_markup=create_back_keyboard()
+        )
+        user_states.pop(user_id, None)
+        return
 
-                # Отправляем лог о покупке в техподдержку
-                asyncio.run(log_stars_purchase(
-                    user_id=user_id,
-                    username=user_data.get('username', 'Unknown'),
-                    stars_amount=stars_amount,
-                    cost=cost,
-                    recipient=recipient,
-                    success=True
-                ))
+    # Отправка транзакции
+    sending_text = f"🚀 Отправляем {stars_amount} звёзд пользователю @{recipient}..."
+    safe_edit_message(
+        chat_id=call.message.chat.id,
+        message_id=call.message.message_id,
+        text=sending_text,
+        reply_markup=None
+    )
 
-                # Отправляем изображение чек.jpeg с сообщением об успешной покупке
-                success_text = (
-                    f"✅ Успешно! {stars_amount} звёзд отправлены пользователю @{recipient}\n"
-                    f"💸 Списано: {cost:.2f} ₽"
-                )
-                send_photo_with_text(
+    purchased = False
+    try:
+        result = run_coro(
+            buy_stars(
+                recipient=recipient,
+                amount=stars_amount,
+                mnemonics=mnemonics,
+                version='v4r2',
+                testnet=False,
+                send_mode=1,
+                test_mode=False
+            )
+        )
+        logging.info(f"📊 Результат покупки: {result}")
+        purchased = purchase_succeeded(result)
+
+        if not purchased:
+            # Получаем детальную информацию об ошибке
+            error_details = purchase_error(result)
+            
+            # Отправляем лог об ошибке покупки в техподдержку
+            spawn(log_stars_purchase(
+                user_id=user_id,
+                username=user_data.username or 'Unknown',
+                stars_amount=stars_amount,
+                cost=cost,
+                recipient=recipient,
+                success=False,
+                error_message=error_details
+            ))
+            
+            # Проверяем, является ли ошибка связанной с невалидным username
+            if isinstance(result, dict) and "username" in error_details.lower():
+                # Показываем сообщение о невалидном username
+                safe_edit_message(
                     chat_id=call.message.chat.id,
-                    text=success_text,
-                    photo_path="чек.jpeg",
-                    reply_markup=create_back_keyboard(),
-                    message_id=call.message.message_id
+                    message_id=call.message.message_id,
+                    text="❌ Некорректный username получателя. Проверьте правильность написания.",
+                    reply_markup=create_back_keyboard()
                 )
             else:
-                # Получаем детальную информацию об ошибке
-                error_details = "Неизвестная ошибка"
-                if isinstance(result, dict):
-                    error_details = result.get('error', result.get('message', 'Неизвестная ошибка'))
-                elif isinstance(result, str):
-                    error_details = result
-                
-                # Отправляем лог об ошибке покупки в техподдержку
-                asyncio.run(log_stars_purchase(
-                    user_id=user_id,
-                    username=user_data.get('username', 'Unknown'),
-                    stars_amount=stars_amount,
-                    cost=cost,
-                    recipient=recipient,
-                    success=False,
-                    error_message=error_details
-                ))
-                
-                # Проверяем, является ли ошибка связанной с невалидным username
-                if isinstance(result, dict) and "username" in error_details.lower():
-                    # Показываем сообщение о невалидном username
-                    safe_edit_message(
-                        chat_id=call.message.chat.id,
-                        message_id=call.message.message_id,
-                        text="❌ Некорректный username получателя. Проверьте правильность написания.",
-                        reply_markup=create_back_keyboard()
-                    )
-                else:
-                    # Показываем простое сообщение пользователю
-                    safe_edit_message(
-                        chat_id=call.message.chat.id,
-                        message_id=call.message.message_id,
-                        text="Проблема на нашей стороне. Обратитесь в техническую поддержку @StarShopsup",
-                        reply_markup=create_back_keyboard()
-                    )
-        except Exception as e:
-            logging.error(f"Ошибка при покупке: {e}")
-            
-            # Отправляем детальное сообщение админу
-            support_message = (
-                f"⚠️ Ошибка покупки звезд!\n"
-                f"Пользователь ID: {user_id}\n"
-                f"Получатель: @{recipient}\n"
-                f"Количество звезд: {stars_amount}\n"
-                f"Стоимость: {cost:.2f} ₽\n"
-                f"Детали ошибки: {str(e)}"
+                # Показываем простое сообщение пользователю
+                safe_edit_message(
+                    chat_id=call.message.chat.id,
+                    message_id=call.message.message_id,
+                    text="Проблема на нашей стороне. Обратитесь в техническую поддержку @StarShopsup",
+                    reply_markup=create_back_keyboard()
+                )
+    except Exception as e:
+        logging.error(f"Ошибка при покупке: {e}")
+        
+        # Отправляем детальное сообщение админу
+        support_message = (
+            f"⚠️ Ошибка покупки звезд!\n"
+            f"Пользователь ID: {user_id}\n"
+            f"Получатель: @{recipient}\n"
+            f"Количество звезд: {stars_amount}\n"
+            f"Стоимость: {cost:.2f} ₽\n"
+            f"Детали ошибки: {str(e)}"
+        )
+        send_to_support(support_message)
+        
+        # Показываем простое сообщение пользователю
+        safe_edit_message(
+            chat_id=call.message.chat.id,
+            message_id=call.message.message_id,
+            text="Проблема на нашей стороне. Обратитесь в техническую поддержку @StarShopsup",
+            reply_markup=create_back_keyboard()
+        )
+    finally:
+        # Звезды не отправлены - снимаем холд; после отправки холд снимает только commit
+        if not purchased:
+            balance_manager.release(hold_id)
+
+    if purchased:
+        # Звезды уже отправлены: дальнейшие ошибки не означают неудачную покупку
+        commit_purchase(hold_id, user_id, stars_amount, cost, recipient)
+        try:
+            # Отправляем изображение чек.jpeg с сообщением об успешной покупке
+            success_text = (
+                f"✅ Успешно! {stars_amount} звёзд отправлены пользователю @{recipient}\n"
+                f"💸 Списано: {cost:.2f} ₽"
             )
-            send_to_support(support_message)
-            
-            # Показываем простое сообщение пользователю
-            safe_edit_message(
+            send_photo_with_text(
                 chat_id=call.message.chat.id,
-                message_id=call.message.message_id,
-                text="Проблема на нашей стороне. Обратитесь в техническую поддержку @StarShopsup",
-                reply_markup=create_back_keyboard()
+                text=success_text,
+                photo_path="чек.jpeg",
+                reply_markup=create_back_keyboard(),
+                message_id=call.message.message_id
             )
 
+            user_data = get_user_data(user_id)
+            
+            # Обновляем статистику рефералов
+            update_referral_stats(user_id, user_data)
+
+            # Отправляем лог о покупке в техподдержку
+            spawn(log_stars_purchase(
+                user_id=user_id,
+                username=user_data.username or 'Unknown',
+                stars_amount=stars_amount,
+                cost=cost,
+                recipient=recipient,
+                success=True
+            ))
+        except Exception as e:
+            logging.error(f"❌ Ошибка после успешной покупки {stars_amount} звезд для @{recipient}: {e}", exc_info=True)
+
+    user_states.pop(user_id, None)
+
+
+@callback_router.route("confirm_purchase", needs_user=True)
+def callback_confirm_purchase(call: CallbackQuery, user_id: str, user_data=None):
+    purchase_data = user_states.get(user_id, {})
+
+    if not purchase_data or purchase_data.get("state") != "confirm_purchase":
+        bot.answer_callback_query(call.id, "❌ Сессия устарела")
+        safe_edit_message(
+            chat_id=call.message.chat.id,
+            message_id=call.message.message_id,
+            text="❌ Сессия устарела. Начните сначала.",
+            reply_markup=create_main_menu()
+        )
         user_states.pop(user_id, None)
+        return
 
-    elif call.data == "check_payment":
-        # Проверяем статус платежа
-        payment_data = user_states.get(user_id, {})
-        if payment_data.get("state") == "payment_created":
-            order_id = payment_data.get("order_id")
-            amount = payment_data.get("amount")
-            
-            try:
-                # Проверяем статус заказа
-                if not APAYS_ENABLED or not apays:
-                    safe_edit_message(
-                        chat_id=call.message.chat.id,
-                        message_id=call.message.message_id,
-                        text="❌ APays временно недоступен",
-                        reply_markup=create_back_keyboard()
-                    )
-                    return
-                
-                status_result = apays.get_order_status(order_id)
-                
-                if status_result.get('status') and status_result.get('order_status'):
-                    order_status = status_result['order_status']
-                    
-                    if order_status == 'approve':
-                        # Платеж успешен - пополняем баланс
-                        user_data = users_data.get(user_id, {})
-                        user_data = update_user_structure(user_data, user_id)
-                        
-                        user_data['balance'] += amount
-                        users_data[user_id] = user_data
-                        
-                        # Обновляем статистику рефералов
-                        update_referral_stats(user_id, users_data)
-                        
-                        save_users_data(users_data)
-                        
-                        # Отправляем лог о пополнении в техподдержку
-                        asyncio.run(log_balance_topup(
-                            user_id=user_id,
-                            username=user_data.get('username', 'Unknown'),
-                            amount=amount,
-                            payment_method="APays",
-                            success=True
-                        ))
-                        
-                        # Очищаем состояние
-                        user_states.pop(user_id, None)
-                        
-                        success_text = (
-                            f"✅ Платеж успешно обработан!\n\n"
-                            f"💰 Пополнено: {amount:.2f} ₽\n"
-                            f"💳 Новый баланс: {user_data['balance']:.2f} ₽\n"
-                            f"🆔 ID заказа: {order_id}"
-                        )
-                        
-                        safe_edit_message(
-                            chat_id=call.message.chat.id,
-                            message_id=call.message.message_id,
-                            text=success_text,
-                            reply_markup=create_back_keyboard()
-                        )
-                        
-                    elif order_status == 'pending':
-                        # Платеж еще обрабатывается
-                        pending_text = (
-                            f"⏳ Платеж обрабатывается...\n\n"
-                            f"💰 Сумма: {amount:.2f} ₽\n"
-                            f"🆔 ID заказа: {order_id}\n\n"
-                            f"Попробуйте проверить еще раз через несколько минут."
-                        )
-                        
-                        # Создаем клавиатуру с кнопкой "Проверить еще раз"
-                        keyboard = InlineKeyboardMarkup()
-                        keyboard.add(InlineKeyboardButton("🔄 Проверить еще раз", callback_data="check_payment"))
-                        keyboard.add(InlineKeyboardButton("❌ Отменить", callback_data="cancel"))
-                        
-                        safe_edit_message(
-                            chat_id=call.message.chat.id,
-                            message_id=call.message.message_id,
-                            text=pending_text,
-                            reply_markup=keyboard
-                        )
-                        
-                    elif order_status == 'decline':
-                        # Платеж отклонен
-                        decline_text = (
-                            f"❌ Платеж отклонен\n\n"
-                            f"💰 Сумма: {amount:.2f} ₽\n"
-                            f"🆔 ID заказа: {order_id}\n\n"
-                            f"Обратитесь в поддержку для уточнения деталей."
-                        )
-                        
-                        safe_edit_message(
-                            chat_id=call.message.chat.id,
-                            message_id=call.message.message_id,
-                            text=decline_text,
-                            reply_markup=create_back_keyboard()
-                        )
-                        
-                        # Очищаем состояние
-                        user_states.pop(user_id, None)
-                        
-                    elif order_status == 'expired':
-                        # Срок платежа истек
-                        expired_text = (
-                            f"⏰ Срок платежа истек\n\n"
-                            f"💰 Сумма: {amount:.2f} ₽\n"
-                            f"🆔 ID заказа: {order_id}\n\n"
-                            f"Создайте новый заказ для пополнения."
-                        )
-                        
-                        safe_edit_message(
-                            chat_id=call.message.chat.id,
-                            message_id=call.message.message_id,
-                            text=expired_text,
-                            reply_markup=create_back_keyboard()
-                        )
-                        
-                        # Очищаем состояние
-                        user_states.pop(user_id, None)
-                        
-                else:
-                    # Ошибка получения статуса
-                    error_text = "❌ Ошибка проверки статуса платежа. Попробуйте еще раз."
-                    
-                    # Создаем клавиатуру с кнопкой "Проверить еще раз"
-                    keyboard = InlineKeyboardMarkup()
-                    keyboard.add(InlineKeyboardButton("🔄 Проверить еще раз", callback_data="check_payment"))
-                    keyboard.add(InlineKeyboardButton("❌ Отменить", callback_data="cancel"))
-                    
-                    safe_edit_message(
-                        chat_id=call.message.chat.id,
-                        message_id=call.message.message_id,
-                        text=error_text,
-                        reply_markup=keyboard
-                    )
-                    
-            except Exception as e:
-                logging.error(f"Ошибка проверки статуса платежа: {e}")
-                error_text = "❌ Ошибка проверки статуса платежа. Попробуйте еще раз."
-                
-                # Создаем клавиатуру с кнопкой "Проверить еще раз"
-                keyboard = InlineKeyboardMarkup()
-                keyboard.add(InlineKeyboardButton("🔄 Проверить еще раз", callback_data="check_payment"))
-                keyboard.add(InlineKeyboardButton("❌ Отменить", callback_data="cancel"))
-                
-                safe_edit_message(
-                    chat_id=call.message.chat.id,
-                    message_id=call.message.message_id,
-                    text=error_text,
-                    reply_markup=keyboard
-                )
-        else:
-            bot.answer_callback_query(call.id, "❌ Нет активного платежа для проверки")
+    stars_amount = purchase_data["stars_amount"]
+    cost = purchase_data["cost"]
+    recipient = purchase_data["recipient"]
+
+    # Проверяем существование username ещё раз
+    username_exists, error_message = check_username_exists(recipient)
+    if not username_exists:
+        bot.answer_callback_query(call.id, f"❌ {error_message}")
+        error_text = (
+            f"❌ {error_message}\n\n"
+            f"Проверьте правильность написания username и попробуйте снова."
+        )
+        safe_edit_message(
+            chat_id=call.message.chat.id,
+            message_id=call.message.message_id,
+            text=error_text,
+            reply_markup=create_back_keyboard()
+        )
+        user_states.pop(user_id, None)
+        return
 
-    elif call.data == "retry_apays":
-        # Повторная попытка создания APays платежа
-        user_state = user_states.get(user_id, {})
-        if user_state.get("state") == "waiting_payment_confirmation" and user_state.get("payment_method") == "apays":
-            amount = user_state.get("amount")
-            
+    process_stars_purchase(call, user_id, user_data, stars_amount, cost, recipient)
+
+
+@callback_router.route("check_payment")
+def callback_check_payment(call: CallbackQuery, user_id: str, user_data=None):
+    # Проверяем статус платежа
+    payment_data = user_states.get(user_id, {})
+    if payment_data.get("state") == "payment_created":
+        order_id = payment_data.get("order_id")
+        amount = payment_data.get("amount")
+        
+        try:
+            # Проверяем статус заказа
             if not APAYS_ENABLED or not apays:
                 safe_edit_message(
                     chat_id=call.message.chat.id,
@@ -1886,89 +2073,24 @@ def handle_callback(call: CallbackQuery):
                 )
                 return
             
-            # Создаем новый платеж
-            payment_data = apays.create_payment(amount)
-            if payment_data and "payment_url" in payment_data:
-                # Обновляем данные платежа
-                user_states[user_id] = {
-                    "state": "waiting_payment_confirmation",
-                    "payment_method": "apays",
-                    "payment_id": payment_data["payment_id"],
-                    "amount": amount
-                }
-                
-                payment_text = (
-                    f"💳 APays платеж пересоздан\n\n"
-                    f"💰 Сумма: {amount:.2f} ₽\n"
-                    f"🆔 ID платежа: {payment_data['payment_id']}\n\n"
-                    f"🔗 Новая ссылка для оплаты:\n{payment_data['payment_url']}\n\n"
-                    f"⏳ Ожидаем подтверждения платежа...\n\n"
-                    f"⚠️ Если при переходе по ссылке появляется ошибка 'Сервис временно недоступен', попробуйте:\n"
-                    f"• Обновить страницу (F5)\n"
-                    f"• Отключить блокировщик рекламы\n"
-                    f"• Использовать другой браузер\n"
-                    f"• Подождать несколько минут и попробовать снова"
-                )
-                
-                safe_edit_message(
-                    chat_id=call.message.chat.id,
-                    message_id=call.message.message_id,
-                    text=payment_text,
-                    reply_markup=create_apays_payment_keyboard()
-                )
-            else:
-                safe_edit_message(
-                    chat_id=call.message.chat.id,
-                    message_id=call.message.message_id,
-                    text="❌ Ошибка пересоздания платежа APays",
-                    reply_markup=create_back_keyboard()
-                )
-        else:
-            bot.answer_callback_query(call.id, "❌ Нет активного APays платежа для повтора")
-
-    elif call.data == "check_ton_payment":
-        # Проверяем статус TON платежа
-        payment_data = user_states.get(user_id, {})
-        if payment_data.get("state") == "payment_created" and payment_data.get("payment_method") == "ton":
-            order_id = payment_data.get("order_id")
-            amount = payment_data.get("amount")
+            status_result = apays.get_order_status(order_id)
             
-            try:
-                # Получаем ожидаемый комментарий
-                payment_info = payment_data.get("payment_data", {})
-                expected_comment = payment_info.get("comment")
-                
-                # Проверяем статус TON транзакции
-                if not TON_ENABLED or not ton_payment:
-                    safe_edit_message(
-                        chat_id=call.message.chat.id,
-                        message_id=call.message.message_id,
-                        text="❌ TON платежи временно недоступны",
-                        reply_markup=create_back_keyboard()
-                    )
-                    return
+            if status_result.get('status') and status_result.get('order_status'):
+                order_status = status_result['order_status']
                 
-                status_result = ton_payment.check_ton_transaction(order_id, expected_comment)
-                
-                if status_result.get("status") == "approved":
+                if order_status == 'approve':
                     # Платеж успешен - пополняем баланс
-                    user_data = users_data.get(user_id, {})
-                    user_data = update_user_structure(user_data, user_id)
-                    
-                    user_data['balance'] += amount
-                    users_data[user_id] = user_data
+                    user_data = credit_balance(user_id, amount, method="APays", order_id=order_id)
                     
                     # Обновляем статистику рефералов
-                    update_referral_stats(user_id, users_data)
-                    
-                    save_users_data(users_data)
+                    update_referral_stats(user_id, user_data)
                     
                     # Отправляем лог о пополнении в техподдержку
-                    asyncio.run(log_balance_topup(
+                    spawn(log_balance_topup(
                         user_id=user_id,
-                        username=user_data.get('username', 'Unknown'),
+                        username=user_data.username or 'Unknown',
                         amount=amount,
-                        payment_method="TON",
+                        payment_method="APays",
                         success=True
                     ))
                     
@@ -1976,9 +2098,9 @@ def handle_callback(call: CallbackQuery):
                     user_states.pop(user_id, None)
                     
                     success_text = (
-                        f"✅ TON платеж успешно обработан!\n\n"
+                        f"✅ Платеж успешно обработан!\n\n"
                         f"💰 Пополнено: {amount:.2f} ₽\n"
-                        f"💳 Новый баланс: {user_data['balance']:.2f} ₽\n"
+                        f"💳 Новый баланс: {user_data.balance:.2f} ₽\n"
                         f"🆔 ID заказа: {order_id}"
                     )
                     
@@ -1989,26 +2111,18 @@ def handle_callback(call: CallbackQuery):
                         reply_markup=create_back_keyboard()
                     )
                     
-                elif status_result.get("status") == "pending":
-                    # Платеж еще обрабатывается - показываем детали оплаты
-                    ton_amount = payment_info.get("amount_ton", 0)
-                    wallet_address = payment_info.get("wallet_address", "")
-                    comment = payment_info.get("comment", "")
-                    
+                elif order_status == 'pending':
+                    # Платеж еще обрабатывается
                     pending_text = (
-                        f"⏳ TON платеж обрабатывается...\n\n"
+                        f"⏳ Платеж обрабатывается...\n\n"
                         f"💰 Сумма: {amount:.2f} ₽\n"
                         f"🆔 ID заказа: {order_id}\n\n"
-                        f"💸 Сумма к отправке: {ton_amount:.4f} TON\n"
-                        f"💳 Адрес для оплаты: <code>{wallet_address}</code>\n"
-                        f"⚠️ Комментарий: <code>{comment}</code>\n\n"
-                        f"‼️ Обязательно указывайте комментарий при отправке монет!\n\n"
                         f"Попробуйте проверить еще раз через несколько минут."
                     )
                     
                     # Создаем клавиатуру с кнопкой "Проверить еще раз"
                     keyboard = InlineKeyboardMarkup()
-                    keyboard.add(InlineKeyboardButton("🔄 Проверить еще раз", callback_data="check_ton_payment"))
+                    keyboard.add(InlineKeyboardButton("🔄 Проверить еще раз", callback_data="check_payment"))
                     keyboard.add(InlineKeyboardButton("❌ Отменить", callback_data="cancel"))
                     
                     safe_edit_message(
@@ -2018,57 +2132,51 @@ def handle_callback(call: CallbackQuery):
                         reply_markup=keyboard
                     )
                     
-                else:
-                    # Платеж не найден или отклонен - показываем детали оплаты
-                    ton_amount = payment_info.get("amount_ton", 0)
-                    wallet_address = payment_info.get("wallet_address", "")
-                    comment = payment_info.get("comment", "")
-                    
-                    not_found_text = (
-                        f"❌ TON платеж не найден\n\n"
+                elif order_status == 'decline':
+                    # Платеж отклонен
+                    decline_text = (
+                        f"❌ Платеж отклонен\n\n"
                         f"💰 Сумма: {amount:.2f} ₽\n"
                         f"🆔 ID заказа: {order_id}\n\n"
-                        f"💸 Сумма к отправке: {ton_amount:.4f} TON\n"
-                        f"💳 Адрес для оплаты: <code>{wallet_address}</code>\n"
-                        f"⚠️ Комментарий: <code>{comment}</code>\n\n"
-                        f"‼️ Обязательно указывайте комментарий при отправке монет!\n\n"
-                        f"Убедитесь, что вы отправили правильную сумму на указанный адрес."
+                        f"Обратитесь в поддержку для уточнения деталей."
                     )
                     
-                    # Создаем клавиатуру с кнопкой "Проверить еще раз"
-                    keyboard = InlineKeyboardMarkup()
-                    keyboard.add(InlineKeyboardButton("🔄 Проверить еще раз", callback_data="check_ton_payment"))
-                    keyboard.add(InlineKeyboardButton("❌ Отменить", callback_data="cancel"))
+                    safe_edit_message(
+                        chat_id=call.message.chat.id,
+                        message_id=call.message.message_id,
+                        text=decline_text,
+                        reply_markup=create_back_keyboard()
+                    )
+                    
+                    # Очищаем состояние
+                    user_states.pop(user_id, None)
+                    
+                elif order_status == 'expired':
+                    # Срок платежа истек
+                    expired_text = (
+                        f"⏰ Срок платежа истек\n\n"
+                        f"💰 Сумма: {amount:.2f} ₽\n"
+                        f"🆔 ID заказа: {order_id}\n\n"
+                        f"Создайте новый заказ для пополнения."
+                    )
                     
                     safe_edit_message(
                         chat_id=call.message.chat.id,
                         message_id=call.message.message_id,
-                        text=not_found_text,
-                        reply_markup=keyboard
+                        text=expired_text,
+                        reply_markup=create_back_keyboard()
                     )
                     
-            except Exception as e:
-                logging.error(f"Ошибка проверки TON платежа: {e}")
-                
-                # Получаем детали оплаты для отображения
-                payment_info = payment_data.get("payment_data", {})
-                ton_amount = payment_info.get("amount_ton", 0)
-                wallet_address = payment_info.get("wallet_address", "")
-                comment = payment_info.get("comment", "")
-                
-                error_text = (
-                    f"❌ Ошибка проверки TON платежа. Попробуйте еще раз.\n\n"
-                    f"💰 Сумма: {amount:.2f} ₽\n"
-                    f"🆔 ID заказа: {order_id}\n\n"
-                    f"💸 Сумма к отправке: {ton_amount:.4f} TON\n"
-                    f"💳 Адрес для оплаты: <code>{wallet_address}</code>\n"
-                    f"⚠️ Комментарий: <code>{comment}</code>\n\n"
-                    f"‼️ Обязательно указывайте комментарий при отправке монет!"
-                )
+                    # Очищаем состояние
+                    user_states.pop(user_id, None)
+                    
+            else:
+                # Ошибка получения статуса
+                error_text = "❌ Ошибка проверки статуса платежа. Попробуйте еще раз."
                 
                 # Создаем клавиатуру с кнопкой "Проверить еще раз"
                 keyboard = InlineKeyboardMarkup()
-                keyboard.add(InlineKeyboardButton("🔄 Проверить еще раз", callback_data="check_ton_payment"))
+                keyboard.add(InlineKeyboardButton("🔄 Проверить еще раз", callback_data="check_payment"))
                 keyboard.add(InlineKeyboardButton("❌ Отменить", callback_data="cancel"))
                 
                 safe_edit_message(
@@ -2077,440 +2185,97 @@ def handle_callback(call: CallbackQuery):
                     text=error_text,
                     reply_markup=keyboard
                 )
-        else:
-            bot.answer_callback_query(call.id, "❌ Нет активного TON платежа для проверки")
-
-    elif call.data == "confirm_self_purchase":
-        # Покупка звезд себе
-        user_data = users_data.get(user_id, {})
-        user_data = update_user_structure(user_data, user_id)
-        purchase_data = user_states.get(user_id, {})
-        
-        if not purchase_data:
-            bot.answer_callback_query(call.id, "❌ Нет данных о покупке")
-            return
-        
-        stars_amount = purchase_data.get("stars_amount")
-        cost = purchase_data.get("cost")
-        recipient = user_data['username']  # Покупаем себе
-        
-        # Проверяем баланс (ещё раз)
-        if user_data.get('balance', 0) < cost:
-            bot.answer_callback_query(call.id, f"❌ Недостаточно средств")
-            balance_error_text = f"❌ Недостаточно средств. Нужно: {cost:.2f} ₽"
-            safe_edit_message(
-                chat_id=call.message.chat.id,
-                message_id=call.message.message_id,
-                text=balance_error_text,
-                reply_markup=create_back_keyboard()
-            )
-            user_states.pop(user_id, None)
-            return
-
-        # Загрузка мнемоники из config.py
-        try:
-            from config import WALLET_MNEMONICS, WALLET_ADDRESS
-            mnemonics = WALLET_MNEMONICS
-            wallet_address = WALLET_ADDRESS
-            logging.info(f"✅ Кошелек загружен: {wallet_address}")
-        except Exception as e:
-            logging.error(f"Ошибка загрузки кошелька: {e}")
-            wallet_error_text = f"❌ Ошибка загрузки кошелька: {e}"
-            safe_edit_message(
-                chat_id=call.message.chat.id,
-                message_id=call.message.message_id,
-                text=wallet_error_text,
-                reply_markup=create_back_keyboard()
-            )
-            user_states.pop(user_id, None)
-            return
-
-        # Отправка транзакции
-        sending_text = f"🚀 Отправляем {stars_amount} звёзд пользователю @{recipient}..."
-        safe_edit_message(
-            chat_id=call.message.chat.id,
-            message_id=call.message.message_id,
-            text=sending_text,
-            reply_markup=None
-        )
-
-        try:
-            # Покупка звезд
-            result = asyncio.run(buy_stars(
-                recipient=recipient,
-                amount=stars_amount,
-                mnemonics=mnemonics
-            ))
-            
-            if result:
-                # Успешная покупка
-                user_data['balance'] -= cost
-                user_data['stars_bought'] += stars_amount
-                user_data['total_spent'] += cost
-                user_data['purchases'].append({
-                    "id": len(user_data['purchases']) + 1,
-                    "date": datetime.now().strftime("%d.%m.%Y %H:%M"),
-                    "stars": stars_amount,
-                    "cost": cost,
-                    "recipient": f"@{recipient}",
-                    "status": "completed"
-                })
-                users_data[user_id] = user_data
-                
-                # Обновляем статистику рефералов
-                update_referral_stats(user_id, users_data)
-                
-                save_users_data(users_data)
-
-                # Отправляем изображение чек.jpeg с сообщением об успешной покупке
-                success_text = (
-                    f"✅ Успешно! {stars_amount} звёзд отправлены пользователю @{recipient}\n"
-                    f"💸 Списано: {cost:.2f} ₽"
-                )
-                send_photo_with_text(
-                    chat_id=call.message.chat.id,
-                    text=success_text,
-                    photo_path="чек.jpeg",
-                    reply_markup=create_back_keyboard()
-                )
-                
-                # Отправляем лог о покупке в техподдержку
-                asyncio.run(log_stars_purchase(
-                    user_id=user_id,
-                    username=user_data.get('username', 'Unknown'),
-                    stars_amount=stars_amount,
-                    cost=cost,
-                    recipient=recipient,
-                    success=True
-                ))
-                
-            else:
-                # Ошибка покупки
-                error_details = result if isinstance(result, str) else "Неизвестная ошибка"
-                
-                # Проверяем, является ли ошибка связанной с невалидным username
-                if isinstance(result, dict) and "username" in error_details.lower():
-                    # Показываем сообщение о невалидном username
-                    safe_edit_message(
-                        chat_id=call.message.chat.id,
-                        message_id=call.message.message_id,
-                        text="❌ Некорректный username получателя. Проверьте правильность написания.",
-                        reply_markup=create_back_keyboard()
-                    )
-                else:
-                    # Общая ошибка
-                    safe_edit_message(
-                        chat_id=call.message.chat.id,
-                        message_id=call.message.message_id,
-                        text="Проблема на нашей стороне. Обратитесь в техническую поддержку @StarShopsup",
-                        reply_markup=create_back_keyboard()
-                    )
-                
-                # Отправляем лог об ошибке покупки в техподдержку
-                asyncio.run(log_stars_purchase(
-                    user_id=user_id,
-                    username=user_data.get('username', 'Unknown'),
-                    stars_amount=stars_amount,
-                    cost=cost,
-                    recipient=recipient,
-                    success=False,
-                    error_message=error_details
-                ))
-                
-        except Exception as e:
-            logging.error(f"Ошибка покупки звезд: {e}")
-            safe_edit_message(
-                chat_id=call.message.chat.id,
-                message_id=call.message.message_id,
-                text="Проблема на нашей стороне. Обратитесь в техническую поддержку @StarShopsup",
-                reply_markup=create_back_keyboard()
-            )
-        
-        # Очищаем состояние пользователя
-        user_states.pop(user_id, None)
-
-    elif call.data == "referral":
-        # Показываем реферальную программу
-        user_data = users_data.get(user_id, {})
-        user_data = update_user_structure(user_data, user_id)
-        
-        referrals = user_data.get("referrals", [])
-        qualified_referrals = sum(1 for ref in referrals if ref.get("total_spent", 0) >= 500.0)
-        discount = user_data.get("referral_discount", 0.0)
-        
-        if qualified_referrals >= 3:
-            price_text = "1.30 ₽ за звезду"
-            status_text = "🎉 Активирована!"
-        else:
-            price_text = f"{STAR_PRICE:.2f} ₽ за звезду"
-            status_text = f"⏳ Нужно еще {3 - qualified_referrals} рефералов"
-        
-        referral_text = (
-            "🎁 Реферальная программа\n\n"
-            f"📊 Статистика:\n"
-            f"👥 Всего приглашенных: {len(referrals)}\n"
-            f"✅ Квалифицированных: {qualified_referrals}\n"
-            f"💰 Текущая цена: {price_text}\n"
-            f"🎯 Статус программы: {status_text}\n\n"
-            f"📋 Условия участия:\n"
-            f"• Пригласите 3 активных пользователей\n"
-            f"• Каждый должен пополнить баланс на 500+ ₽\n"
-            f"• Получите специальную цену 1.30 ₽ за звезду\n"
-            f"• Стандартная цена: {STAR_PRICE:.2f} ₽ за звезду\n\n"
-            f"🔗 Ваша реферальная ссылка:\n"
-            f"https://t.me/{bot.get_me().username}?start={user_data.get('referral_code', f'ref_{user_id}')}"
-        )
-        
-        safe_edit_message(
-            chat_id=call.message.chat.id,
-            message_id=call.message.message_id,
-            text=referral_text,
-            reply_markup=create_referral_keyboard()
-        )
-        
-    elif call.data == "my_referrals":
-        # Показываем список рефералов
-        user_data = users_data.get(user_id, {})
-        user_data = update_user_structure(user_data, user_id)
-        
-        referrals = user_data.get("referrals", [])
-        if not referrals:
-            referrals_text = "📋 У вас пока нет рефералов\n\nПригласите друзей по вашей реферальной ссылке!"
-        else:
-            referrals_text = "📋 Ваши рефералы:\n\n"
-            for i, referral in enumerate(referrals, 1):
-                status = "✅" if referral.get("total_spent", 0) >= 250.0 else "⏳"
-                referrals_text += (
-                    f"{i}. {status} @{referral.get('username', 'Unknown')}\n"
-                    f"   💰 Потрачено: {referral.get('total_spent', 0):.2f} ₽\n"
-                    f"   ⭐ Звезд: {referral.get('stars_bought', 0)}\n"
-                    f"   📅 Регистрация: {referral.get('registration_date', 'Unknown')}\n\n"
-                )
-        
-        safe_edit_message(
-            chat_id=call.message.chat.id,
-            message_id=call.message.message_id,
-            text=referrals_text,
-            reply_markup=create_referral_keyboard()
-        )
-        
-    elif call.data == "my_referral_link":
-        # Показываем реферальную ссылку
-        user_data = users_data.get(user_id, {})
-        user_data = update_user_structure(user_data, user_id)
-        
-        referral_code = user_data.get('referral_code', f'ref_{user_id}')
-        referral_link = f"https://t.me/{bot.get_me().username}?start={referral_code}"
-        
-        link_text = (
-            "🔗 Реферальная ссылка\n\n"
-            f"<code>{referral_link}</code>\n\n"
-            f"📋 Уникальный код: <code>{referral_code}</code>\n\n"
-            f"💼 Инструкция по использованию:\n"
-            f"• Поделитесь ссылкой с потенциальными клиентами\n"
-            f"• Пригласите 3 активных пользователей\n"
-            f"• Каждый должен пополнить баланс на 500+ ₽\n"
-            f"• Получите специальную цену 1.30 ₽ за звезду\n"
-            f"• Стандартная цена: {STAR_PRICE:.2f} ₽ за звезду"
-        )
-        
-        safe_edit_message(
-            chat_id=call.message.chat.id,
-            message_id=call.message.message_id,
-            text=link_text,
-            reply_markup=create_referral_keyboard()
-        )
-        
-    elif call.data == "referral_stats":
-        # Показываем статистику рефералов
-        user_data = users_data.get(user_id, {})
-        user_data = update_user_structure(user_data, user_id)
-        
-        referrals = user_data.get("referrals", [])
-        total_referrals = len(referrals)
-        qualified_referrals = sum(1 for ref in referrals if ref.get("total_spent", 0) >= 500.0)
-        total_spent_by_referrals = sum(ref.get("total_spent", 0) for ref in referrals)
-        total_stars_by_referrals = sum(ref.get("stars_bought", 0) for ref in referrals)
-        discount = user_data.get("referral_discount", 0.0)
-        
-        if qualified_referrals >= 3:
-            price_status = "1.30 ₽ за звезду (активирована)"
-        else:
-            price_status = f"{STAR_PRICE:.2f} ₽ за звезду (нужно еще {3 - qualified_referrals} рефералов)"
-        
-        stats_text = (
-            "📊 Детальная статистика\n\n"
-            f"👥 Всего приглашенных: {total_referrals}\n"
-            f"✅ Квалифицированных: {qualified_referrals}\n"
-            f"💰 Общий оборот рефералов: {total_spent_by_referrals:.2f} ₽\n"
-            f"⭐ Приобретено звезд: {total_stars_by_referrals}\n"
-            f"🎯 Ваша цена за звезду: {price_status}\n\n"
-            f"📋 Критерии квалификации:\n"
-            f"• Минимальное пополнение: 500 ₽\n"
-            f"• Требуется для активации: 3 квалифицированных реферала\n"
-            f"• Специальная цена: 1.30 ₽ за звезду"
-        )
-        
-        safe_edit_message(
-            chat_id=call.message.chat.id,
-            message_id=call.message.message_id,
-            text=stats_text,
-            reply_markup=create_referral_keyboard()
-        )
-        
-    elif call.data == "referral_earnings":
-        # Показываем информацию о заработке
-        user_data = users_data.get(user_id, {})
-        user_data = update_user_structure(user_data, user_id)
-        
-        discount = user_data.get("referral_discount", 0.0)
-        stars_bought = user_data.get("stars_bought", 0)
-        total_saved = stars_bought * discount
-        qualified_referrals = sum(1 for ref in user_data.get("referrals", []) if ref.get("total_spent", 0) >= 500.0)
-        
-        if discount > 0:
-            savings_text = f"💵 Всего сэкономлено: {total_saved:.2f} ₽"
-            status_text = "🎉 Скидка активирована!"
-        else:
-            savings_text = f"💵 Для получения скидки нужно 3 реферала"
-            status_text = f"⏳ Квалифицированных рефералов: {qualified_referrals}/3"
-        
-        earnings_text = (
-            "💰 Финансовая выгода\n\n"
-            f"🎯 Статус программы: {status_text}\n"
-            f"⭐ Приобретено звезд: {stars_bought}\n"
-            f"{savings_text}\n\n"
-            f"💼 Условия получения выгоды:\n"
-            f"• Пригласите 3 активных пользователей\n"
-            f"• Каждый должен пополнить баланс на 500+ ₽\n"
-            f"• Получите специальную цену 1.30 ₽ за звезду\n"
-            f"• Стандартная цена: {STAR_PRICE:.2f} ₽ за звезду"
-        )
-        
-        safe_edit_message(
-            chat_id=call.message.chat.id,
-            message_id=call.message.message_id,
-            text=earnings_text,
-            reply_markup=create_referral_keyboard()
-        )
-        
-    elif call.data == "topup_apays":
-        # Переходим к пополнению через APays с нужной суммой
-        user_data = users_data.get(user_id, {})
-        user_data = update_user_structure(user_data, user_id)
-        
-        # Получаем состояние пользователя
-        user_state = user_states.get(user_id, {})
-        
-        # Получаем нужную сумму в зависимости от состояния
-        if user_state.get("state") == "insufficient_balance":
-            needed_amount = user_state.get("needed_amount", 0)
-            
-            # Проверяем минимальную сумму для APays
-            if needed_amount < APAYS_MIN_AMOUNT:
-                bot.answer_callback_query(
-                    call.id, 
-                    f"❌ Минимальная сумма для APays: {APAYS_MIN_AMOUNT} ₽"
-                )
-                return
-        else:
-            needed_amount = user_state.get("needed_amount", 0)
-        
-        # Отладочная информация
-        logging.info(f"topup_apays: user_state = {user_state}, needed_amount = {needed_amount}")
-        
-        if needed_amount > 0:
-            # Рассчитываем сумму с комиссией APays
-            commission_rate = APAYS_COMMISSION_PERCENT / 100
-            amount_with_commission = needed_amount / (1 - commission_rate)
-            amount_with_commission = round(amount_with_commission, 2)
+                
+        except Exception as e:
+            logging.error(f"Ошибка проверки статуса платежа: {e}")
+            error_text = "❌ Ошибка проверки статуса платежа. Попробуйте еще раз."
             
-            topup_text = (
-                f"⚪️ Выбран метод: APays\n\n"
-                f"💰 Текущий баланс: {user_data.get('balance', 0):.2f} ₽\n"
-                f"💸 Нужно пополнить: {needed_amount:.2f} ₽\n"
-                f"💳 К оплате (с комиссией {APAYS_COMMISSION_PERCENT}%): {amount_with_commission:.2f} ₽\n\n"
-                f"🔽 Выберите действие:"
-            )
+            # Создаем клавиатуру с кнопкой "Проверить еще раз"
+            keyboard = InlineKeyboardMarkup()
+            keyboard.add(InlineKeyboardButton("🔄 Проверить еще раз", callback_data="check_payment"))
+            keyboard.add(InlineKeyboardButton("❌ Отменить", callback_data="cancel"))
             
-            # Сохраняем данные для пополнения
+            safe_edit_message(
+                chat_id=call.message.chat.id,
+                message_id=call.message.message_id,
+                text=error_text,
+                reply_markup=keyboard
+            )
+    else:
+        bot.answer_callback_query(call.id, "❌ Нет активного платежа для проверки")
+
+
+@callback_router.route("retry_apays")
+def callback_retry_apays(call: CallbackQuery, user_id: str, user_data=None):
+    # Повторная попытка создания APays платежа
+    user_state = user_states.get(user_id, {})
+    if user_state.get("state") == "waiting_payment_confirmation" and user_state.get("payment_method") == "apays":
+        amount = user_state.get("amount")
+        
+        if not APAYS_ENABLED or not apays:
+            safe_edit_message(
+                chat_id=call.message.chat.id,
+                message_id=call.message.message_id,
+                text="❌ APays временно недоступен",
+                reply_markup=create_back_keyboard()
+            )
+            return
+        
+        # Создаем новый платеж
+        payment_data = apays.create_payment(amount)
+        if payment_data and "payment_url" in payment_data:
+            # Обновляем данные платежа
             user_states[user_id] = {
-                "state": "waiting_topup_amount",
+                "state": "waiting_payment_confirmation",
                 "payment_method": "apays",
-                "needed_amount": needed_amount,
-                "amount_with_commission": amount_with_commission
+                "payment_id": payment_data["payment_id"],
+                "amount": amount
             }
             
-            # Создаем клавиатуру с возможностью изменить сумму
-            keyboard = InlineKeyboardMarkup()
-            keyboard.add(
-                InlineKeyboardButton(f"💳 Пополнить {amount_with_commission:.2f} ₽", callback_data="confirm_topup_apays")
-            )
-            keyboard.add(
-                InlineKeyboardButton("💰 Другая сумма", callback_data="change_amount")
-            )
-            keyboard.add(
-                InlineKeyboardButton(f"{EMOJIS['back']} Назад", callback_data="back_main")
-            )
-        else:
-            # Если нет нужной суммы, показываем обычное меню
-            topup_text = (
-                "💳 Пополнение баланса\n\n"
-                f"💰 Текущий баланс: {user_data.get('balance', 0):.2f} ₽\n"
-                f"💸 APays: от {APAYS_MIN_AMOUNT} ₽\n"
-                f"💸 TON: от {TON_MIN_AMOUNT} ₽\n"
-                f"💸 Максимальная сумма: {PAYMENT_MAX_AMOUNT} ₽\n\n"
-                "🔽 Выберите способ оплаты:"
+            payment_text = (
+                f"💳 APays платеж пересоздан\n\n"
+                f"💰 Сумма: {amount:.2f} ₽\n"
+                f"🆔 ID платежа: {payment_data['payment_id']}\n\n"
+                f"🔗 Новая ссылка для оплаты:\n{payment_data['payment_url']}\n\n"
+                f"⏳ Ожидаем подтверждения платежа...\n\n"
+                f"⚠️ Если при переходе по ссылке появляется ошибка 'Сервис временно недоступен', попробуйте:\n"
+                f"• Обновить страницу (F5)\n"
+                f"• Отключить блокировщик рекламы\n"
+                f"• Использовать другой браузер\n"
+                f"• Подождать несколько минут и попробовать снова"
             )
             
-            keyboard = InlineKeyboardMarkup()
-            if APAYS_ENABLED and apays:
-                keyboard.add(
-                    InlineKeyboardButton(f"💳 APays (+{APAYS_COMMISSION_PERCENT}%)", callback_data="payment_method_apays")
-                )
-            keyboard.add(
-                InlineKeyboardButton(f"⚡ Прямой перевод TON (Без комиссии)", callback_data="payment_method_ton")
+            safe_edit_message(
+                chat_id=call.message.chat.id,
+                message_id=call.message.message_id,
+                text=payment_text,
+                reply_markup=create_apays_payment_keyboard()
             )
-            keyboard.add(
-                InlineKeyboardButton(f"{EMOJIS['back']} Назад", callback_data="back_main")
+        else:
+            safe_edit_message(
+                chat_id=call.message.chat.id,
+                message_id=call.message.message_id,
+                text="❌ Ошибка пересоздания платежа APays",
+                reply_markup=create_back_keyboard()
             )
+    else:
+        bot.answer_callback_query(call.id, "❌ Нет активного APays платежа для повтора")
+
+
+@callback_router.route("check_ton_payment")
+def callback_check_ton_payment(call: CallbackQuery, user_id: str, user_data=None):
+    # Проверяем статус TON платежа
+    payment_data = user_states.get(user_id, {})
+    if payment_data.get("state") == "payment_created" and payment_data.get("payment_method") == "ton":
+        order_id = payment_data.get("order_id")
+        amount = payment_data.get("amount")
         
-        safe_edit_message(
-            chat_id=call.message.chat.id,
-            message_id=call.message.message_id,
-            text=topup_text,
-            reply_markup=keyboard
-        )
-        
-    elif call.data == "topup_ton":
-        # Переходим к пополнению через TON с нужной суммой
-        user_data = users_data.get(user_id, {})
-        user_data = update_user_structure(user_data, user_id)
-        
-        # Получаем состояние пользователя
-        user_state = user_states.get(user_id, {})
-        
-        # Отладочная информация
-        logging.info(f"topup_ton: user_state = {user_state}")
-        
-        # Получаем нужную сумму в зависимости от состояния
-        if user_state.get("state") == "insufficient_balance":
-            needed_amount = user_state.get("needed_amount", 0)
+        try:
+            # Получаем ожидаемый комментарий
+            payment_info = payment_data.get("payment_data", {})
+            expected_comment = payment_info.get("comment")
             
-            # Проверяем минимальную сумму для TON
-            if needed_amount < TON_MIN_AMOUNT:
-                bot.answer_callback_query(
-                    call.id, 
-                    f"❌ Минимальная сумма для TON: {TON_MIN_AMOUNT} ₽"
-                )
-                return
-        else:
-            needed_amount = user_state.get("needed_amount", 0)
-        
-        logging.info(f"topup_ton: needed_amount = {needed_amount}")
-        
-        if needed_amount > 0:
-            # Сразу создаем платеж через TON (как в payment_method_ton)
+            # Проверяем статус TON транзакции
             if not TON_ENABLED or not ton_payment:
                 safe_edit_message(
                     chat_id=call.message.chat.id,
@@ -2520,312 +2285,762 @@ def handle_callback(call: CallbackQuery):
                 )
                 return
             
-            # Создаем платеж через TON
-            payment_data = ton_payment.create_payment_request(int(user_id), needed_amount)
-            if payment_data and "error" not in payment_data:
-                # Сохраняем данные платежа, сохраняя информацию о первоначальной покупке
-                new_state = {
-                    "state": "waiting_payment_confirmation",
-                    "payment_method": "ton",
-                    "amount": needed_amount,
-                    "payment_id": payment_data["payment_id"],
-                    "comment": payment_data["comment"],
-                    "amount_ton": payment_data["amount_ton"],
-                    "wallet_address": payment_data["wallet_address"],
-                    "created_at": int(time.time())
-                }
+            status_result = ton_payment.check_ton_transaction(order_id, expected_comment)
+            
+            if status_result.get("status") == "approved":
+                # Платеж успешен - пополняем баланс
+                user_data = credit_balance(user_id, amount, method="TON", order_id=order_id)
                 
-                # Если это пополнение из-за недостаточного баланса, сохраняем информацию о покупке
-                if user_state.get("state") == "insufficient_balance":
-                    new_state["original_purchase"] = {
-                        "stars_amount": user_state.get("stars_amount"),
-                        "cost": user_state.get("cost"),
-                        "needed_amount": user_state.get("needed_amount")
-                    }
+                # Обновляем статистику рефералов
+                update_referral_stats(user_id, user_data)
+                
+                # Отправляем лог о пополнении в техподдержку
+                spawn(log_balance_topup(
+                    user_id=user_id,
+                    username=user_data.username or 'Unknown',
+                    amount=amount,
+                    payment_method="TON",
+                    success=True
+                ))
                 
-                user_states[user_id] = new_state
+                # Очищаем состояние
+                user_states.pop(user_id, None)
                 
-                payment_text = (
-                    f"📋 Платеж сформирован\n\n"
-                    f"💸 Сумма к отправке: {payment_data['amount_ton']:.4f} TON\n"
-                    f"⚠️ Комментарий: <code>{payment_data['comment']}</code>\n"
-                    f"💳 Адрес для оплаты: <code>{payment_data['wallet_address']}</code>\n\n"
-                    f"‼️ Обязательно указывайте комментарий при отправке монет, в противном случае - пополнение не будет засчитано\n"
-                    f"‼️ Окончательная сумма к получению будет рассчитана в момент получения монет\n\n"
-                    f"📱 Для оплаты:\n"
-                    f"1. Откройте TON кошелек\n"
-                    f"2. Отправьте {payment_data['amount_ton']:.4f} TON на указанный адрес\n"
-                    f"3. В комментарии укажите: <code>{payment_data['comment']}</code>\n"
-                    f"4. Нажмите \"Проверить оплату\" после перевода"
+                success_text = (
+                    f"✅ TON платеж успешно обработан!\n\n"
+                    f"💰 Пополнено: {amount:.2f} ₽\n"
+                    f"💳 Новый баланс: {user_data.balance:.2f} ₽\n"
+                    f"🆔 ID заказа: {order_id}"
                 )
                 
-                # Создаем клавиатуру с кнопкой проверки оплаты
-                keyboard = InlineKeyboardMarkup()
-                keyboard.add(
-                    InlineKeyboardButton("🔍 Проверить оплату", callback_data=f"check_ton_payment_{payment_data['payment_id']}")
+                safe_edit_message(
+                    chat_id=call.message.chat.id,
+                    message_id=call.message.message_id,
+                    text=success_text,
+                    reply_markup=create_back_keyboard()
                 )
-                keyboard.add(
-                    InlineKeyboardButton("❌ Отменить", callback_data="cancel")
+                
+            elif status_result.get("status") == "pending":
+                # Платеж еще обрабатывается - показываем детали оплаты
+                ton_amount = payment_info.get("amount_ton", 0)
+                wallet_address = payment_info.get("wallet_address", "")
+                comment = payment_info.get("comment", "")
+                
+                pending_text = (
+                    f"⏳ TON платеж обрабатывается...\n\n"
+                    f"💰 Сумма: {amount:.2f} ₽\n"
+                    f"🆔 ID заказа: {order_id}\n\n"
+                    f"💸 Сумма к отправке: {ton_amount:.4f} TON\n"
+                    f"💳 Адрес для оплаты: <code>{wallet_address}</code>\n"
+                    f"⚠️ Комментарий: <code>{comment}</code>\n\n"
+                    f"‼️ Обязательно указывайте комментарий при отправке монет!\n\n"
+                    f"Попробуйте проверить еще раз через несколько минут."
                 )
                 
+                # Создаем клавиатуру с кнопкой "Проверить еще раз"
+                keyboard = InlineKeyboardMarkup()
+                keyboard.add(InlineKeyboardButton("🔄 Проверить еще раз", callback_data="check_ton_payment"))
+                keyboard.add(InlineKeyboardButton("❌ Отменить", callback_data="cancel"))
+                
                 safe_edit_message(
                     chat_id=call.message.chat.id,
                     message_id=call.message.message_id,
-                    text=payment_text,
+                    text=pending_text,
                     reply_markup=keyboard
                 )
+                
             else:
-                error_msg = payment_data.get("error", "Неизвестная ошибка") if payment_data else "Ошибка создания платежа"
+                # Платеж не найден или отклонен - показываем детали оплаты
+                ton_amount = payment_info.get("amount_ton", 0)
+                wallet_address = payment_info.get("wallet_address", "")
+                comment = payment_info.get("comment", "")
+                
+                not_found_text = (
+                    f"❌ TON платеж не найден\n\n"
+                    f"💰 Сумма: {amount:.2f} ₽\n"
+                    f"🆔 ID заказа: {order_id}\n\n"
+                    f"💸 Сумма к отправке: {ton_amount:.4f} TON\n"
+                    f"💳 Адрес для оплаты: <code>{wallet_address}</code>\n"
+                    f"⚠️ Комментарий: <code>{comment}</code>\n\n"
+                    f"‼️ Обязательно указывайте комментарий при отправке монет!\n\n"
+                    f"Убедитесь, что вы отправили правильную сумму на указанный адрес."
+                )
+                
+                # Создаем клавиатуру с кнопкой "Проверить еще раз"
+                keyboard = InlineKeyboardMarkup()
+                keyboard.add(InlineKeyboardButton("🔄 Проверить еще раз", callback_data="check_ton_payment"))
+                keyboard.add(InlineKeyboardButton("❌ Отменить", callback_data="cancel"))
+                
                 safe_edit_message(
                     chat_id=call.message.chat.id,
                     message_id=call.message.message_id,
-                    text=f"❌ Ошибка создания TON платежа: {error_msg}",
-                    reply_markup=create_back_keyboard()
+                    text=not_found_text,
+                    reply_markup=keyboard
                 )
-                return
-        else:
-            # Если нет нужной суммы, показываем обычное меню
-            topup_text = (
-                "💳 Пополнение баланса\n\n"
-                f"💰 Текущий баланс: {user_data.get('balance', 0):.2f} ₽\n"
-                f"💸 APays: от {APAYS_MIN_AMOUNT} ₽\n"
-                f"💸 TON: от {TON_MIN_AMOUNT} ₽\n"
-                f"💸 Максимальная сумма: {PAYMENT_MAX_AMOUNT} ₽\n\n"
-                "🔽 Выберите способ оплаты:"
+                
+        except Exception as e:
+            logging.error(f"Ошибка проверки TON платежа: {e}")
+            
+            # Получаем детали оплаты для отображения
+            payment_info = payment_data.get("payment_data", {})
+            ton_amount = payment_info.get("amount_ton", 0)
+            wallet_address = payment_info.get("wallet_address", "")
+            comment = payment_info.get("comment", "")
+            
+            error_text = (
+                f"❌ Ошибка проверки TON платежа. Попробуйте еще раз.\n\n"
+                f"💰 Сумма: {amount:.2f} ₽\n"
+                f"🆔 ID заказа: {order_id}\n\n"
+                f"💸 Сумма к отправке: {ton_amount:.4f} TON\n"
+                f"💳 Адрес для оплаты: <code>{wallet_address}</code>\n"
+                f"⚠️ Комментарий: <code>{comment}</code>\n\n"
+                f"‼️ Обязательно указывайте комментарий при отправке монет!"
             )
             
+            # Создаем клавиатуру с кнопкой "Проверить еще раз"
             keyboard = InlineKeyboardMarkup()
-            if APAYS_ENABLED and apays:
-                keyboard.add(
-                    InlineKeyboardButton(f"💳 APays (+{APAYS_COMMISSION_PERCENT}%)", callback_data="payment_method_apays")
-                )
+            keyboard.add(InlineKeyboardButton("🔄 Проверить еще раз", callback_data="check_ton_payment"))
+            keyboard.add(InlineKeyboardButton("❌ Отменить", callback_data="cancel"))
+            
+            safe_edit_message(
+                chat_id=call.message.chat.id,
+                message_id=call.message.message_id,
+                text=error_text,
+                reply_markup=keyboard
+            )
+    else:
+        bot.answer_callback_query(call.id, "❌ Нет активного TON платежа для проверки")
+
+
+@callback_router.route("confirm_self_purchase", needs_user=True)
+def callback_confirm_self_purchase(call: CallbackQuery, user_id: str, user_data=None):
+    # Покупка звезд себе
+    purchase_data = user_states.get(user_id, {})
+    
+    # Покупка себе сохраняет общее состояние confirm_purchase (см. callback_recipient_self)
+    if not purchase_data or purchase_data.get("state") not in ("confirm_self_purchase", "confirm_purchase") \
+            or not purchase_data.get("stars_amount") or purchase_data.get("cost") is None:
+        bot.answer_callback_query(call.id, "❌ Нет данных о покупке")
+        return
+    
+    stars_amount = purchase_data.get("stars_amount")
+    cost = purchase_data.get("cost")
+    recipient = user_data.username  # Покупаем себе
+    
+    process_stars_purchase(call, user_id, user_data, stars_amount, cost, recipient)
+
+
+@callback_router.route("referral", needs_user=True)
+def callback_referral(call: CallbackQuery, user_id: str, user_data=None):
+    # Показываем реферальную программу
+    
+    referral_summary = referral_index.summary(user_id)
+    qualified_referrals = referral_summary.qualified
+    discount = user_data.referral_discount
+    
+    if qualified_referrals >= 3:
+        price_text = "1.30 ₽ за звезду"
+        status_text = "🎉 Активирована!"
+    else:
+        price_text = f"{STAR_PRICE:.2f} ₽ за звезду"
+        status_text = f"⏳ Нужно еще {3 - qualified_referrals} рефералов"
+    
+    referral_text = (
+        "🎁 Реферальная программа\n\n"
+        f"📊 Статистика:\n"
+        f"👥 Всего приглашенных: {referral_summary.count}\n"
+        f"✅ Квалифицированных: {qualified_referrals}\n"
+        f"💰 Текущая цена: {price_text}\n"
+        f"🎯 Статус программы: {status_text}\n\n"
+        f"📋 Условия участия:\n"
+        f"• Пригласите 3 активных пользователей\n"
+        f"• Каждый должен пополнить баланс на 500+ ₽\n"
+        f"• Получите специальную цену 1.30 ₽ за звезду\n"
+        f"• Стандартная цена: {STAR_PRICE:.2f} ₽ за звезду\n\n"
+        f"🔗 Ваша реферальная ссылка:\n"
+        f"https://t.me/{bot.get_me().username}?start={user_data.referral_code}"
+    )
+    
+    safe_edit_message(
+        chat_id=call.message.chat.id,
+        message_id=call.message.message_id,
+        text=referral_text,
+        reply_markup=create_referral_keyboard()
+    )
+
+
+@callback_router.route("my_referrals")
+def callback_my_referrals(call: CallbackQuery, user_id: str, user_data=None):
+    # Показываем список рефералов
+    referrals = referral_index.referrals_of(user_id)
+    if not referrals:
+        referrals_text = "📋 У вас пока нет рефералов\n\nПригласите друзей по вашей реферальной ссылке!"
+    else:
+        referrals_text = "📋 Ваши рефералы:\n\n"
+        for i, referral in enumerate(referrals, 1):
+            status = "✅" if referral.total_spent >= 250.0 else "⏳"
+            referrals_text += (
+                f"{i}. {status} @{referral.username or 'Unknown'}\n"
+                f"   💰 Потрачено: {referral.total_spent:.2f} ₽\n"
+                f"   ⭐ Звезд: {referral.stars_bought}\n"
+                f"   📅 Регистрация: {referral.registration_date or 'Unknown'}\n\n"
+            )
+    
+    safe_edit_message(
+        chat_id=call.message.chat.id,
+        message_id=call.message.message_id,
+        text=referrals_text,
+        reply_markup=create_referral_keyboard()
+    )
+
+
+@callback_router.route("my_referral_link", needs_user=True)
+def callback_my_referral_link(call: CallbackQuery, user_id: str, user_data=None):
+    # Показываем реферальную ссылку
+    
+    referral_code = user_data.referral_code
+    referral_link = f"https://t.me/{bot.get_me().username}?start={referral_code}"
+    
+    link_text = (
+        "🔗 Реферальная ссылка\n\n"
+        f"<code>{referral_link}</code>\n\n"
+        f"📋 Уникальный код: <code>{referral_code}</code>\n\n"
+        f"💼 Инструкция по использованию:\n"
+        f"• Поделитесь ссылкой с потенциальными клиентами\n"
+        f"• Пригласите 3 активных пользователей\n"
+        f"• Каждый должен пополнить баланс на 500+ ₽\n"
+        f"• Получите специальную цену 1.30 ₽ за звезду\n"
+        f"• Стандартная цена: {STAR_PRICE:.2f} ₽ за звезду"
+    )
+    
+    safe_edit_message(
+        chat_id=call.message.chat.id,
+        message_id=call.message.message_id,
+        text=link_text,
+        reply_markup=create_referral_keyboard()
+    )
+
+
+@callback_router.route("referral_stats", needs_user=True)
+def callback_referral_stats(call: CallbackQuery, user_id: str, user_data=None):
+    # Показываем статистику рефералов
+    
+    referral_summary = referral_index.summary(user_id)
+    total_referrals = referral_summary.count
+    qualified_referrals = referral_summary.qualified
+    total_spent_by_referrals = referral_summary.turnover
+    total_stars_by_referrals = referral_summary.stars
+    discount = user_data.referral_discount
+    
+    if qualified_referrals >= 3:
+        price_status = "1.30 ₽ за звезду (активирована)"
+    else:
+        price_status = f"{STAR_PRICE:.2f} ₽ за звезду (нужно еще {3 - qualified_referrals} рефералов)"
+    
+    stats_text = (
+        "📊 Детальная статистика\n\n"
+        f"👥 Всего приглашенных: {total_referrals}\n"
+        f"✅ Квалифицированных: {qualified_referrals}\n"
+        f"💰 Общий оборот рефералов: {total_spent_by_referrals:.2f} ₽\n"
+        f"⭐ Приобретено звезд: {total_stars_by_referrals}\n"
+        f"🎯 Ваша цена за звезду: {price_status}\n\n"
+        f"📋 Критерии квалификации:\n"
+        f"• Минимальное пополнение: 500 ₽\n"
+        f"• Требуется для активации: 3 квалифицированных реферала\n"
+        f"• Специальная цена: 1.30 ₽ за звезду"
+    )
+    
+    safe_edit_message(
+        chat_id=call.message.chat.id,
+        message_id=call.message.message_id,
+        text=stats_text,
+        reply_markup=create_referral_keyboard()
+    )
+
+
+@callback_router.route("referral_earnings", needs_user=True)
+def callback_referral_earnings(call: CallbackQuery, user_id: str, user_data=None):
+    # Показываем информацию о заработке
+    
+    discount = user_data.referral_discount
+    stars_bought = user_data.stars_bought
+    total_saved = stars_bought * discount
+    qualified_referrals = referral_index.summary(user_id).qualified
+    
+    if discount > 0:
+        savings_text = f"💵 Всего сэкономлено: {total_saved:.2f} ₽"
+        status_text = "🎉 Скидка активирована!"
+    else:
+        savings_text = f"💵 Для получения скидки нужно 3 реферала"
+        status_text = f"⏳ Квалифицированных рефералов: {qualified_referrals}/3"
+    
+    earnings_text = (
+        "💰 Финансовая выгода\n\n"
+        f"🎯 Статус программы: {status_text}\n"
+        f"⭐ Приобретено звезд: {stars_bought}\n"
+        f"{savings_text}\n\n"
+        f"💼 Условия получения выгоды:\n"
+        f"• Пригласите 3 активных пользователей\n"
+        f"• Каждый должен пополнить баланс на 500+ ₽\n"
+        f"• Получите специальную цену 1.30 ₽ за звезду\n"
+        f"• Стандартная цена: {STAR_PRICE:.2f} ₽ за звезду"
+    )
+    
+    safe_edit_message(
+        chat_id=call.message.chat.id,
+        message_id=call.message.message_id,
+        text=earnings_text,
+        reply_markup=create_referral_keyboard()
+    )
+
+
+@callback_router.route("topup_apays", needs_user=True)
+def callback_topup_apays(call: CallbackQuery, user_id: str, user_data=None):
+    # Переходим к пополнению через APays с нужной суммой
+    
+    # Получаем состояние пользователя
+    user_state = user_states.get(user_id, {})
+    
+    # Получаем нужную сумму в зависимости от состояния
+    if user_state.get("state") == "insufficient_balance":
+        needed_amount = user_state.get("needed_amount", 0)
+        
+        # Проверяем минимальную сумму для APays
+        if needed_amount < APAYS_MIN_AMOUNT:
+            bot.answer_callback_query(
+                call.id, 
+                f"❌ Минимальная сумма для APays: {APAYS_MIN_AMOUNT} ₽"
+            )
+            return
+    else:
+        needed_amount = user_state.get("needed_amount", 0)
+    
+    # Отладочная информация
+    logging.info(f"topup_apays: user_state = {user_state}, needed_amount = {needed_amount}")
+    
+    if needed_amount > 0:
+        # Рассчитываем сумму с комиссией APays
+        commission_rate = APAYS_COMMISSION_PERCENT / 100
+        amount_with_commission = needed_amount / (1 - commission_rate)
+        amount_with_commission = round(amount_with_commission, 2)
+        
+        topup_text = (
+            f"⚪️ Выбран метод: APays\n\n"
+            f"💰 Текущий баланс: {user_data.balance:.2f} ₽\n"
+            f"💸 Нужно пополнить: {needed_amount:.2f} ₽\n"
+            f"💳 К оплате (с комиссией {APAYS_COMMISSION_PERCENT}%): {amount_with_commission:.2f} ₽\n\n"
+            f"🔽 Выберите действие:"
+        )
+        
+        # Сохраняем данные для пополнения
+        user_states[user_id] = {
+            "state": "waiting_topup_amount",
+            "payment_method": "apays",
+            "needed_amount": needed_amount,
+            "amount_with_commission": amount_with_commission
+        }
+        
+        # Создаем клавиатуру с возможностью изменить сумму
+        keyboard = InlineKeyboardMarkup()
+        keyboard.add(
+            InlineKeyboardButton(f"💳 Пополнить {amount_with_commission:.2f} ₽", callback_data="confirm_topup_apays")
+        )
+        keyboard.add(
+            InlineKeyboardButton("💰 Другая сумма", callback_data="change_amount")
+        )
+        keyboard.add(
+            InlineKeyboardButton(f"{EMOJIS['back']} Назад", callback_data="back_main")
+        )
+    else:
+        # Если нет нужной суммы, показываем обычное меню
+        topup_text = (
+            "💳 Пополнение баланса\n\n"
+            f"💰 Текущий баланс: {user_data.balance:.2f} ₽\n"
+            f"💸 APays: от {APAYS_MIN_AMOUNT} ₽\n"
+            f"💸 TON: от {TON_MIN_AMOUNT} ₽\n"
+            f"💸 Максимальная сумма: {PAYMENT_MAX_AMOUNT} ₽\n\n"
+            "🔽 Выберите способ оплаты:"
+        )
+        
+        keyboard = InlineKeyboardMarkup()
+        if APAYS_ENABLED and apays:
+            keyboard.add(
+                InlineKeyboardButton(f"💳 APays (+{APAYS_COMMISSION_PERCENT}%)", callback_data="payment_method_apays")
+            )
+        keyboard.add(
+            InlineKeyboardButton(f"⚡ Прямой перевод TON (Без комиссии)", callback_data="payment_method_ton")
+        )
+        keyboard.add(
+            InlineKeyboardButton(f"{EMOJIS['back']} Назад", callback_data="back_main")
+        )
+    
+    safe_edit_message(
+        chat_id=call.message.chat.id,
+        message_id=call.message.message_id,
+        text=topup_text,
+        reply_markup=keyboard
+    )
+
+
+@callback_router.route("topup_ton", needs_user=True)
+def callback_topup_ton(call: CallbackQuery, user_id: str, user_data=None):
+    # Переходим к пополнению через TON с нужной суммой
+    
+    # Получаем состояние пользователя
+    user_state = user_states.get(user_id, {})
+    
+    # Отладочная информация
+    logging.info(f"topup_ton: user_state = {user_state}")
+    
+    # Получаем нужную сумму в зависимости от состояния
+    if user_state.get("state") == "insufficient_balance":
+        needed_amount = user_state.get("needed_amount", 0)
+        
+        # Проверяем минимальную сумму для TON
+        if needed_amount < TON_MIN_AMOUNT:
+            bot.answer_callback_query(
+                call.id, 
+                f"❌ Минимальная сумма для TON: {TON_MIN_AMOUNT} ₽"
+            )
+            return
+    else:
+        needed_amount = user_state.get("needed_amount", 0)
+    
+    logging.info(f"topup_ton: needed_amount = {needed_amount}")
+    
+    if needed_amount > 0:
+        # Сразу создаем платеж через TON (как в payment_method_ton)
+        if not TON_ENABLED or not ton_payment:
+            safe_edit_message(
+                chat_id=call.message.chat.id,
+                message_id=call.message.message_id,
+                text="❌ TON платежи временно недоступны",
+                reply_markup=create_back_keyboard()
+            )
+            return
+        
+        # Создаем платеж через TON
+        payment_data = ton_payment.create_payment_request(int(user_id), needed_amount)
+        if payment_data and "error" not in payment_data:
+            # Сохраняем данные платежа, сохраняя информацию о первоначальной покупке
+            new_state = {
+                "state": "waiting_payment_confirmation",
+                "payment_method": "ton",
+                "amount": needed_amount,
+                "payment_id": payment_data["payment_id"],
+                "comment": payment_data["comment"],
+                "amount_ton": payment_data["amount_ton"],
+                "wallet_address": payment_data["wallet_address"],
+                "created_at": int(time.time())
+            }
+            
+            # Если это пополнение из-за недостаточного баланса, сохраняем информацию о покупке
+            if user_state.get("state") == "insufficient_balance":
+                new_state["original_purchase"] = {
+                    "stars_amount": user_state.get("stars_amount"),
+                    "cost": user_state.get("cost"),
+                    "needed_amount": user_state.get("needed_amount")
+                }
+            
+            user_states[user_id] = new_state
+            
+            payment_text = (
+                f"📋 Платеж сформирован\n\n"
+                f"💸 Сумма к отправке: {payment_data['amount_ton']:.4f} TON\n"
+                f"⚠️ Комментарий: <code>{payment_data['comment']}</code>\n"
+                f"💳 Адрес для оплаты: <code>{payment_data['wallet_address']}</code>\n\n"
+                f"‼️ Обязательно указывайте комментарий при отправке монет, в противном случае - пополнение не будет засчитано\n"
+                f"‼️ Окончательная сумма к получению будет рассчитана в момент получения монет\n\n"
+                f"📱 Для оплаты:\n"
+                f"1. Откройте TON кошелек\n"
+                f"2. Отправьте {payment_data['amount_ton']:.4f} TON на указанный адрес\n"
+                f"3. В комментарии укажите: <code>{payment_data['comment']}</code>\n"
+                f"4. Нажмите \"Проверить оплату\" после перевода"
+            )
+            
+            # Создаем клавиатуру с кнопкой проверки оплаты
+            keyboard = InlineKeyboardMarkup()
+            keyboard.add(
+                InlineKeyboardButton("🔍 Проверить оплату", callback_data=f"check_ton_payment_{payment_data['payment_id']}")
+            )
             keyboard.add(
-                InlineKeyboardButton(f"⚡ Прямой перевод TON (Без комиссии)", callback_data="payment_method_ton")
+                InlineKeyboardButton("❌ Отменить", callback_data="cancel")
+            )
+            
+            safe_edit_message(
+                chat_id=call.message.chat.id,
+                message_id=call.message.message_id,
+                text=payment_text,
+                reply_markup=keyboard
             )
-            keyboard.add(
-                InlineKeyboardButton(f"{EMOJIS['back']} Назад", callback_data="back_main")
+        else:
+            error_msg = payment_data.get("error", "Неизвестная ошибка") if payment_data else "Ошибка создания платежа"
+            safe_edit_message(
+                chat_id=call.message.chat.id,
+                message_id=call.message.message_id,
+                text=f"❌ Ошибка создания TON платежа: {error_msg}",
+                reply_markup=create_back_keyboard()
             )
-        
-        safe_edit_message(
-            chat_id=call.message.chat.id,
-            message_id=call.message.message_id,
-            text=topup_text,
-            reply_markup=keyboard
-        )
-        
-    elif call.data == "change_amount":
-        # Переходим к вводу другой суммы
-        user_data = users_data.get(user_id, {})
-        user_data = update_user_structure(user_data, user_id)
-        
-        change_text = (
-            "💰 Введите сумму пополнения\n\n"
-            f"💰 Текущий баланс: {user_data.get('balance', 0):.2f} ₽\n"
+            return
+    else:
+        # Если нет нужной суммы, показываем обычное меню
+        topup_text = (
+            "💳 Пополнение баланса\n\n"
+            f"💰 Текущий баланс: {user_data.balance:.2f} ₽\n"
             f"💸 APays: от {APAYS_MIN_AMOUNT} ₽\n"
             f"💸 TON: от {TON_MIN_AMOUNT} ₽\n"
             f"💸 Максимальная сумма: {PAYMENT_MAX_AMOUNT} ₽\n\n"
-            f"Введите сумму в рублях:"
+            "🔽 Выберите способ оплаты:"
         )
         
-        # Устанавливаем состояние ожидания ввода суммы
-        user_states[user_id] = {
-            "state": "waiting_custom_topup_amount"
-        }
-        
-        safe_edit_message(
-            chat_id=call.message.chat.id,
-            message_id=call.message.message_id,
-            text=change_text,
-            reply_markup=create_cancel_keyboard()
+        keyboard = InlineKeyboardMarkup()
+        if APAYS_ENABLED and apays:
+            keyboard.add(
+                InlineKeyboardButton(f"💳 APays (+{APAYS_COMMISSION_PERCENT}%)", callback_data="payment_method_apays")
+            )
+        keyboard.add(
+            InlineKeyboardButton(f"⚡ Прямой перевод TON (Без комиссии)", callback_data="payment_method_ton")
+        )
+        keyboard.add(
+            InlineKeyboardButton(f"{EMOJIS['back']} Назад", callback_data="back_main")
         )
+    
+    safe_edit_message(
+        chat_id=call.message.chat.id,
+        message_id=call.message.message_id,
+        text=topup_text,
+        reply_markup=keyboard
+    )
+
+
+@callback_router.route("change_amount", needs_user=True)
+def callback_change_amount(call: CallbackQuery, user_id: str, user_data=None):
+    # Переходим к вводу другой суммы
+    
+    change_text = (
+        "💰 Введите сумму пополнения\n\n"
+        f"💰 Текущий баланс: {user_data.balance:.2f} ₽\n"
+        f"💸 APays: от {APAYS_MIN_AMOUNT} ₽\n"
+        f"💸 TON: от {TON_MIN_AMOUNT} ₽\n"
+        f"💸 Максимальная сумма: {PAYMENT_MAX_AMOUNT} ₽\n\n"
+        f"Введите сумму в рублях:"
+    )
+    
+    # Устанавливаем состояние ожидания ввода суммы
+    user_states[user_id] = {
+        "state": "waiting_custom_topup_amount"
+    }
+    
+    safe_edit_message(
+        chat_id=call.message.chat.id,
+        message_id=call.message.message_id,
+        text=change_text,
+        reply_markup=create_cancel_keyboard()
+    )
+
+
+@callback_router.route("confirm_topup_apays")
+def callback_confirm_topup_apays(call: CallbackQuery, user_id: str, user_data=None):
+    # Подтверждаем пополнение через APays
+    user_state = user_states.get(user_id, {})
+    
+    # Получаем сумму в зависимости от состояния
+    if user_state.get("state") == "insufficient_balance":
+        needed_amount = user_state.get("needed_amount", 0)
+        
+        # Проверяем минимальную сумму для APays
+        if needed_amount < APAYS_MIN_AMOUNT:
+            bot.answer_callback_query(
+                call.id, 
+                f"❌ Минимальная сумма для APays: {APAYS_MIN_AMOUNT} ₽"
+            )
+            return
         
-    elif call.data == "confirm_topup_apays":
-        # Подтверждаем пополнение через APays
-        user_state = user_states.get(user_id, {})
+        commission_rate = APAYS_COMMISSION_PERCENT / 100
+        amount = needed_amount / (1 - commission_rate)
+        amount = round(amount, 2)
+    else:
+        amount = user_state.get("amount_with_commission", 0)
+    
+    # Отладочная информация
+    logging.info(f"confirm_topup_apays: user_state = {user_state}, amount = {amount}")
+    
+    if amount > 0:
+        # Напрямую вызываем логику пополнения APays
+        if not APAYS_ENABLED or not apays:
+            safe_edit_message(
+                chat_id=call.message.chat.id,
+                message_id=call.message.message_id,
+                text="❌ APays временно недоступен",
+                reply_markup=create_back_keyboard()
+            )
+            return
         
-        # Получаем сумму в зависимости от состояния
-        if user_state.get("state") == "insufficient_balance":
-            needed_amount = user_state.get("needed_amount", 0)
-            
-            # Проверяем минимальную сумму для APays
-            if needed_amount < APAYS_MIN_AMOUNT:
-                bot.answer_callback_query(
-                    call.id, 
-                    f"❌ Минимальная сумма для APays: {APAYS_MIN_AMOUNT} ₽"
-                )
-                return
+        # Создаем платеж
+        payment_data = apays.create_payment(amount)
+        if payment_data and "payment_url" in payment_data:
+            # Сохраняем данные платежа
+            user_states[user_id] = {
+                "state": "waiting_payment_confirmation",
+                "payment_method": "apays",
+                "payment_id": payment_data["payment_id"],
+                "amount": amount
+            }
             
-            commission_rate = APAYS_COMMISSION_PERCENT / 100
-            amount = needed_amount / (1 - commission_rate)
-            amount = round(amount, 2)
-        else:
-            amount = user_state.get("amount_with_commission", 0)
-        
-        # Отладочная информация
-        logging.info(f"confirm_topup_apays: user_state = {user_state}, amount = {amount}")
-        
-        if amount > 0:
-            # Напрямую вызываем логику пополнения APays
-            if not APAYS_ENABLED or not apays:
-                safe_edit_message(
-                    chat_id=call.message.chat.id,
-                    message_id=call.message.message_id,
-                    text="❌ APays временно недоступен",
-                    reply_markup=create_back_keyboard()
-                )
-                return
+            payment_text = (
+                f"💳 APays платеж создан\n\n"
+                f"💰 Сумма: {amount:.2f} ₽\n"
+                f"🆔 ID платежа: {payment_data['payment_id']}\n\n"
+                f"🔗 Ссылка для оплаты:\n{payment_data['payment_url']}\n\n"
+                f"⏳ Ожидаем подтверждения платежа...\n\n"
+                f"⚠️ Если при переходе по ссылке появляется ошибка 'Сервис временно недоступен', попробуйте:\n"
+                f"• Обновить страницу (F5)\n"
+                f"• Отключить блокировщик рекламы\n"
+                f"• Использовать другой браузер\n"
+                f"• Подождать несколько минут и попробовать снова"
+            )
             
-            # Создаем платеж
-            payment_data = apays.create_payment(amount)
-            if payment_data and "payment_url" in payment_data:
-                # Сохраняем данные платежа
-                user_states[user_id] = {
-                    "state": "waiting_payment_confirmation",
-                    "payment_method": "apays",
-                    "payment_id": payment_data["payment_id"],
-                    "amount": amount
-                }
-                
-                payment_text = (
-                    f"💳 APays платеж создан\n\n"
-                    f"💰 Сумма: {amount:.2f} ₽\n"
-                    f"🆔 ID платежа: {payment_data['payment_id']}\n\n"
-                    f"🔗 Ссылка для оплаты:\n{payment_data['payment_url']}\n\n"
-                    f"⏳ Ожидаем подтверждения платежа...\n\n"
-                    f"⚠️ Если при переходе по ссылке появляется ошибка 'Сервис временно недоступен', попробуйте:\n"
-                    f"• Обновить страницу (F5)\n"
-                    f"• Отключить блокировщик рекламы\n"
-                    f"• Использовать другой браузер\n"
-                    f"• Подождать несколько минут и попробовать снова"
-                )
-                
-                safe_edit_message(
-                    chat_id=call.message.chat.id,
-                    message_id=call.message.message_id,
-                    text=payment_text,
-                    reply_markup=create_apays_payment_keyboard()
-                )
-            else:
-                safe_edit_message(
-                    chat_id=call.message.chat.id,
-                    message_id=call.message.message_id,
-                    text="❌ Ошибка создания платежа APays",
-                    reply_markup=create_back_keyboard()
-                )
+            safe_edit_message(
+                chat_id=call.message.chat.id,
+                message_id=call.message.message_id,
+                text=payment_text,
+                reply_markup=create_apays_payment_keyboard()
+            )
         else:
             safe_edit_message(
                 chat_id=call.message.chat.id,
                 message_id=call.message.message_id,
-                text="❌ Ошибка: сумма не определена",
+                text="❌ Ошибка создания платежа APays",
                 reply_markup=create_back_keyboard()
             )
-            
-    elif call.data == "confirm_topup_ton":
-        # Подтверждаем пополнение через TON
-        user_state = user_states.get(user_id, {})
-        
-        # Отладочная информация
-        logging.info(f"confirm_topup_ton: user_state = {user_state}")
+    else:
+        safe_edit_message(
+            chat_id=call.message.chat.id,
+            message_id=call.message.message_id,
+            text="❌ Ошибка: сумма не определена",
+            reply_markup=create_back_keyboard()
+        )
+
+
+@callback_router.route("confirm_topup_ton")
+def callback_confirm_topup_ton(call: CallbackQuery, user_id: str, user_data=None):
+    # Подтверждаем пополнение через TON
+    user_state = user_states.get(user_id, {})
+    
+    # Отладочная информация
+    logging.info(f"confirm_topup_ton: user_state = {user_state}")
+    
+    # Получаем сумму в зависимости от состояния
+    if user_state.get("state") == "insufficient_balance":
+        amount = user_state.get("needed_amount", 0)
+        
+        # Проверяем минимальную сумму для TON
+        if amount < TON_MIN_AMOUNT:
+            bot.answer_callback_query(
+                call.id, 
+                f"❌ Минимальная сумма для TON: {TON_MIN_AMOUNT} ₽"
+            )
+            return
+    elif user_state.get("state") == "waiting_topup_amount":
+        amount = user_state.get("needed_amount", 0)
+    else:
+        amount = user_state.get("needed_amount", 0)
+    
+    logging.info(f"confirm_topup_ton: amount = {amount}")
+    
+    if amount > 0:
+        # Напрямую вызываем логику пополнения TON
+        if not TON_ENABLED or not ton_payment:
+            safe_edit_message(
+                chat_id=call.message.chat.id,
+                message_id=call.message.message_id,
+                text="❌ TON платежи временно недоступны",
+                reply_markup=create_back_keyboard()
+            )
+            return
         
-        # Получаем сумму в зависимости от состояния
-        if user_state.get("state") == "insufficient_balance":
-            amount = user_state.get("needed_amount", 0)
+        # Создаем платеж через TON
+        payment_data = ton_payment.create_payment_request(int(user_id), amount)
+        if payment_data and "error" not in payment_data:
+            # Сохраняем данные платежа
+            user_states[user_id] = {
+                "state": "waiting_payment_confirmation",
+                "payment_method": "ton",
+                "amount": amount,
+                "payment_id": payment_data["payment_id"],
+                "comment": payment_data["comment"],
+                "amount_ton": payment_data["amount_ton"],
+                "wallet_address": payment_data["wallet_address"],
+                "created_at": int(time.time())
+            }
             
-            # Проверяем минимальную сумму для TON
-            if amount < TON_MIN_AMOUNT:
-                bot.answer_callback_query(
-                    call.id, 
-                    f"❌ Минимальная сумма для TON: {TON_MIN_AMOUNT} ₽"
-                )
-                return
-        elif user_state.get("state") == "waiting_topup_amount":
-            amount = user_state.get("needed_amount", 0)
-        else:
-            amount = user_state.get("needed_amount", 0)
-        
-        logging.info(f"confirm_topup_ton: amount = {amount}")
-        
-        if amount > 0:
-            # Напрямую вызываем логику пополнения TON
-            if not TON_ENABLED or not ton_payment:
-                safe_edit_message(
-                    chat_id=call.message.chat.id,
-                    message_id=call.message.message_id,
-                    text="❌ TON платежи временно недоступны",
-                    reply_markup=create_back_keyboard()
-                )
-                return
+            payment_text = (
+                f"📋 Платеж сформирован\n\n"
+                f"💸 Сумма к отправке: {payment_data['amount_ton']:.4f} TON\n"
+                f"⚠️ Комментарий: <code>{payment_data['comment']}</code>\n"
+                f"💳 Адрес для оплаты: <code>{payment_data['wallet_address']}</code>\n\n"
+                f"‼️ Обязательно указывайте комментарий при отправке монет, в противном случае - пополнение не будет засчитано\n"
+                f"‼️ Окончательная сумма к получению будет рассчитана в момент получения монет\n\n"
+                f"📱 Для оплаты:\n"
+                f"1. Откройте TON кошелек\n"
+                f"2. Отправьте {payment_data['amount_ton']:.4f} TON на указанный адрес\n"
+                f"3. В комментарии укажите: <code>{payment_data['comment']}</code>\n"
+                f"4. Нажмите \"Проверить оплату\" после перевода"
+            )
             
-            # Создаем платеж через TON
-            payment_data = ton_payment.create_payment_request(int(user_id), amount)
-            if payment_data and "error" not in payment_data:
-                # Сохраняем данные платежа
-                user_states[user_id] = {
-                    "state": "waiting_payment_confirmation",
-                    "payment_method": "ton",
-                    "amount": amount,
-                    "payment_id": payment_data["payment_id"],
-                    "comment": payment_data["comment"],
-                    "amount_ton": payment_data["amount_ton"],
-                    "wallet_address": payment_data["wallet_address"],
-                    "created_at": int(time.time())
-                }
-                
-                payment_text = (
-                    f"📋 Платеж сформирован\n\n"
-                    f"💸 Сумма к отправке: {payment_data['amount_ton']:.4f} TON\n"
-                    f"⚠️ Комментарий: <code>{payment_data['comment']}</code>\n"
-                    f"💳 Адрес для оплаты: <code>{payment_data['wallet_address']}</code>\n\n"
-                    f"‼️ Обязательно указывайте комментарий при отправке монет, в противном случае - пополнение не будет засчитано\n"
-                    f"‼️ Окончательная сумма к получению будет рассчитана в момент получения монет\n\n"
-                    f"📱 Для оплаты:\n"
-                    f"1. Откройте TON кошелек\n"
-                    f"2. Отправьте {payment_data['amount_ton']:.4f} TON на указанный адрес\n"
-                    f"3. В комментарии укажите: <code>{payment_data['comment']}</code>\n"
-                    f"4. Нажмите \"Проверить оплату\" после перевода"
-                )
-                
-                # Создаем клавиатуру с кнопкой проверки оплаты
-                keyboard = InlineKeyboardMarkup()
-                keyboard.add(
-                    InlineKeyboardButton("🔍 Проверить оплату", callback_data=f"check_ton_payment_{payment_data['payment_id']}")
-                )
-                keyboard.add(
-                    InlineKeyboardButton("❌ Отменить", callback_data="cancel")
-                )
-                
-                safe_edit_message(
-                    chat_id=call.message.chat.id,
-                    message_id=call.message.message_id,
-                    text=payment_text,
-                    reply_markup=keyboard
-                )
-            else:
-                error_msg = payment_data.get("error", "Неизвестная ошибка") if payment_data else "Ошибка создания платежа"
-                safe_edit_message(
-                    chat_id=call.message.chat.id,
-                    message_id=call.message.message_id,
-                    text=f"❌ Ошибка создания TON платежа: {error_msg}",
-                    reply_markup=create_back_keyboard()
-                )
+            # Создаем клавиатуру с кнопкой проверки оплаты
+            keyboard = InlineKeyboardMarkup()
+            keyboard.add(
+                InlineKeyboardButton("🔍 Проверить оплату", callback_data=f"check_ton_payment_{payment_data['payment_id']}")
+            )
+            keyboard.add(
+                InlineKeyboardButton("❌ Отменить", callback_data="cancel")
+            )
+            
+            safe_edit_message(
+                chat_id=call.message.chat.id,
+                message_id=call.message.message_id,
+                text=payment_text,
+                reply_markup=keyboard
+            )
         else:
+            error_msg = payment_data.get("error", "Неизвестная ошибка") if payment_data else "Ошибка создания платежа"
             safe_edit_message(
                 chat_id=call.message.chat.id,
                 message_id=call.message.message_id,
-                text="❌ Ошибка: сумма не определена",
+                text=f"❌ Ошибка создания TON платежа: {error_msg}",
                 reply_markup=create_back_keyboard()
             )
+    else:
+        safe_edit_message(
+            chat_id=call.message.chat.id,
+            message_id=call.message.message_id,
+            text="❌ Ошибка: сумма не определена",
+            reply_markup=create_back_keyboard()
+        )
 
-    # Callback уже отвечен в начале функции
+
+# Обработчик callback запросов
+@bot.callback_query_handler(func=lambda call: True)
+@dispatcher.per_chat(chat_of_callback)
+def handle_callback(call: CallbackQuery):
+    user_id = str(call.from_user.id)
+    
+    # Сначала отвечаем на callback, чтобы избежать timeout
+    try:
+        bot.answer_callback_query(call.id)
+    except Exception as e:
+        logging.warning(f"⚠️ Не удалось ответить на callback: {e}")
+    
+    callback_router.dispatch(call, user_id)
 
 # Обработчик текстовых сообщений
 @bot.message_handler(func=lambda message: True)
+@dispatcher.per_chat(chat_of_message)
 def handle_text(message: Message):
     user_id = str(message.from_user.id)
     user_state = user_states.get(user_id, {})
-    users_data = load_users_data()
-    user_data = users_data.get(user_id, {})
-    user_data = update_user_structure(user_data, user_id)
+    user_data = get_user_data(user_id)
     
     if user_state.get("state") == "waiting_topup_amount":
         payment_method = user_state.get("payment_method", "apays")
@@ -2967,8 +3182,8 @@ def handle_text(message: Message):
                 effective_price = get_effective_star_price(user_data)
                 cost = stars_amount * effective_price
                 
-                if user_data.get('balance', 0) < cost:
-                    needed_amount = cost - user_data.get('balance', 0)
+                if user_data.balance < cost:
+                    needed_amount = cost - user_data.balance
                     
                     # Сохраняем нужную сумму в состоянии пользователя
                     user_states[user_id] = {
@@ -2980,7 +3195,7 @@ def handle_text(message: Message):
                     
                     insufficient_text = (
                         f"❌ Недостаточно средств для покупки\n\n"
-                        f"💰 Текущий баланс: {user_data.get('balance', 0):.2f} ₽\n"
+                        f"💰 Текущий баланс: {user_data.balance:.2f} ₽\n"
                         f"💸 Требуется: {cost:.2f} ₽\n"
                         f"💸 Не хватает: {needed_amount:.2f} ₽\n\n"
                     )
@@ -3004,8 +3219,8 @@ def handle_text(message: Message):
                     "cost": cost
                 }
                 
-                discount = user_data.get("referral_discount", 0.0)
-                qualified_referrals = sum(1 for ref in user_data.get("referrals", []) if ref.get("total_spent", 0) >= 500.0)
+                discount = user_data.referral_discount
+                qualified_referrals = referral_index.summary(user_id).qualified
                 
                 reply_text = (
                     f"⭐️ Количество: {stars_amount} звезд\n"
@@ -3156,12 +3371,11 @@ def handle_text(message: Message):
             # Для пользовательской суммы используем минимальную сумму TON (самую низкую)
             if TON_MIN_AMOUNT <= amount <= PAYMENT_MAX_AMOUNT:
                 # Показываем меню выбора способа оплаты с введенной суммой
-                user_data = users_data.get(user_id, {})
-                user_data = update_user_structure(user_data, user_id)
+                user_data = get_user_data(user_id)
                 
                 topup_text = (
                     "💳 Пополнение баланса\n\n"
-                    f"💰 Текущий баланс: {user_data.get('balance', 0):.2f} ₽\n"
+                    f"💰 Текущий баланс: {user_data.balance:.2f} ₽\n"
                     f"💸 Сумма пополнения: {amount:.2f} ₽\n\n"
                     "🔽 Выберите способ оплаты:"
                 )
@@ -3225,134 +3439,152 @@ def handle_text(message: Message):
 
 # Функция автопроверки TON платежей
 def auto_check_ton_payments():
-    """Автоматически проверяет ожидающие TON платежи"""
+    """
+    Автоматически проверяет ожидающие TON платежи. Проверка каждого платежа ставится
+    в очередь чата пользователя в диспетчере, поэтому не идет одновременно с нажатием
+    "Проверить платеж" этого же пользователя.
+    """
     try:
         current_time = int(time.time())
         
-        # Загружаем данные пользователей
-        users_data = load_users_data()
-        
         # Проверяем всех пользователей с ожидающими TON платежами
         for user_id, user_state in list(user_states.items()):
             if (user_state.get("state") == "waiting_payment_confirmation" and 
                 user_state.get("payment_method") == "ton" and
                 user_state.get("payment_id")):
                 
-                payment_id = user_state.get("payment_id")
                 created_at = user_state.get("created_at", current_time)
                 
                 # Проверяем только платежи старше 2 минут
                 if current_time - created_at > 120:
-                    try:
-                        result = ton_payment.check_ton_transaction(payment_id, user_state.get("comment"))
-                        
-                        if result.get("status") == "approved":
-                            # Платеж подтвержден
-                            amount_ton = result.get("amount", 0)
-                            amount_rub = ton_payment.ton_to_rubles(amount_ton)
-                            
-                            # Пополняем баланс пользователя
-                            user_data = users_data.get(user_id, {})
-                            user_data = update_user_structure(user_data, user_id)
-                            user_data['balance'] = user_data.get('balance', 0) + amount_rub
-                            users_data[user_id] = user_data
-                            save_users_data(users_data)
-                            
-                            # Отправляем лог о пополнении в техподдержку
-                            asyncio.run(log_balance_topup(
-                                user_id=user_id,
-                                username=user_data.get('username', 'Unknown'),
-                                amount=amount_rub,
-                                payment_method="TON (автопополнение)",
-                                success=True
-                            ))
-                            
-                            # Проверяем, есть ли информация о первоначальной покупке
-                            original_purchase = user_state.get("original_purchase")
-                            
-                            if original_purchase:
-                                # Это пополнение из-за недостаточного баланса для покупки звезд
-                                stars_amount = original_purchase.get("stars_amount")
-                                cost = original_purchase.get("cost")
-                                
-                                # Проверяем, что баланса теперь достаточно
-                                if user_data.get('balance', 0) >= cost:
-                                    # Устанавливаем состояние для продолжения покупки
-                                    user_states[user_id] = {
-                                        "state": "waiting_recipient_username",
-                                        "stars_amount": stars_amount,
-                                        "cost": cost
-                                    }
-                                    
-                                    success_text = (
-                                        f"✅ Платеж автоматически подтвержден!\n\n"
-                                        f"💰 Получено: {amount_ton:.4f} TON ({amount_rub:.2f} ₽)\n"
-                                        f"💳 Новый баланс: {user_data['balance']:.2f} ₽\n\n"
-                                        f"🎉 Баланс пополнен! Продолжаем покупку {stars_amount} звезд.\n\n"
-                                        f"👤 Введите username получателя (например: @username):"
-                                    )
-                                    
-                                    try:
-                                        bot.send_message(
-                                            chat_id=user_id,
-                                            text=success_text,
-                                            reply_markup=create_cancel_keyboard()
-                                        )
-                                    except Exception as e:
-                                        logging.error(f"Ошибка отправки уведомления о продолжении покупки: {e}")
-                                else:
-                                    # Баланса все еще недостаточно
-                                    user_states.pop(user_id, None)
-                                    
-                                    success_text = (
-                                        f"✅ Платеж автоматически подтвержден!\n\n"
-                                        f"💰 Получено: {amount_ton:.4f} TON ({amount_rub:.2f} ₽)\n"
-                                        f"💳 Новый баланс: {user_data['balance']:.2f} ₽\n\n"
-                                        f"⚠️ Баланса все еще недостаточно для покупки {stars_amount} звезд ({cost:.2f} ₽)\n"
-                                        f"💸 Не хватает: {cost - user_data['balance']:.2f} ₽"
-                                    )
-                                    
-                                    try:
-                                        bot.send_message(
-                                            chat_id=user_id,
-                                            text=success_text,
-                                            reply_markup=create_main_menu()
-                                        )
-                                    except Exception as e:
-                                        logging.error(f"Ошибка отправки уведомления о недостаточном балансе: {e}")
-                            else:
-                                # Обычное пополнение баланса
-                                user_states.pop(user_id, None)
-                                
-                                success_text = (
-                                    f"✅ Платеж автоматически подтвержден!\n\n"
-                                    f"💰 Получено: {amount_ton:.4f} TON ({amount_rub:.2f} ₽)\n"
-                                    f"💳 Новый баланс: {user_data['balance']:.2f} ₽\n\n"
-                                    f"🎉 Баланс успешно пополнен!"
-                                )
-                                
-                                try:
-                                    bot.send_message(
-                                        chat_id=user_id,
-                                        text=success_text,
-                                        reply_markup=create_main_menu()
-                                    )
-                                    logging.info(f"✅ Автоподтверждение TON платежа для пользователя {user_id}: {amount_ton:.4f} TON")
-                                except Exception as e:
-                                    logging.error(f"Ошибка отправки уведомления о подтверждении платежа: {e}")
-                                
-                    except Exception as e:
-                        logging.error(f"Ошибка автопроверки TON платежа {payment_id}: {e}")
+                    dispatcher.submit(int(user_id), auto_check_ton_payment, user_id, user_state.get("payment_id"))
                         
     except Exception as e:
         logging.error(f"Ошибка автопроверки TON платежей: {e}")
 
+# Автопроверка одного TON платежа (выполняется в очереди чата пользователя)
+def auto_check_ton_payment(user_id, payment_id):
+    user_state = user_states.get(user_id, {})
+    # Платеж уже обработан нажатием кнопки, пока проверка ждала в очереди
+    if user_state.get("payment_id") != payment_id or user_state.get("state") != "waiting_payment_confirmation":
+        return
+    try:
+        result = ton_payment.check_ton_transaction(payment_id, user_state.get("comment"))
+
+        if result.get("status") == "approved":
+            # Платеж подтвержден
+            amount_ton = result.get("amount", 0)
+            amount_rub = ton_payment.ton_to_rubles(amount_ton)
+
+            # Пополняем баланс пользователя
+            user_data = credit_payment_once(user_id, amount_rub, payment_id, method="TON (автопополнение)")
+            if user_data is None:
+                return
+
+            # Отправляем лог о пополнении в техподдержку
+            spawn(log_balance_topup(
+                user_id=user_id,
+                username=user_data.username or 'Unknown',
+                amount=amount_rub,
+                payment_method="TON (автопополнение)",
+                success=True
+            ))
+
+            # Проверяем, есть ли информация о первоначальной покупке
+            original_purchase = user_state.get("original_purchase")
+
+            if original_purchase:
+                # Это пополнение из-за недостаточного баланса для покупки звезд
+                stars_amount = original_purchase.get("stars_amount")
+                cost = original_purchase.get("cost")
+
+                # Проверяем, что баланса теперь достаточно
+                if user_data.balance >= cost:
+                    # Устанавливаем состояние для продолжения покупки
+                    user_states[user_id] = {
+                        "state": "waiting_recipient_username",
+                        "stars_amount": stars_amount,
+                        "cost": cost
+                    }
+
+                    success_text = (
+                        f"✅ Платеж автоматически подтвержден!\n\n"
+                        f"💰 Получено: {amount_ton:.4f} TON ({amount_rub:.2f} ₽)\n"
+                        f"💳 Новый баланс: {user_data.balance:.2f} ₽\n\n"
+                        f"🎉 Баланс пополнен! Продолжаем покупку {stars_amount} звезд.\n\n"
+                        f"👤 Введите username получателя (например: @username):"
+                    )
+
+                    try:
+                        bot.send_message(
+                            chat_id=user_id,
+                            text=success_text,
+                            reply_markup=create_cancel_keyboard()
+                        )
+                    except Exception as e:
+                        logging.error(f"Ошибка отправки уведомления о продолжении покупки: {e}")
+                else:
+                    # Баланса все еще недостаточно
+                    user_states.pop(user_id, None)
+
+                    success_text = (
+                        f"✅ Платеж автоматически подтвержден!\n\n"
+                        f"💰 Получено: {amount_ton:.4f} TON ({amount_rub:.2f} ₽)\n"
+                        f"💳 Новый баланс: {user_data.balance:.2f} ₽\n\n"
+                        f"⚠️ Баланса все еще недостаточно для покупки {stars_amount} звезд ({cost:.2f} ₽)\n"
+                        f"💸 Не хватает: {cost - user_data.balance:.2f} ₽"
+                    )
+
+                    try:
+                        bot.send_message(
+                            chat_id=user_id,
+                            text=success_text,
+                            reply_markup=create_main_menu()
+                        )
+                    except Exception as e:
+                        logging.error(f"Ошибка отправки уведомления о недостаточном балансе: {e}")
+            else:
+                # Обычное пополнение баланса
+                user_states.pop(user_id, None)
+
+                success_text = (
+                    f"✅ Платеж автоматически подтвержден!\n\n"
+                    f"💰 Получено: {amount_ton:.4f} TON ({amount_rub:.2f} ₽)\n"
+                    f"💳 Новый баланс: {user_data.balance:.2f} ₽\n\n"
+                    f"🎉 Баланс успешно пополнен!"
+                )
+
+                try:
+                    bot.send_message(
+                        chat_id=user_id,
+                        text=success_text,
+                        reply_markup=create_main_menu()
+                    )
+                    logging.info(f"✅ Автоподтверждение TON платежа для пользователя {user_id}: {amount_ton:.4f} TON")
+                except Exception as e:
+                    logging.error(f"Ошибка отправки уведомления о подтверждении платежа: {e}")
+
+    except Exception as e:
+        logging.error(f"Ошибка автопроверки TON платежа {payment_id}: {e}")
+
+# Интервал автопроверки TON платежей (секунды)
+TON_AUTO_CHECK_INTERVAL = 30
+
+# Фоновая автопроверка TON платежей: работает и в polling, и в webhook режиме
+def run_auto_check_ton_payments(stop_event=None):
+    stop_event = stop_event or threading.Event()
+    while not stop_event.wait(TON_AUTO_CHECK_INTERVAL):
+        auto_check_ton_payments()
+
 # Инициализация логирования
 log_init()
 
 # Запуск бота
 if __name__ == "__main__":
     print("🤖 Telegram бот запущен...")
+    if image_optimizer.enabled:
+        threading.Thread(target=image_optimizer.optimize_all, args=(BOT_IMAGES,),
+                         name="image-optimizer", daemon=True).start()
     try:
         bot_info = bot.get_me()
         print(f"👤 Username: @{bot_info.username}")
@@ -3361,6 +3593,27 @@ if __name__ == "__main__":
         print("Проверьте правильность BOT_TOKEN в config.py")
         exit(1)
     
+    # Автопроверка TON платежей каждые TON_AUTO_CHECK_INTERVAL секунд в любом режиме
+    threading.Thread(target=run_auto_check_ton_payments, name="ton-auto-check", daemon=True).start()
+    
+    # Режим webhook: Telegram сам присылает обновления, при ошибке переходим на polling
+    if BOT_MODE == "webhook" and WEBHOOK_URL:
+        try:
+            print(f"🌐 Запуск webhook: {WEBHOOK_URL}{WEBHOOK_PATH}")
+            run_webhook(
+                bot,
+                WEBHOOK_URL,
+                WEBHOOK_SECRET or generate_secret(),
+                host=WEBHOOK_HOST,
+                port=WEBHOOK_PORT,
+                path=WEBHOOK_PATH
+            )
+        except Exception as e:
+            logging.error(f"❌ Ошибка webhook, переходим на polling: {e}")
+            print(f"⚠️ Webhook недоступен ({e}), запускаем polling")
+    elif BOT_MODE == "webhook":
+        logging.warning("⚠️ BOT_MODE = 'webhook', но WEBHOOK_URL не задан: запускаем polling")
+    
     # Очищаем webhook перед запуском polling
     try:
         print("🧹 Очистка webhook...")
@@ -3372,9 +3625,6 @@ if __name__ == "__main__":
     # Запуск с обработкой ошибок соединения
     while True:
         try:
-            # Автопроверка TON платежей каждые 30 секунд
-            auto_check_ton_payments()
-            
             print("🔄 Запуск polling...")
             bot.polling(none_stop=True, interval=1, timeout=20)
         except Exception as e:
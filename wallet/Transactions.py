@@ -1,6 +1,5 @@
 # wallet/Transactions.py
 import logging
-import requests
 
 # --- Импорт TonTools для версии 2.1.2 ---
 TONTOOLS_AVAILABLE = False
@@ -16,8 +15,14 @@ except ImportError as e:
     logging.warning("⚠️ TonTools НЕДОСТУПЕН.")
 
 import asyncio
+from Functions.HttpSessions import get_session
 from tonsdk.utils import from_nano, to_nano
-from tonsdk.contract.wallet import Wallets, WalletVersionEnum
+from wallet.WalletIdentity import get_identity
+
+# Сколько следующая отправка ждет, пока сеть примет предыдущий перевод (seqno увеличится),
+# и как часто проверять, секунды
+SEQNO_TIMEOUT = 30
+SEQNO_POLL_INTERVAL = 1
 
 
 class Transactions:
@@ -35,6 +40,12 @@ class Transactions:
             logging.error("❌ Не удалось импортировать TON_CENTER_API_URL или TON_CENTER_API_KEY из config.py")
             self.ton_center_api_url = "https://toncenter.com/api/v2"
             self.ton_center_api_key = None
+        # TonCenterClient создается при первой отправке и дальше переиспользуется
+        self._provider = None
+        # Кошельки TonTools по (мнемоника, версия): ключи выводятся при создании кошелька
+        self._wallets = {}
+        # seqno последнего отправленного перевода по кошельку: следующий перевод ждет только его
+        self._sent_seqno = {}
 
     async def get_balance(self, mnemonics, version='v4r2'):
         """
@@ -45,10 +56,8 @@ class Transactions:
             return {"success": False, "message": "TonTools не установлен", "error": "TonTools library not available", "balance_ton": 0}
 
         try:
-            # 1. Создаем кошелек из мнемоники для получения адреса
-            wallet_version_enum = getattr(WalletVersionEnum, version, WalletVersionEnum.v4r2)
-            _, _, _, wallet_obj = Wallets.from_mnemonics(mnemonics=mnemonics, version=wallet_version_enum, workchain=0)
-            wallet_address = wallet_obj.address.to_string(True, True, True)
+            # 1. Адрес кошелька (ключи из мнемоники выводятся один раз на процесс)
+            wallet_address = get_identity(mnemonics, version).address
             logging.info(f"👛 Адрес кошелька для проверки баланса: {wallet_address}")
 
             # 2. Запрашиваем баланс через TON Center API
@@ -61,10 +70,15 @@ class Transactions:
                  logging.warning("⚠️ TON Center API ключ не настроен в config.py!")
 
             logging.info(f"📡 Запрос баланса: GET {balance_url} с параметрами {balance_params}")
-            balance_response = requests.get(balance_url, params=balance_params)
+            # Общая aiohttp-сессия: запрос не блокирует цикл событий и переиспользует соединение
+            async with get_session("toncenter").get(balance_url, params=balance_params) as balance_response:
+                status_code = balance_response.status
+                if status_code == 200:
+                    balance_data = await balance_response.json(content_type=None)
+                else:
+                    response_text = await balance_response.text()
 
-            if balance_response.status_code == 200:
-                balance_data = balance_response.json()
+            if status_code == 200:
                 logging.info(f"📥 Ответ TON Center API (баланс): {balance_data}")
                 if balance_data.get("ok"):
                     balance_nano = int(balance_data["result"])
@@ -76,7 +90,7 @@ class Transactions:
                     logging.error(error_msg)
                     return {"success": False, "message": "Ошибка API", "error": error_msg, "balance_ton": 0}
             else:
-                error_msg = f"❌ HTTP ошибка при получении баланса: {balance_response.status_code}, {balance_response.text}"
+                error_msg = f"❌ HTTP ошибка при получении баланса: {status_code}, {response_text}"
                 logging.error(error_msg)
                 return {"success": False, "message": "HTTP ошибка", "error": error_msg, "balance_ton": 0}
 
@@ -112,14 +126,14 @@ class Transactions:
             clean_payload = payload.replace("\n", " ") if payload else ""
             logging.info(f"📄 Payload (comment): {clean_payload}")
 
-            # 3. Создаем провайдер и кошелек
-            provider = TonCenterClient(testnet=self.testnet)
-            wallet = Wallet(mnemonics=mnemonics, version=version, provider=provider)
+            # 3. Провайдер и кошелек (создаются один раз)
+            identity, wallet = self._wallet(mnemonics, version)
 
             # 4. Отправляем транзакцию
             logging.info(f"🚀 Отправка {amount_ton} TON на {destination_address}...")
             
-            # В TonTools 2.1.2 используем новый API
+            # В TonTools 2.1.2 используем новый API; transfer_ton сам читает seqno
+            seqno = await wallet.get_seqno()
             result = await wallet.transfer_ton(
                 destination_address=destination_address,
                 amount=amount_ton,  # Сумма в TON
@@ -128,6 +142,7 @@ class Transactions:
             )
             
             logging.info("✅ Транзакция отправлена успешно!")
+            self._sent_seqno[identity.key] = seqno
             
             # Попытка извлечь хэш
             tx_hash = "unknown"
@@ -142,11 +157,69 @@ class Transactions:
             logging.error(f"❌ Ошибка в _send_ton_async: {e}", exc_info=True)
             return {"success": False, "message": "Ошибка отправки", "error": str(e)}
 
+    def _wallet(self, mnemonics, version):
+        """Данные кошелька и кошелек TonTools (с общим TonCenterClient) для мнемоники"""
+        if self._provider is None:
+            self._provider = TonCenterClient(testnet=self.testnet)
+        identity = get_identity(mnemonics, version)
+        wallet = self._wallets.get(identity.key)
+        if wallet is None:
+            wallet = self._wallets[identity.key] = Wallet(mnemonics=list(identity.mnemonics), version=version, provider=self._provider)
+        return identity, wallet
+
+    async def _wait_previous_transfer(self, mnemonics, version):
+        """
+        Если предыдущий перевод с кошелька еще не принят сетью (seqno прежний), ждет только его.
+        None - можно отправлять; иначе словарь с ошибкой.
+        """
+        identity, wallet = self._wallet(mnemonics, version)
+        pending = self._sent_seqno.get(identity.key)
+        if pending is None:
+            return None
+        try:
+            if await wallet.get_seqno() > pending:
+                return None
+        except Exception as e:
+            logging.warning(f"⚠️ Не удалось прочитать seqno кошелька: {e}")
+        if await self._wait_seqno(wallet, pending) is not None:
+            return None
+        error_msg = f"Предыдущий перевод (seqno {pending}) не принят сетью за {SEQNO_TIMEOUT} с"
+        logging.error(f"❌ {error_msg}")
+        return {"success": False, "message": "Кошелек занят", "error": error_msg}
+
+    async def _wait_seqno(self, wallet, seqno):
+        """Ждет, пока сеть примет перевод с seqno; новый seqno или None по таймауту"""
+        deadline = asyncio.get_running_loop().time() + SEQNO_TIMEOUT
+        while asyncio.get_running_loop().time() < deadline:
+            await asyncio.sleep(SEQNO_POLL_INTERVAL)
+            try:
+                current = await wallet.get_seqno()
+            except Exception as e:
+                logging.warning(f"⚠️ Не удалось прочитать seqno кошелька: {e}")
+                continue
+            if current > seqno:
+                logging.info(f"🔢 seqno кошелька: {seqno} -> {current}")
+                return current
+        logging.warning(f"⚠️ seqno кошелька не изменился за {SEQNO_TIMEOUT} с (был {seqno})")
+        return None
+
     async def send_ton(self, mnemonics, destination_address, amount, payload="", nano_amount=True, version='v4r2', send_mode=0):
         """
         Асинхронный метод для отправки TON.
-        Сначала проверяет баланс, затем отправляет.
+        Сначала проверяет баланс, затем отправляет. Отправки с одного кошелька идут по очереди:
+        блокировка держится от проверки баланса до принятия перевода API. Сеть применяет перевод
+        позже, поэтому следующая отправка сначала ждет, пока seqno предыдущего перевода увеличится
+        (не дольше SEQNO_TIMEOUT), и только потом читает баланс.
         """
+        async with get_identity(mnemonics, version).transfer_lock():
+            if TONTOOLS_AVAILABLE:
+                busy = await self._wait_previous_transfer(mnemonics, version)
+                if busy is not None:
+                    return busy
+            return await self._send_ton_locked(mnemonics, destination_address, amount, payload,
+                                               nano_amount, version, send_mode)
+
+    async def _send_ton_locked(self, mnemonics, destination_address, amount, payload="", nano_amount=True, version='v4r2', send_mode=0):
         logging.info("💸 Отправляем TON транзакцию (TonTools 2.1.2)...")
 
         # 1. Проверяем баланс перед отправкой
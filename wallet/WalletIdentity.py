@@ -0,0 +1,104 @@
+"""
+Ключи, адрес и контракт кошелька, полученные из мнемоники один раз на процесс
+
+Получение ключей из мнемоники в tonsdk - это PBKDF2 (проверка мнемоники и сам вывод ключа),
+а раньше оно повторялось на каждой покупке в трех местах: FragmentApi.PaymentGet
+(публичный ключ для getBuyStarsLink), Transactions.get_balance (адрес) и Transactions._send_ton_async (кошелек TonTools).
+
+Замер: python -m wallet.WalletIdentity [покупок]
+"""
+import asyncio
+import logging
+import sys
+import threading
+import time
+from typing import Dict, List, Tuple
+
+from tonsdk.contract.wallet import Wallets, WalletVersionEnum
+
+
+class WalletIdentity:
+    __slots__ = ("key", "mnemonics", "version", "public_key", "private_key", "address", "contract", "_transfer_lock")
+
+    def __init__(self, mnemonics: List[str], version: str = "v4r2"):
+        self.mnemonics = tuple(mnemonics)
+        self.version = version
+        self.key = (self.mnemonics, version)
+        _, pub_k, priv_k, contract = Wallets.from_mnemonics(
+            mnemonics=list(mnemonics),
+            version=getattr(WalletVersionEnum, version, WalletVersionEnum.v4r2),
+            workchain=0
+        )
+        self.public_key = pub_k.hex()
+        self.private_key = priv_k.hex()
+        self.address = contract.address.to_string(True, True, True)
+        self.contract = contract
+        self._transfer_lock = None
+
+    def transfer_lock(self) -> asyncio.Lock:
+        """
+        Блокировка отправок с этого кошелька: seqno читается и расходуется одной отправкой за раз,
+        иначе параллельные покупки отправят переводы с одинаковым seqno и сеть примет только один.
+        Создается при первом обращении внутри общего цикла событий (Functions.AsyncLoop).
+        """
+        if self._transfer_lock is None:
+            self._transfer_lock = asyncio.Lock()
+        return self._transfer_lock
+
+
+_identities: Dict[Tuple[Tuple[str, ...], str], WalletIdentity] = {}
+_lock = threading.Lock()
+
+
+def get_identity(mnemonics: List[str], version: str = "v4r2") -> WalletIdentity:
+    """Данные кошелька для мнемоники; ключи выводятся только при первом обращении"""
+    key = (tuple(mnemonics), version)
+    identity = _identities.get(key)
+    if identity is not None:
+        return identity
+    with _lock:
+        identity = _identities.get(key)
+        if identity is None:
+            identity = _identities[key] = WalletIdentity(mnemonics, version)
+        return identity
+
+
+def warm_up(mnemonics: List[str], version: str = "v4r2"):
+    """Выводит ключи при запуске бота, чтобы первая покупка их не ждала"""
+    try:
+        started = time.perf_counter()
+        identity = get_identity(mnemonics, version)
+        logging.info(f"✅ Ключи кошелька получены за {(time.perf_counter() - started) * 1000:.0f} мс: {identity.address}")
+    except Exception as e:
+        logging.warning(f"⚠️ Не удалось получить ключи кошелька из WALLET_MNEMONICS: {e}")
+
+
+def bench(purchases: int = 20):
+    """Сравнивает вывод ключей на каждой покупке (3 раза) с кэшем"""
+    from tonsdk.crypto import mnemonic_new
+
+    mnemonics = mnemonic_new()
+    version = getattr(WalletVersionEnum, "v4r2")
+
+    started = time.perf_counter()
+    for _ in range(purchases):
+        # Тело getBuyStarsLink, Transactions.get_balance и кошелек для отправки
+        for _ in range(3):
+            Wallets.from_mnemonics(mnemonics=mnemonics, version=version, workchain=0)
+    uncached = time.perf_counter() - started
+
+    _identities.clear()
+    started = time.perf_counter()
+    for _ in range(purchases):
+        for _ in range(3):
+            get_identity(mnemonics, "v4r2")
+    cached = time.perf_counter() - started
+
+    print(f"Покупок: {purchases}")
+    print(f"Без кэша: {uncached * 1000 / purchases:8.1f} мс процессора на покупку")
+    print(f"С кэшем:  {cached * 1000 / purchases:8.3f} мс на покупку (вывод ключей один раз: {cached * 1000:.1f} мс)")
+    print(f"Экономия: {(uncached - cached) * 1000 / purchases:.1f} мс на покупку")
+
+
+if __name__ == "__main__":
+    bench(int(sys.argv[1]) if len(sys.argv) > 1 else 20)